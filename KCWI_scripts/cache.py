@@ -0,0 +1,296 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from KCWI_scripts.ipac_reader import read_compact
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts import trace
+
+# Shared on-disk cache of KOA metadata tables.
+#
+# Every entry is one query result (a night, a position search, a parsed local
+# table...) stored as an uncompressed .npz with the encoded arrays of its
+# CompactTable (compact_table.py), which loads much faster than re-parsing the
+# ASCII IPAC file; tables come out of the cache as CompactTables. Entries for nights
+# older than KCWI_CACHE_RECENT_DAYS never expire; everything else expires after
+# KCWI_CACHE_TTL seconds. When the cache grows over KCWI_CACHE_MAX_BYTES the
+# least recently used entries are removed (the file mtime is the access time).
+# Long-running processes (the service) also keep up to KCWI_CACHE_MEMORY_BYTES
+# of recently used tables in memory, so repeated lookups skip the disk too.
+# The size of the cache is tracked as entries are written; the directory is
+# only scanned when that estimate goes over the limit (and then entries are
+# removed down to EVICT_TO of it, so the next writes don't scan again), and
+# every EVICT_EVERY writes to count what other processes wrote.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kcwi_scripts")
+DEFAULT_MAX_BYTES = 2 * 1024**3
+DEFAULT_TTL = 24 * 3600
+DEFAULT_RECENT_DAYS = 30
+DEFAULT_MEMORY_BYTES = 0
+EVICT_EVERY = 256
+EVICT_TO = 0.9
+
+_MASK_PREFIX = "__mask__"
+_CATEGORIES_PREFIX = "__categories__"
+
+
+class MetadataCache:
+    def __init__(self, cache_dir=None, max_bytes=None, ttl=None, recent_days=None, memory_bytes=None):
+        self.cache_dir = cache_dir or os.environ.get("KCWI_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_bytes = int(max_bytes if max_bytes is not None else os.environ.get("KCWI_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.ttl = float(ttl if ttl is not None else os.environ.get("KCWI_CACHE_TTL", DEFAULT_TTL))
+        self.recent_days = int(recent_days if recent_days is not None else os.environ.get("KCWI_CACHE_RECENT_DAYS", DEFAULT_RECENT_DAYS))
+        self.memory_bytes = int(memory_bytes if memory_bytes is not None else os.environ.get("KCWI_CACHE_MEMORY_BYTES", DEFAULT_MEMORY_BYTES))
+        self.enabled = self.max_bytes > 0 and os.environ.get("KCWI_NO_CACHE", "") == ""
+        self._lock = threading.Lock()
+        self._size = None  # bytes on disk as of the last scan plus what was written since
+        self._puts = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._memory_lock = threading.Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.npz")
+
+    # ttl for a night: None (permanent) for old nights, self.ttl for recent ones
+    def night_ttl(self, date):
+        import pandas as pd
+        age = pd.Timestamp.now().normalize() - pd.to_datetime(date)
+        if age > pd.Timedelta(days=self.recent_days):
+            return None
+        return self.ttl
+
+    # keep a parsed table in memory, dropping the least recently used ones over
+    # memory_bytes; size is what it takes, its nbytes by default
+    def _remember(self, key, table, expires, size=None):
+        size = _table_nbytes(table) if size is None else size
+        if size > self.memory_bytes:
+            return
+        with self._memory_lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_used -= old[2]
+            self._memory[key] = (table, expires, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, (_, _, dropped) = self._memory.popitem(last=False)
+                self._memory_used -= dropped
+
+    def _forget(self, key):
+        with self._memory_lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_used -= entry[2]
+
+    def _recall(self, key):
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            table, expires, size = entry
+            if expires and expires < time.time():
+                del self._memory[key]
+                self._memory_used -= size
+                return None
+            self._memory.move_to_end(key)
+            return table
+
+    def memory_usage(self):
+        with self._memory_lock:
+            return {"entries": len(self._memory), "bytes": self._memory_used, "max_bytes": self.memory_bytes}
+
+    # the table stored under key, or None; with columns, only those columns are
+    # read from the entry
+    def get(self, key, columns=None):
+        if not self.enabled:
+            return None
+
+        if self.memory_bytes > 0:
+            table = self._recall(key)
+            if table is not None:
+                trace.count("cache.memory_hit")
+                return table if columns is None else table[list(columns)]
+
+        path = self._path(key)
+        try:
+            with trace.span("cache.load"), np.load(path, allow_pickle=False) as data:
+                expires = float(data["__expires__"])
+                if expires and expires < time.time():
+                    expired = True
+                else:
+                    expired = False
+                    table = _table_from_arrays(data, columns)
+        except (OSError, KeyError, ValueError):
+            trace.count("cache.miss")
+            return None
+
+        if expired:
+            trace.count("cache.miss")
+            self._remove(path)
+            return None
+
+        trace.count("cache.hit")
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        # partial tables are not kept in memory
+        if self.memory_bytes > 0 and columns is None:
+            self._remember(key, table, expires)
+        return table
+
+    def put(self, key, table, ttl=None):
+        if not self.enabled or table is None:
+            return
+
+        table = CompactTable.from_table(table)
+        expires = time.time() + ttl if ttl else 0.0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        save_table(path, table, __expires__=np.array(expires))
+        if self.memory_bytes > 0:
+            self._remember(key, table, expires)
+
+        with self._lock:
+            self._puts += 1
+            if self._size is not None:
+                self._size += os.path.getsize(path) - replaced
+            scan = self._size is None or self._size > self.max_bytes or self._puts >= EVICT_EVERY
+        if scan:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # remove least recently used entries until the cache fits in max_bytes
+    # (in EVICT_TO of it, when it didn't fit)
+    def evict(self):
+        with self._lock:
+            try:
+                entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith(".npz")]
+            except OSError:
+                return
+
+            stats = []
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                stats.append((st.st_mtime, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in stats)
+            limit = self.max_bytes if total <= self.max_bytes else self.max_bytes * EVICT_TO
+            for _, size, path in sorted(stats):
+                if total <= limit:
+                    break
+                self._remove(path)
+                total -= size
+            self._size, self._puts = total, 0
+
+    def clear(self):
+        with self._memory_lock:
+            self._memory.clear()
+            self._memory_used = 0
+        with self._lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".npz"):
+                    self._remove(entry.path)
+            self._size = 0
+
+
+def _arrays_from_table(table):
+    table = CompactTable.from_table(table)
+    arrays = {"__colnames__": np.array(table.colnames, dtype=str),
+              "__units__": np.array([table.units.get(name, "") for name in table.colnames], dtype=str),
+              "__length__": np.array(len(table))}
+    for name, data, categories, mask in table.encoded():
+        arrays[name] = data
+        if categories is not None:
+            arrays[_CATEGORIES_PREFIX + name] = categories
+        if mask is not None:
+            arrays[_MASK_PREFIX + name] = mask
+    return arrays
+
+
+def _table_nbytes(table):
+    return CompactTable.from_table(table).nbytes
+
+
+# the arrays of an .npz are read when they are accessed, so only the given
+# columns (all by default) are read. Entries written before the tables were
+# compact have no __length__ and one plain array per column; they are encoded
+# as they load.
+def _table_from_arrays(data, columns=None):
+    names = [str(name) for name in data["__colnames__"]]
+    units = {name: str(unit) for name, unit in zip(names, data["__units__"]) if unit} if "__units__" in data.files else {}
+    if columns is not None:
+        missing = [c for c in columns if c not in names]
+        if missing:
+            raise KeyError(f"Columns not found: {missing}")
+        names = list(columns)
+    if "__length__" not in data.files:
+        return CompactTable.from_columns({name: data[name] for name in names},
+                                         {name: data[_MASK_PREFIX + name] for name in names if _MASK_PREFIX + name in data.files})
+
+    encoded = []
+    for name in names:
+        categories = data[_CATEGORIES_PREFIX + name] if _CATEGORIES_PREFIX + name in data.files else None
+        mask = data[_MASK_PREFIX + name] if _MASK_PREFIX + name in data.files else None
+        encoded.append((name, data[name], categories, mask))
+    return CompactTable.from_encoded(encoded, {name: units[name] for name in names if name in units}, int(data["__length__"]))
+
+
+# write a table as an uncompressed .npz (the cache entry format), atomically
+def save_table(path, table, **extra):
+    arrays = _arrays_from_table(table)
+    arrays.update(extra)
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_table(path):
+    with np.load(path, allow_pickle=False) as data:
+        return _table_from_arrays(data)
+
+
+_default_cache = None
+
+
+# process-wide cache configured from the KCWI_CACHE_* environment variables
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MetadataCache()
+    return _default_cache
+
+
+# read a local metadata file through the cache, keyed by its path, size, mtime
+# and the requested columns
+def read_table(path, columns=None):
+    st = os.stat(path)
+    key = ("file", os.path.abspath(path), st.st_size, st.st_mtime, tuple(columns or ()))
+    cache = default_cache()
+
+    table = cache.get(key)
+    if table is None:
+        table = read_compact(path, columns)
+        cache.put(key, table)
+    return table
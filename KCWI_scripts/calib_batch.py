@@ -0,0 +1,189 @@
+import os
+import json
+import argparse
+import numpy as np
+from KCWI_scripts.metadata import fetch_window, window_dates
+from KCWI_scripts.crossmatch import match_standard_stars
+from KCWI_scripts.standard_stars import load_catalog
+from KCWI_scripts.inventory import NightInventory, calibration_quotas, take_calibrations, config_label
+from KCWI_scripts.calib_finder import required_calibrations
+from KCWI_scripts.downloader import DownloadEngine
+from KCWI_scripts.frame_store import default_store
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts import trace
+
+
+# expand 'YYYY-MM-DD/YYYY-MM-DD' into the list of nights it covers
+def expand_date_range(date_range):
+    start, end = date_range.split('/')
+    import pandas as pd
+    return [d.strftime('%Y-%m-%d') for d in pd.date_range(start, end)]
+
+
+# range_dates: more nights (e.g. from --date_range), planned only when they
+# have science frames; the nights in dates are always planned
+def plan_calibrations(dates, outpath='./downloads/', days_to_check=7, tolerance_arcsec=5, range_dates=(),
+                      bias_min_nframes=7, flatlamp_min_nframes=6, domeflat_min_nframes=3,
+                      twiflat_min_nframes=1, dark_min_nframes=3, arc_min_nframes=1, contbars_min_nframes=1,
+                      standards_file=None):
+
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+
+    required = required_calibrations(bias_min_nframes, flatlamp_min_nframes, domeflat_min_nframes, twiflat_min_nframes,
+                                     dark_min_nframes, arc_min_nframes, contbars_min_nframes)
+
+    given = set(dates)
+    dates = sorted(given | set(range_dates))
+    windows = {date: [date] + window_dates(date, days_to_check) for date in dates}
+
+    # every night of every window is fetched and indexed exactly once
+    all_nights = sorted(set(night for window in windows.values() for night in window))
+    print(f"Fetching metadata for {len(all_nights)} nights ({all_nights[0]} to {all_nights[-1]})...")
+    tables = fetch_window(all_nights, outpath)
+
+    star_names, star_coords = load_catalog(standards_file)
+    inventories = {}
+    star_matches = {}
+    filehands = {}
+    for night, table in tables.items():
+        if table is None:
+            continue
+        with trace.span("match", night=night):
+            inventories[night] = NightInventory(table)
+            if 'filehand' in table.colnames:
+                filehands.update(zip(np.asarray(table['koaid']).astype(str), np.asarray(table['filehand']).astype(str)))
+            star_idx, frame_idx, _ = match_standard_stars(star_coords, table, tolerance_arcsec)
+            star_matches[night] = [(star_names[i], str(table['koaid'][j])) for i, j in zip(star_idx, frame_idx)]
+
+    plan = {'nights': {}, 'download': []}
+    download = set()
+
+    for date in dates:
+        if date not in given and (date not in inventories or not inventories[date].configs('OBJECT')):
+            continue
+
+        if date not in inventories:
+            print(f"⚠️ No metadata found for {date}, skipping.")
+            continue
+
+        missing = calibration_quotas(inventories[date], required)
+        calibrations = {cal: [] for cal in required}
+        standard_star = None
+
+        # nearest nights first, the science night itself included
+        for night in windows[date]:
+            if night not in inventories:
+                continue
+
+            for (cal, config), koaids in take_calibrations(missing, inventories[night]).items():
+                calibrations[cal].extend((night, koaid) for koaid in koaids)
+                download.update(koaids)
+
+            if standard_star is None and star_matches[night]:
+                name, koaid = star_matches[night][0]
+                standard_star = (night, name, koaid)
+                download.add(koaid)
+
+            if standard_star is not None and all(n <= 0 for n in missing.values()):
+                break
+
+        plan['nights'][date] = {
+            'calibrations': calibrations,
+            'standard_star': standard_star,
+            'missing': {f"{cal}{config_label(config)}": n for (cal, config), n in missing.items() if n > 0},
+        }
+
+    plan['download'] = sorted(download)
+    plan['filehands'] = {koaid: filehands[koaid] for koaid in plan['download'] if koaid in filehands}
+    return plan
+
+
+# download every frame of a plan into one reduction directory; with the frame
+# store, frames downloaded before are only linked
+def download_plan(plan, download_dir, max_workers=4):
+    with DownloadEngine(download_dir, max_workers=max_workers, store=default_store()) as engine:
+        for koaid in plan['download']:
+            if koaid in plan['filehands']:
+                engine.submit(koaid, plan['filehands'][koaid])
+            else:
+                print(f"⚠️ No file handle for {koaid}, not downloaded.")
+    report = engine.report()
+
+    print(f"\n📥 {len(report['downloaded'])} files downloaded ({report['bytes'] / 1e6:.1f} MB), "
+          f"{len(report['skipped'])} already present, {len(report['failed'])} failed.")
+    return report
+
+
+def print_plan(plan):
+    for date, night in plan['nights'].items():
+        print(f"\n📊 ** {date} **")
+        for cal, found in night['calibrations'].items():
+            if found:
+                nights = sorted(set(fdate for fdate, _ in found))
+                print(f"✅ {cal}: {len(found)} frames from {', '.join(nights)}")
+            else:
+                print(f"❌ {cal}: No frames found.")
+
+        if night['standard_star']:
+            sdate, name, koaid = night['standard_star']
+            print(f"🌟 Standard star {name} found on {sdate}, file: {koaid}")
+        else:
+            print("⚠️ No standard star found in the checked range.")
+
+        for cal, n in night['missing'].items():
+            print(f"⚠️ {cal}: {n} more needed.")
+
+    print(f"\n📥 {len(plan['download'])} distinct frames to download for {len(plan['nights'])} nights.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Plan calibrations and standard stars for several science nights at once.")
+    parser.add_argument('dates', type=str, nargs='*', help = "Observation dates in format: 'YYYY-MM-DD'.")
+    parser.add_argument('--date_range', type=str, default=None, help = "Range of observation dates 'YYYY-MM-DD/YYYY-MM-DD' (of these, only nights with science frames are planned).")
+    parser.add_argument('--days_to_check', type=int, default=7, help="Number of days to check before and after each date.")
+    parser.add_argument('--tolerance_arcsec', type=float, default=5, help = "Tolerance in arcseconds for matching standard stars.")
+    parser.add_argument('--output_dir', type=str, default='.', help = "Output directory for the metadata files and the plan.")
+    parser.add_argument('--bias_min_nframes', type=int, default=7, help = "Minumun number of BIAS frames required.")
+    parser.add_argument('--flatlamp_min_nframes', type=int, default=6, help = "Minumun number of FLATLAMP frames required.")
+    parser.add_argument('--domeflat_min_nframes', type=int, default=3, help = "Minumun number of DOMEFLAT frames required.")
+    parser.add_argument('--twiflat_min_nframes', type=int, default=1, help = "Minumun number of TWIFLAT frames required.")
+    parser.add_argument('--dark_min_nframes', type=int, default=3, help = "Minumun number of DARK frames required.")
+    parser.add_argument('--arc_min_nframes', type=int, default=1, help = "Minumun number of ARCLAMP frames required.")
+    parser.add_argument('--contbars_min_nframes', type=int, default=1, help = "Minumun number of CONTBARS frames required.")
+    parser.add_argument('--standards_file', type=str, default=None, help = "CSV file (Name,RA,DEC) with your own standard stars (default: the package catalog).")
+    parser.add_argument('--download_dir', type=str, default=None, help = "Download every planned frame into this directory (linked from the local frame store).")
+    parser.add_argument('--download_workers', type=int, default=4, help = "Number of files downloaded at the same time (default 4).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
+
+    args = parser.parse_args()
+
+    try:
+        with trace.profiled(args.profile):
+            range_dates = expand_date_range(args.date_range) if args.date_range else []
+            dates = list(args.dates) + range_dates
+            if not dates:
+                parser.error("give at least one date or --date_range")
+
+            plan = plan_calibrations(args.dates, outpath = args.output_dir, days_to_check = args.days_to_check,
+                                     tolerance_arcsec = args.tolerance_arcsec, range_dates = range_dates,
+                                     bias_min_nframes = args.bias_min_nframes, flatlamp_min_nframes = args.flatlamp_min_nframes,
+                                     domeflat_min_nframes = args.domeflat_min_nframes, twiflat_min_nframes = args.twiflat_min_nframes,
+                                     dark_min_nframes = args.dark_min_nframes, arc_min_nframes = args.arc_min_nframes,
+                                     contbars_min_nframes = args.contbars_min_nframes, standards_file = args.standards_file)
+            print_plan(plan)
+
+            plan_path = os.path.join(args.output_dir, f"calib_plan_{min(dates)}_{max(dates)}.json")
+            with open(plan_path, "w") as plan_file:
+                json.dump(plan, plan_file, indent=2)
+            print(f"\n📝 Plan saved to: {plan_path}")
+
+            if args.download_dir:
+                download_plan(plan, args.download_dir, max_workers = args.download_workers)
+
+            default_client().print_report()
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,47 @@
 import os
-import pandas as pd
-from astropy.table import Table
-from astropy.coordinates import SkyCoord
-from astropy.coordinates import match_coordinates_sky
-import astropy.units as u
-from pykoa.koa import Koa
-import scipy
 import argparse
-import csv
-from importlib.resources import files
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-# load standard stars from csv file
-def load_stars():
-    data_file = files("KCWI_scripts").joinpath("data", "standard_stars.csv")
-    stars = []
-    with open(data_file, mode="r") as file:
-        reader = csv.reader(file)
-        next(reader)
-        for row in reader:
-            stars.append((row[0], row[1], row[2]))  # (Name, RA, DEC)
-    
-    return stars
-
-
-def check_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_arcsec=5):
+from concurrent.futures import ThreadPoolExecutor
+from KCWI_scripts.metadata import load_night, fetch_window, window_dates
+from KCWI_scripts.crossmatch import match_standard_stars
+from KCWI_scripts.standard_stars import load_catalog
+from KCWI_scripts.inventory import NightInventory
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts import trace
+
+def check_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_arcsec=5, window_fetch=True, standards_file=None):
     if not os.path.exists(outpath):
         os.makedirs(outpath) 
 
-    stars = load_stars()
-
-    # Convert coordinates to SkyCoord objectss
-    star_coords = [(name, SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg))) for name, ra, dec in stars]
+    # One SkyCoord for the whole catalog, parsed once per process and reused for every night's crossmatch
+    star_names, star_coords = load_catalog(standards_file)
 
     # requierd calibrations list
     required_calibrations = ['BIAS', 'DOMEFLAT', 'TWIFLAT', 'FLATLAMP', 'ARCLAMP', 'CONTBARS', 'DARK']
     found_dates = {cal: [] for cal in required_calibrations}
     found_dates['STANDARD'] = []
+    window_tables = {}
 
     def check_date_for_calibrations(check_date):
-        metadata_path = os.path.join(outpath, f'koa_metadata_{check_date}.tbl')
-
-        # if metadata file doesn't exist, query metadata from KOA
-        if not os.path.isfile(metadata_path):
-            try:
-                Koa.query_date(instrument='kcwi', date=check_date, outpath=metadata_path, overwrite=True)
-            except Exception as e:
-                print(f"Error querying metadata for {check_date}: {e}")
-                return None, None, None
-
-        if not os.path.isfile(metadata_path):
-            print(f"No metadata found for {check_date}.")
+        # use the table from the window query if there is one, otherwise query KOA for this night
+        if check_date in window_tables:
+            table = window_tables[check_date]
+        else:
+            table = load_night(check_date, outpath)
+
+        if table is None:
             return None, None, None
 
-        table = Table.read(metadata_path, format='ascii.ipac')
-        calibrations = list(set([str(row['koaimtyp']).upper() for row in table]))
-        ra_dec_coords = SkyCoord(ra=table['ra'] * u.deg, dec=table['dec'] * u.deg)
-        return calibrations, ra_dec_coords, table
+        with trace.span("match", night=check_date):
+            calibrations = NightInventory(table).types()
+
+            # every (star, frame) pair within the tolerance
+            star_idx, frame_idx, _ = match_standard_stars(star_coords, table, tolerance_arcsec)
+            star_matches = [(star_names[i], table['koaid'][j]) for i, j in zip(star_idx, frame_idx)]
+        return calibrations, star_matches, table
 
     # Verify calibrations and standard stars for the given date
     print(f"Checking calibrations for {date}...")
-    calibrations, ra_dec_coords, table = check_date_for_calibrations(date)
+    calibrations, star_matches, table = check_date_for_calibrations(date)
 
     if calibrations is None:
         return
@@ -74,25 +55,32 @@ def check_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_
 
     # Verify if standard stars are present
     found_star = False
-    for name, coord in star_coords:
-        try:
-            idx, sep, _ = match_coordinates_sky(coord, ra_dec_coords)
-            if sep.arcsecond <= tolerance_arcsec:
-                found_dates['STANDARD'].append((date, name, table['koaid'][idx]))
-                print(f"Standard star {name} found on {date}, file: {table['koaid'][idx]}")
-                found_star = True
-        except:
-            pass
+    for name, koaid in star_matches:
+        found_dates['STANDARD'].append((date, name, koaid))
+        print(f"Standard star {name} found on {date}, file: {koaid}")
+        found_star = True
 
     # if there are missing calibrations or no standard star found, check previous and next days
     if missing_calibrations or not found_dates['STANDARD']:
-        def process_date(delta):
-            check_date = (pd.to_datetime(date) + pd.Timedelta(days=delta)).strftime('%Y-%m-%d')
-            print(f"Checking calibrations for {check_date}...")
-            calibrations, ra_dec_coords, table = check_date_for_calibrations(check_date)
+        # workers only look at their own night; the results are merged here in
+        # window order, so the report doesn't depend on thread timing
+        def process_date(check_date):
+            calibrations, star_matches, table = check_date_for_calibrations(check_date)
+            return check_date, calibrations, star_matches
 
+        check_dates = window_dates(date, days_to_check)
+
+        # fetch all the neighbouring nights with one range query
+        if window_fetch:
+            window_tables.update(fetch_window(check_dates, outpath))
+
+        with ThreadPoolExecutor() as executor:
+            results = list(executor.map(process_date, check_dates))
+
+        for check_date, calibrations, star_matches in results:
+            print(f"Checking calibrations for {check_date}...")
             if calibrations is None:
-                return
+                continue
 
             for cal in missing_calibrations:
                 if cal in calibrations and check_date not in found_dates[cal]:
@@ -100,19 +88,10 @@ def check_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_
                     print(f"Calibration {cal} found on {check_date}.")
 
             if not found_star:
-                for name, coord in star_coords:
-                    try:
-                        idx, sep, _ = match_coordinates_sky(coord, ra_dec_coords)
-                        if sep.arcsecond <= tolerance_arcsec and check_date not in [d[0] for d in found_dates['STANDARD']]:
-                            found_dates['STANDARD'].append((check_date, name, table['koaid'][idx]))
-                            print(f"Standard star {name} found on {check_date}, file: {table['koaid'][idx]}")
-                    except:
-                        pass
-
-        all_offsets = [delta for offset in range(1, days_to_check + 1) for delta in [-offset, offset]]
-        with ThreadPoolExecutor() as executor:
-            executor.map(process_date, all_offsets)
-                        
+                for name, koaid in star_matches:
+                    found_dates['STANDARD'].append((check_date, name, koaid))
+                    print(f"Standard star {name} found on {check_date}, file: {koaid}")
+
     # report all dates where the missing calibrations were found
     for cal, dates in found_dates.items():
         if dates:
@@ -131,12 +110,18 @@ def main():
     parser.add_argument('days_to_check', type=int, default=7, help="Número de días a revisar antes y después de la fecha dada.")
     parser.add_argument('tolerance_arcsec', type=int, default=5, help="Tolerancia en arco segundos para la coincidencia de coordenadas.")
     parser.add_argument('--output_dir', type=str, default='.', help="Directorio de salida para los archivos descargados.")
+    parser.add_argument('--per_night_queries', action="store_true", help="Query KOA once per night instead of a single range query for the whole window.")
+    parser.add_argument('--standards_file', type=str, default=None, help="CSV file (Name,RA,DEC) with your own standard stars (default: the package catalog).")
     
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        check_calibrations(args.date, outpath=args.output_dir, days_to_check=args.days_to_check, tolerance_arcsec=args.tolerance_arcsec)
+        with trace.profiled(args.profile):
+            check_calibrations(args.date, outpath=args.output_dir, days_to_check=args.days_to_check, tolerance_arcsec=args.tolerance_arcsec,
+                               window_fetch=not args.per_night_queries, standards_file=args.standards_file)
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
@@ -1,34 +1,49 @@
 import os
-import pandas as pd
-from astropy.table import Table
-from astropy.coordinates import SkyCoord, match_coordinates_sky
-import astropy.units as u
-from pykoa.koa import Koa
-import csv
 import argparse
-from importlib.resources import files
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def load_stars():
-    data_file = files("KCWI_scripts").joinpath("data", "standard_stars.csv")
-    stars = []
-    with open(data_file, mode="r") as file:
-        reader = csv.reader(file)
-        next(reader)
-        for row in reader:
-            stars.append((row[0], row[1], row[2]))  # (Name, RA, DEC)
-    
-    return stars
+from KCWI_scripts.metadata import load_night, fetch_window, window_dates
+from KCWI_scripts.crossmatch import match_standard_stars
+from KCWI_scripts.standard_stars import load_catalog
+from KCWI_scripts.scheduler import run_nearest_first, offset_rings
+from KCWI_scripts.inventory import NightInventory, calibration_quotas, take_calibrations, config_label
+from KCWI_scripts.downloader import DownloadEngine
+from KCWI_scripts.frame_store import default_store
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.service import call_or_run
+from KCWI_scripts import trace
 
 def find_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_arcsec=5, summary = False, max_workers = 4,
                           bias_min_nframes=7, flatlamp_min_nframes=6, domeflat_min_nframes=3, 
-                          twiflat_min_nframes=1, dark_min_nframes=3, arc_min_nframes=1, contbars_min_nframes=1):
+                          twiflat_min_nframes=1, dark_min_nframes=3, arc_min_nframes=1, contbars_min_nframes=1,
+                          window_fetch=True, standards_file=None, download=False, download_dir=None, download_workers=4):
 
-    if not os.path.exists(outpath):
-        os.makedirs(outpath)
+    # with download, every selected frame is queued as soon as it is chosen so
+    # transfers overlap with the rest of the search
+    engine = None
+    if download:
+        engine = DownloadEngine(download_dir or outpath, max_workers=download_workers, calibfile=True, store=default_store())
 
-    # Dictionary with the minimum number of frames required for each calibration
-    required_calibrations = {
+    try:
+        return _find_calibrations(date, outpath, days_to_check, tolerance_arcsec, summary, max_workers,
+                                  bias_min_nframes, flatlamp_min_nframes, domeflat_min_nframes,
+                                  twiflat_min_nframes, dark_min_nframes, arc_min_nframes, contbars_min_nframes,
+                                  window_fetch, standards_file, engine)
+    finally:
+        if engine is not None:
+            wait_for_downloads(engine)
+
+
+def wait_for_downloads(engine):
+    print("\n⏳ Waiting for downloads to finish...")
+    report = engine.wait()
+    print(f"📥 {len(report['downloaded'])} files downloaded ({report['bytes'] / 1e6:.1f} MB) to {engine.outdir}, "
+          f"{len(report['skipped'])} already present, {len(report['failed'])} failed.")
+    return report
+
+
+# Dictionary with the minimum number of frames required for each calibration
+def required_calibrations(bias_min_nframes=7, flatlamp_min_nframes=6, domeflat_min_nframes=3, twiflat_min_nframes=1,
+                          dark_min_nframes=3, arc_min_nframes=1, contbars_min_nframes=1):
+    return {
         'BIAS': bias_min_nframes,
         'DOMEFLAT': domeflat_min_nframes,
         'TWIFLAT': twiflat_min_nframes,
@@ -38,158 +53,200 @@ def find_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_a
         'DARK': dark_min_nframes
     }
 
-    found_calibrations = {cal: [] for cal in required_calibrations}
-    missing_calibrations = {cal: required_calibrations[cal] for cal in required_calibrations}
 
-    stars = load_stars()
+# State of the search for one science night: the science night is given to
+# start(), then every neighbouring night to add() until is_done(). Shared by
+# find_calibrations and its asyncio version (pipeline.py), which only differ in
+# how the nights are fetched.
+class CalibrationSearch:
+    def __init__(self, date, required, tolerance_arcsec=5, standards_file=None, engine=None):
+        self.date = date
+        self.required = required
+        self.tolerance_arcsec = tolerance_arcsec
+        self.engine = engine
+
+        self.found_calibrations = {cal: [] for cal in required}
+        # {(cal, configuration): frames still needed}, filled once the science configurations are known
+        self.missing_calibrations = {}
+
+        # One SkyCoord for the whole catalog, parsed once per process and reused for every night's crossmatch
+        self.star_names, self.star_coords = load_catalog(standards_file)
+
+        self.found_star = None
+        self.found_before = False
+        self.standard_frames = []
+        self.download_list = []
+
+    # (inventory, star matches) of a night's table
+    def check(self, check_date, table):
+        with trace.span("match", night=check_date):
+            # all frames of the night grouped by image type and configuration
+            inventory = NightInventory(table)
+
+            # every (star, frame) pair within the tolerance, first star of the catalog first
+            star_idx, frame_idx, _ = match_standard_stars(self.star_coords, table, self.tolerance_arcsec)
+            star_matches = [(self.star_names[i], table['koaid'][j]) for i, j in zip(star_idx, frame_idx)]
+
+        return inventory, star_matches
+
+    # hand selected frames to the download engine; calibration frames are
+    # fetched alone, the standard star with its companion calibration files
+    def _queue_download(self, table, koaids, calib=True):
+        if self.engine is None:
+            return
+        filehands = dict(zip(table['koaid'], table['filehand']))
+        for koaid in koaids:
+            self.engine.submit(koaid, filehands[koaid], calib=calib)
+
+    # take as many matching frames of each missing calibration as still needed
+    def _add_calibrations(self, check_date, table, inventory, neighbour):
+        for (cal, config), koaids in take_calibrations(self.missing_calibrations, inventory).items():
+            if neighbour:
+                print(f"📥 Adding {len(koaids)} {cal}{config_label(config)} from {check_date} (Files: {', '.join(koaids)})...")
+                self.download_list.extend(koaids)
+            self.found_calibrations[cal].extend((check_date, koaid) for koaid in koaids)
+            self._queue_download(table, koaids)
+
+    def _add_stars(self, check_date, table, star_matches):
+        self.standard_frames.extend((check_date, name, koaid) for name, koaid in star_matches)
+        if not self.found_star and star_matches:
+            name, koaid = star_matches[0]
+            self.found_star = (check_date, name, koaid)
+            print(f"🌟 Standard star {name} found on {check_date}, file: {koaid}")
+            self._queue_download(table, [koaid], calib=False)
+
+    def start(self, table, inventory, star_matches):
+        # calibrations have to match the configurations used for science on this night
+        self.missing_calibrations.update(calibration_quotas(inventory, self.required))
+        self._add_calibrations(self.date, table, inventory, neighbour=False)
+        self._add_stars(self.date, table, star_matches)
+        self.found_before = self.found_star is not None
+
+    def add(self, check_date, table, inventory, star_matches):
+        self._add_calibrations(check_date, table, inventory, neighbour=True)
+        self._add_stars(check_date, table, star_matches)
+
+    def is_done(self):
+        return all(n <= 0 for n in self.missing_calibrations.values()) and self.found_star is not None
+
+    def _summary_lines(self, listing):
+        lines = []
+        for cal, found in self.found_calibrations.items():
+            if found:
+                lines.append(f"✅ {cal}: {len(found)} frames found.")
+                lines += [f"   - {fdate}: {ffile}" for fdate, ffile in found]
+            else:
+                lines.append(f"❌ {cal}: No frames found.")
 
-    # Convert coordinates to SkyCoord objects
-    star_skycoords = [(name, SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg))) for name, ra, dec in stars]
-    
-    found_star = None
-    found_before = False
-    download_list = []  
+        if self.found_star:
+            if listing or not self.found_before:
+                lines.append(f"\n🌟 Standard star {self.found_star[1]} found on {self.found_star[0]}, file: {self.found_star[2]}.")
+            lines.append(f"🌟 {len(self.standard_frames)} standard star frames found in the checked range:")
+            lines += [f"   - {fdate}: {name} ({koaid})" for fdate, name, koaid in self.standard_frames]
+        else:
+            lines.append("\n⚠️ No standard star found in the checked range.")
 
-    def check_date_for_calibrations(check_date):
-        metadata_path = os.path.join(outpath, f'koa_metadata_{check_date}.tbl')
+        if any(n > 0 for n in self.missing_calibrations.values()):
+            lines.append("\n⚠️ **Warning: Some calibrations are still missing:**")
+            lines += [f"   - {cal}{config_label(config)}: {n} more needed."
+                      for (cal, config), n in self.missing_calibrations.items() if n > 0]
+        else:
+            lines.append("\n🎉 **All required calibrations and a standard star were found successfully!**")
+        return lines
 
-        if not os.path.isfile(metadata_path):
-            try:
-                Koa.query_date(instrument='kcwi', date=check_date, outpath=metadata_path, overwrite=True)
-            except Exception as e:
-                print(f"❌ Error querying metadata for {check_date}: {e}")
-                return None, None, None
+    def print_summary(self):
+        print("\n📊 ** Summary of all calibrations found **")
+        for line in self._summary_lines(listing=False):
+            print(line)
 
-        if not os.path.isfile(metadata_path):
-            print(f"⚠️ No metadata found for {check_date}.")
-            return None, None, None
+    def write_summary(self, summary_path):
+        with open(summary_path, "w") as summary_file:
+            summary_file.write(f"📊 **Summary of Calibration Search & Downloads for {self.date}:**\n\n")
+            for line in self._summary_lines(listing=True):
+                summary_file.write(line + "\n")
+        print(f"\n📝 Summary file saved to: {summary_path}")
+
+
+def summary_path(outpath, date, days_to_check):
+    return os.path.join(outpath, f"summary_{date}_with_{days_to_check*2}_days.txt")
+
+
+def _find_calibrations(date, outpath, days_to_check, tolerance_arcsec, summary, max_workers,
+                       bias_min_nframes, flatlamp_min_nframes, domeflat_min_nframes,
+                       twiflat_min_nframes, dark_min_nframes, arc_min_nframes, contbars_min_nframes,
+                       window_fetch, standards_file, engine):
+
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
 
-        table = Table.read(metadata_path, format='ascii.ipac')
+    required = required_calibrations(bias_min_nframes, flatlamp_min_nframes, domeflat_min_nframes, twiflat_min_nframes,
+                                     dark_min_nframes, arc_min_nframes, contbars_min_nframes)
+    search = CalibrationSearch(date, required, tolerance_arcsec, standards_file, engine)
+    window_tables = {}
 
-        calibrations = {row["koaimtyp"].upper(): row["koaid"] for row in table}
-        ra_dec_coords = SkyCoord(ra=table['ra'] * u.deg, dec=table['dec'] * u.deg)
+    def check_date_for_calibrations(check_date):
+        if check_date in window_tables:
+            table = window_tables[check_date]
+        else:
+            table = load_night(check_date, outpath)
 
-        return table, calibrations, ra_dec_coords
+        if table is None:
+            return None, None, None
+        return (table,) + search.check(check_date, table)
 
     print(f"Checking calibrations for {date}...")
-    table, calibrations_koaid, ra_dec_coords = check_date_for_calibrations(date)
+    table, inventory, star_matches = check_date_for_calibrations(date)
 
     if table is None:
         return
 
-    for cal in required_calibrations:
-        if cal in calibrations_koaid:
-            found_calibrations[cal].append((date, calibrations_koaid[cal]))
-            missing_calibrations[cal] -= 1
-
-    for name, coord in star_skycoords:
-        try:
-            idx, sep, _ = match_coordinates_sky(coord, ra_dec_coords)
-            if sep.arcsecond <= tolerance_arcsec:
-                found_star = (date, name, table['koaid'][idx])
-                found_before = True
-                print(f"🌟 Standard star {name} found on {date}, file: {table['koaid'][idx]}")
-                break 
-        except:
-            pass 
-
-    if all(n <= 0 for n in missing_calibrations.values()) and found_star:
+    search.start(table, inventory, star_matches)
+
+    if search.is_done():
         print("\n✅ All required calibrations and a standard star are present.")
-        return
+        return search
 
-    check_dates = [
-        (pd.to_datetime(date) + pd.Timedelta(days=delta)).strftime('%Y-%m-%d')
-        for offset in range(1, days_to_check + 1)
-        for delta in [-offset, offset]
-    ]
-
-    # Función wrapper para el executor
-    def process_date(check_date):
-        result = check_date_for_calibrations(check_date)
-        return check_date, result
-
-    with ThreadPoolExecutor(max_workers = max_workers) as executor:
-        futures = {executor.submit(process_date, d): d for d in check_dates}
-
-        for future in as_completed(futures):
-            check_date, (table, calibrations_koaid, ra_dec_coords) = future.result()
-
-            if table is None:
-                continue
-
-            for cal in missing_calibrations:
-                if missing_calibrations[cal] > 0 and cal in calibrations_koaid:
-                    koaid = calibrations_koaid[cal]
-                    print(f"📥 Adding {cal} from {check_date} (File: {koaid})...")
-                    download_list.append(koaid)
-                    found_calibrations[cal].append((check_date, koaid))
-                    missing_calibrations[cal] -= 1
-
-        if not found_star:
-            for name, coord in star_skycoords:
-                try:
-                    idx, sep, _ = match_coordinates_sky(coord, ra_dec_coords)
-                    if sep.arcsecond <= tolerance_arcsec:
-                        found_star = (check_date, name, table['koaid'][idx])
-                        print(f"🌟 Standard star {name} found on {check_date}, file: {table['koaid'][idx]}")
-                        break
-                except:
-                    pass
-
-        if all(n <= 0 for n in missing_calibrations.values()) and found_star:
-            print("\n✅ All required calibrations and a standard star are present.")
-            return  
-
-
-    print("\n📊 ** Summary of all calibrations found **")
-    for cal, found in found_calibrations.items():
-        if found:
-            print(f"✅ {cal}: {len(found)} frames found.")
-            for fdate, ffile in found:
-                print(f"   - {fdate}: {ffile}")
-        else:
-            print(f"❌ {cal}: No frames found.")
+    check_dates = window_dates(date, days_to_check)
 
-    if found_star and not found_before:
-        print(f"\n🌟 Standard star {found_star[1]} found on {found_star[0]}, file: {found_star[2]}.")
+    # nights are checked nearest first; in window mode each unit is a ring of
+    # offsets (1, 2-3, 4-7, ...) fetched with one range query and checked before
+    # the next ring is requested, otherwise each night is its own query
+    if window_fetch:
+        units = offset_rings(check_dates)
+        max_in_flight = 1
     else:
-        print("\n⚠️ No standard star found in the checked range.")
+        units = [(None, [d]) for d in check_dates]
+        max_in_flight = max_workers
 
-    if any(n > 0 for n in missing_calibrations.values()):
-        print("\n⚠️ **Warning: Some calibrations are still missing:**")
-        for cal, n in missing_calibrations.items():
-            if n > 0:
-                print(f"   - {cal}: {n} more needed.")
-    else:
-        print("\n🎉 **All required calibrations and a standard star were found successfully!**")
+    def process_unit(unit):
+        lo, nights = unit
+        if lo is not None:
+            window_tables.update(fetch_window(nights, outpath, max_gap=2 * lo))
+        return [(check_date, check_date_for_calibrations(check_date)) for check_date in nights]
 
-    if summary:
-        summary_path = os.path.join(outpath, f"summary_{date}_with_{days_to_check*2}_days.txt")
+    def on_result(results):
+        for check_date, (table, inventory, star_matches) in results:
+            if table is not None:
+                search.add(check_date, table, inventory, star_matches)
 
-        with open(summary_path, "w") as summary_file:
-            summary_file.write(f"📊 **Summary of Calibration Search & Downloads for {date}:**\n\n")
-
-            for cal, found in found_calibrations.items():
-                if found:
-                    summary_file.write(f"✅ {cal}: {len(found)} frames found.\n")
-                    for fdate, ffile in found:
-                        summary_file.write(f"   - {fdate}: {ffile}\n")
-                else:
-                    summary_file.write(f"❌ {cal}: No frames found.\n")
-
-            if found_star:
-                summary_file.write(f"\n🌟 Standard star {found_star[1]} found on {found_star[0]}, file: {found_star[2]}.\n")
-            else:
-                summary_file.write("\n⚠️ No standard star found in the checked range.\n")
+    skipped = run_nearest_first(units, process_unit, on_result, search.is_done, max_in_flight=max_in_flight)
+    print_outcome(search, skipped, len(check_dates), summary, summary_path(outpath, date, days_to_check))
+    return search
 
-            if any(n > 0 for n in missing_calibrations.values()):
-                summary_file.write("\n⚠️ **Warning: Some calibrations are still missing:**\n")
-                for cal, n in missing_calibrations.items():
-                    if n > 0:
-                        summary_file.write(f"   - {cal}: {n} more needed.\n")
-            else:
-                summary_file.write("\n🎉 **All required calibrations and a standard star were found successfully!**\n")
-        print(f"\n📝 Summary file saved to: {summary_path}") 
+
+# print (and with summary write) the outcome of a search
+def print_outcome(search, skipped, n_dates, summary, path):
+    if skipped:
+        skipped_nights = sum(len(nights) for _, nights in skipped)
+        print(f"\n⏩ Search satisfied early: {len(skipped)} KOA queries saved ({skipped_nights} of {n_dates} nights not checked).")
+
+    if search.is_done():
+        print("\n✅ All required calibrations and a standard star are present.")
+        return
+
+    search.print_summary()
+    if summary:
+        search.write_summary(path)
 
 def main():
     parser = argparse.ArgumentParser(description = "Search for a given number of calibrations and a standard star for a given date.")
@@ -205,17 +262,36 @@ def main():
     parser.add_argument('--dark_min_nframes', type=int, default=3, help = "Minumun number of DARK frames required.")
     parser.add_argument('--arc_min_nframes', type=int, default=1, help = "Minumun number of ARCLAMP frames required.")
     parser.add_argument('--contbars_min_nframes', type=int, default=1, help = "Minumun number of CONTBARS frames required.")    
-    parser.add_argument('--max_workers', type=int, default = 4, help = "Number of threads to use for parallel processing.")
+    parser.add_argument('--max_workers', type=int, default = 4, help = "Number of nights queried at the same time with --per_night_queries.")
+    parser.add_argument('--per_night_queries', action = "store_true", help = "Query KOA once per night instead of a single range query for the whole window.")
+    parser.add_argument('--standards_file', type=str, default=None, help = "CSV file (Name,RA,DEC) with your own standard stars (default: the package catalog).")
+    parser.add_argument('--download', action = "store_true", help = "Download the selected calibrations and standard star frame while searching.")
+    parser.add_argument('--download_dir', type=str, default=None, help = "Directory for the downloaded frames (default: --output_dir).")
+    parser.add_argument('--download_workers', type=int, default = 4, help = "Number of files downloaded at the same time with --download.")
+    parser.add_argument('--pipeline', action = "store_true", help = "Run the search with the asyncio pipeline (KOA queries on an event loop, large tables parsed in a process pool, nights matched as they arrive).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        find_calibrations(args.date, outpath = args.output_dir, days_to_check = args.days_to_check, tolerance_arcsec = args.tolerance_arcsec, 
+        with trace.profiled(args.profile):
+            search = dict(date = args.date, outpath = args.output_dir, days_to_check = args.days_to_check, tolerance_arcsec = args.tolerance_arcsec, 
                           summary = args.summary, max_workers = args.max_workers,   
                           bias_min_nframes = args.bias_min_nframes, flatlamp_min_nframes = args.flatlamp_min_nframes, 
                           domeflat_min_nframes = args.domeflat_min_nframes, twiflat_min_nframes = args.twiflat_min_nframes, 
-                          dark_min_nframes = args.dark_min_nframes, arc_min_nframes = args.arc_min_nframes, contbars_min_nframes = args.contbars_min_nframes)
+                          dark_min_nframes = args.dark_min_nframes, arc_min_nframes = args.arc_min_nframes, contbars_min_nframes = args.contbars_min_nframes,
+                          window_fetch = not args.per_night_queries, standards_file = args.standards_file)
+            if args.pipeline:
+                from KCWI_scripts import pipeline
+                pipeline.run(pipeline.find_calibrations, **search, download = args.download, download_dir = args.download_dir,
+                             download_workers = args.download_workers)
+            elif args.download:
+                find_calibrations(**search, download = True, download_dir = args.download_dir, download_workers = args.download_workers)
+            else:
+                # answered by kcwi_service when one is running
+                call_or_run('find_calibrations', find_calibrations, **search)
     
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
@@ -0,0 +1,56 @@
+import sys
+import importlib
+
+# Single entry point for every script: kcwi <command> [arguments].
+#
+# Listing the commands only needs this table, and a command's module is
+# imported when it runs. The modules themselves import pandas, astropy, scipy,
+# pykoa and requests inside the functions that use them, so `--help`, argument
+# errors and lookups answered from the cache start in a fraction of a second
+# (tests/test_startup.py checks it).
+
+COMMANDS = {
+    "obs_table_date": ("KCWI_scripts.obs_table_date", "Table of the observations of a night."),
+    "obs_table_target": ("KCWI_scripts.obs_table_target", "Table of the observations around a position."),
+    "obs_table_targets": ("KCWI_scripts.obs_table_targets", "Tables of the observations for a list of targets."),
+    "download_files": ("KCWI_scripts.download_files", "Download the frames of a night (science, calibrations or both)."),
+    "download_files_by_date": ("KCWI_scripts.download_files_by_date", "Download a whole night into lev0/ and calib/ folders."),
+    "rename_files": ("KCWI_scripts.rename_files", "Name downloaded frames by their original file name."),
+    "calib_date_finder": ("KCWI_scripts.calib_date_finder", "Nights around a date with the missing calibrations."),
+    "calib_finder": ("KCWI_scripts.calib_finder", "Calibrations and a standard star for a night."),
+    "calib_batch": ("KCWI_scripts.calib_batch", "Calibration plan for several science nights."),
+    "verify_frames": ("KCWI_scripts.verify_frames", "Check downloaded frames against their metadata."),
+    "sync_archive": ("KCWI_scripts.sync_archive", "Keep a local mirror of the archive up to date."),
+    "service": ("KCWI_scripts.service", "Answer the lookups of the other commands from a warm process."),
+}
+
+
+def usage():
+    width = max(len(name) for name in COMMANDS)
+    lines = ["usage: kcwi <command> [arguments]", "", "Scripts to work with KCWI data.", "", "commands:"]
+    lines += [f"  {name:<{width}}  {description}" for name, (_, description) in COMMANDS.items()]
+    lines += ["", "Run 'kcwi <command> --help' for the arguments of a command."]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    if not argv or argv[0] in ("-h", "--help"):
+        print(usage())
+        return 0 if argv else 2
+
+    command = argv[0]
+    if command not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print(f"\nkcwi: error: unknown command '{command}'", file=sys.stderr)
+        return 2
+
+    # the command parses sys.argv itself, as when run as its own console script
+    sys.argv = [f"kcwi {command}"] + argv[1:]
+    module = importlib.import_module(COMMANDS[command][0])
+    return module.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+import numpy as np
+
+# Compact in-memory form of KOA metadata tables.
+#
+# A KOA table has ~100 columns, most of them strings with a handful of distinct
+# values per night (image type, camera, grating, slicer, target...), and as an
+# astropy Table every one is a unicode array of 4 bytes per character per row.
+# A CompactTable keeps:
+#   - strings with few distinct values dictionary-encoded: a uint8/uint16 code
+#     per row and each distinct value once
+#   - the other strings (koaid, file names, dates) as fixed-width ASCII bytes,
+#     1 byte per character
+#   - numbers (ra, dec, mjd...) as the int64/float64 arrays they were read as
+#   - a mask only for the columns with null values
+# Columns are decoded when they are accessed: table['koaimtyp'] is the array
+# (masked when it has nulls) the Table column would be. Row selections and
+# column projections share the encoded arrays, and to_table() converts to an
+# astropy Table for what needs one (vstack, unique...). len, colnames, rows,
+# write and printing behave as for a Table.
+
+# a string column is dictionary-encoded when it has at most this many
+# distinct values and every value repeats on average
+MAX_CATEGORIES = 65536
+
+
+class _Column:
+    __slots__ = ("data", "categories", "mask")
+
+    def __init__(self, data, categories=None, mask=None):
+        self.data = data
+        self.categories = categories
+        self.mask = mask
+
+    def values(self):
+        if self.categories is not None:
+            return self.categories[self.data]
+        if self.data.dtype.kind == "S":
+            return self.data.astype(str)
+        return self.data
+
+    def decode(self):
+        values = self.values()
+        if self.mask is not None:
+            return np.ma.MaskedArray(values, mask=self.mask)
+        return values
+
+    def take(self, idx):
+        return _Column(self.data[idx], self.categories, None if self.mask is None else self.mask[idx])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.data, self.categories, self.mask) if a is not None)
+
+
+# encode one column from its values (bytes, str or numbers) and null mask
+def encode_column(values, mask=None):
+    values = np.asarray(values)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            mask = None
+
+    if values.dtype.kind == "O":
+        values = values.astype(str)
+    if values.dtype.kind not in "SU":
+        return _Column(values, mask=mask)
+
+    if len(values):
+        categories, codes = np.unique(values, return_inverse=True)
+        if len(categories) <= MAX_CATEGORIES and 2 * len(categories) <= len(values):
+            codes = codes.astype(np.uint8 if len(categories) <= 256 else np.uint16)
+            return _Column(codes, categories.astype(str), mask)
+
+    if values.dtype.kind == "S" and len(values):
+        # as narrow as the longest value
+        values = values.astype(f"S{max(1, int(np.char.str_len(values).max()))}")
+    elif values.dtype.kind == "U":
+        try:
+            values = np.char.encode(values, "ascii") if len(values) else values.astype("S1")
+        except UnicodeEncodeError:
+            pass
+    return _Column(values, mask=mask)
+
+
+class CompactTable:
+    def __init__(self, columns=None, units=None, length=None):
+        self._columns = dict(columns or {})
+        self.units = dict(units or {})
+        if length is None:
+            length = len(next(iter(self._columns.values())).data) if self._columns else 0
+        self._length = length
+
+    # {name: values}, {name: mask} and {name: unit} to a CompactTable
+    @classmethod
+    def from_columns(cls, values, masks=None, units=None):
+        masks = masks or {}
+        columns = {name: encode_column(data, masks.get(name)) for name, data in values.items()}
+        return cls(columns, units)
+
+    # a table without rows with (string) columns colnames
+    @classmethod
+    def empty(cls, colnames=()):
+        return cls({name: _Column(np.array([], dtype="S1")) for name in colnames}, length=0)
+
+    @classmethod
+    def from_table(cls, table):
+        if isinstance(table, CompactTable):
+            return table
+        values, masks, units = {}, {}, {}
+        for name in table.colnames:
+            col = table[name]
+            values[name] = np.asarray(col)
+            if getattr(col, "mask", None) is not None:
+                masks[name] = np.asarray(col.mask)
+            if getattr(col, "unit", None):
+                units[name] = str(col.unit)
+        return cls.from_columns(values, masks, units)
+
+    def to_table(self):
+        from astropy.table import Table, MaskedColumn
+        import astropy.units as u
+
+        table = Table()
+        for name, col in self._columns.items():
+            values = col.values()
+            table[name] = MaskedColumn(values, name=name, mask=col.mask) if col.mask is not None else values
+            if self.units.get(name):
+                table[name].unit = u.Unit(self.units[name], parse_strict='silent')
+        return table
+
+    # (name, data, categories or None, mask or None) of every column, as stored
+    def encoded(self):
+        return [(name, col.data, col.categories, col.mask) for name, col in self._columns.items()]
+
+    @classmethod
+    def from_encoded(cls, columns, units=None, length=None):
+        return cls({name: _Column(data, categories, mask) for name, data, categories, mask in columns}, units, length)
+
+    @property
+    def colnames(self):
+        return list(self._columns)
+
+    def __len__(self):
+        return self._length
+
+    # fn applied to the values of a string column, once per distinct value when
+    # the column is dictionary-encoded; masked rows get fill
+    def map_values(self, name, fn, fill=None):
+        col = self._columns[name]
+        if col.categories is not None:
+            result = fn(col.categories)[col.data]
+        else:
+            result = fn(col.values())
+        if col.mask is not None and fill is not None:
+            result[col.mask] = fill
+        return result
+
+    @property
+    def nbytes(self):
+        return sum(col.nbytes for col in self._columns.values())
+
+    def _rows(self, key):
+        if isinstance(key, slice):
+            return np.arange(self._length)[key]
+        idx = np.asarray(key)
+        if idx.dtype.kind == "b":
+            if len(idx) != self._length:
+                raise IndexError(f"boolean index of length {len(idx)} for a table of length {self._length}")
+            return np.flatnonzero(idx)
+        if idx.size == 0:
+            return idx.astype(np.intp)
+        if idx.dtype.kind not in "iu":
+            raise IndexError(f"invalid row index {key!r}")
+        return idx
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key].decode()
+        if isinstance(key, (int, np.integer)):
+            if not -self._length <= key < self._length:
+                raise IndexError(f"index {key} out of range for a table of length {self._length}")
+            return {name: col.decode()[key] for name, col in self._columns.items()}
+        if isinstance(key, (list, tuple)) and key and all(isinstance(k, str) for k in key):
+            missing = [k for k in key if k not in self._columns]
+            if missing:
+                raise KeyError(f"Columns not found: {missing}")
+            return CompactTable({k: self._columns[k] for k in key},
+                                {k: v for k, v in self.units.items() if k in key}, self._length)
+        idx = self._rows(key)
+        return CompactTable({name: col.take(idx) for name, col in self._columns.items()}, self.units, len(idx))
+
+    def __iter__(self):
+        columns = [(name, col.decode()) for name, col in self._columns.items()]
+        for i in range(self._length):
+            yield {name: values[i] for name, values in columns}
+
+    def write(self, *args, **kwargs):
+        self.to_table().write(*args, **kwargs)
+
+    def __str__(self):
+        return str(self.to_table())
+
+    def __repr__(self):
+        return repr(self.to_table())
+
+
+# the rows of tables one after another, as one table with the columns of the
+# first one (colnames when there are no tables); columns are decoded and
+# encoded again, so concatenate after filtering, not before
+def concatenate(tables, colnames=()):
+    tables = [CompactTable.from_table(table) for table in tables]
+    if not tables:
+        return CompactTable.empty(colnames)
+    if len(tables) == 1:
+        return tables[0]
+
+    values, masks = {}, {}
+    for name in tables[0].colnames:
+        missing = [i for i, table in enumerate(tables) if name not in table._columns]
+        if missing:
+            raise KeyError(f"Column {name} is missing from {len(missing)} of the tables")
+        columns = [table._columns[name] for table in tables]
+        values[name] = np.concatenate([col.values() for col in columns])
+        if any(col.mask is not None for col in columns):
+            masks[name] = np.concatenate([col.mask if col.mask is not None else np.zeros(len(col.data), dtype=bool)
+                                          for col in columns])
+    return CompactTable.from_columns(values, masks, tables[0].units)
@@ -0,0 +1,36 @@
+import numpy as np
+from KCWI_scripts import trace
+
+
+# SkyCoord of the frames with valid coordinates and their row indices in the table
+def frame_coords(table):
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+    ra = np.ma.filled(np.ma.asarray(table['ra'], dtype=float), np.nan)
+    dec = np.ma.filled(np.ma.asarray(table['dec'], dtype=float), np.nan)
+    valid = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+    with trace.span("coords", n=len(valid)):
+        return SkyCoord(ra=ra[valid] * u.deg, dec=dec[valid] * u.deg), valid
+
+
+# Crossmatch the whole standard-star catalog against every frame of a table in
+# one call. The KD-tree is built over star_coords and cached by astropy on that
+# SkyCoord, so passing the same catalog object for every night builds it once.
+# Returns (star_idx, frame_idx, sep_arcsec) arrays with every pair closer than
+# tolerance_arcsec, ordered by star then separation.
+def match_standard_stars(star_coords, table, tolerance_arcsec):
+    empty = (np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float))
+    if table is None or len(table) == 0:
+        return empty
+
+    coords, rows = frame_coords(table)
+    if len(coords) == 0:
+        return empty
+
+    from astropy.coordinates import search_around_sky
+    import astropy.units as u
+    with trace.span("crossmatch", frames=len(coords), stars=len(star_coords)):
+        frame_idx, star_idx, sep, _ = search_around_sky(coords, star_coords, tolerance_arcsec * u.arcsec)
+    sep = sep.arcsecond
+    order = np.lexsort((sep, star_idx))
+    return star_idx[order], rows[frame_idx[order]], sep[order]
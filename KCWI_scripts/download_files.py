@@ -1,22 +1,22 @@
 import argparse
 import os
-from pykoa.koa import Koa
-import shutil
-from astropy.table import Table
+from KCWI_scripts.metadata import load_night
+from KCWI_scripts.downloader import download_table
+from KCWI_scripts.verify_frames import verify_and_repair
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.trace import profiled
 
-def download_files_by_date(date, output_dir='.', filename_type='all'):
+def download_files_by_date(date, output_dir='.', filename_type='all', max_workers=4, verify=True):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    metadata_path = os.path.join(output_dir, f'koa_metadata_{date}.tbl')
-    Koa.query_date(instrument='kcwi', date=date, outpath=metadata_path, overwrite=True, format='ipac')
+    # metadata comes from the shared cache when this night was already queried
+    table = load_night(date, output_dir)
 
-    if not os.path.isfile(metadata_path):
+    if table is None:
         print(f"No se encontraron archivos para la fecha {date}.")
         return
 
-    table = Table.read(metadata_path, format='ascii.ipac')
-
     # filter the table according to the filename type
     if filename_type == 'telescope':
         table = table[table['ofname'] != '']
@@ -27,28 +27,13 @@ def download_files_by_date(date, output_dir='.', filename_type='all'):
     filtered_metadata_path = os.path.join(output_dir, f'koa_metadata_{date}_filtered.tbl')
     table.write(filtered_metadata_path, format='ascii.ipac', overwrite=True)
 
-    # download files according to the filtered table
-    Koa.download(
-        metapath=filtered_metadata_path,
-        format='ipac',
-        outdir=output_dir,
-        calibfile=1
-    )
-
-    # move files to output_dir
-    for root, dirs, files in os.walk(output_dir):
-        for file in files:
-            if file.endswith('.fits'):
-                source_path = os.path.join(root, file)
-                destination_path = os.path.join(output_dir, file)
-                if source_path != destination_path:
-                    shutil.move(source_path, destination_path)
+    # download files (and their calibrations) according to the filtered table,
+    # straight into output_dir
+    download_table(table, output_dir, max_workers=max_workers, calibfile=True)
 
-    # remove not desired directories
-    for folder in ["lev0","calib"]:
-        folder_path = os.path.join(output_dir, folder)
-        if os.path.exists(folder_path):
-            shutil.rmtree(folder_path)
+    # header-only check; bad files are downloaded again
+    if verify:
+        verify_and_repair(table, output_dir, download_workers=max_workers)
 
     print(f"Files downloaded to {output_dir}.")
 
@@ -59,12 +44,17 @@ def main():
     parser.add_argument('date', type=str, help="Fecha de la observación en formato 'YYYY-MM-DD'.")
     parser.add_argument('filename_type', type=str, default='all', choices=['all', 'telescope', 'archive'], help="Tipo de nombre de archivo para filtrar (por defecto, 'all').")
     parser.add_argument('--output_dir', type=str, default='.', help="Directorio de salida (por defecto, donde estás en la terminal).")
+    parser.add_argument('--max_workers', type=int, default=4, help="Number of files downloaded at the same time (default 4).")
+    parser.add_argument('--no_verify', action='store_true', help="Don't check the downloaded files (header-only check, bad files are downloaded again).")
     
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        download_files_by_date(date = args.date, output_dir = args.output_dir)
+        with profiled(args.profile):
+            download_files_by_date(date = args.date, output_dir = args.output_dir, filename_type = args.filename_type, max_workers = args.max_workers, verify = not args.no_verify)
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
@@ -1,25 +1,34 @@
 import argparse
 import os
-from pykoa.koa import Koa
+from KCWI_scripts.metadata import load_night
+from KCWI_scripts.downloader import download_table
+from KCWI_scripts.verify_frames import verify_and_repair
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.trace import profiled
 
-def download_files_by_date(date, output_dir='.'): #por defecto, en el mismo directrorio
+def download_files_by_date(date, output_dir='.', max_workers=4, verify=True): #por defecto, en el mismo directrorio
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     metadata_path = os.path.join(output_dir, f'koa_metadata_{date}.tbl')
 
-    Koa.query_date(instrument='kcwi', date=date, outpath=metadata_path, overwrite=True, format='ipac')
+    # metadata comes from the shared cache when this night was already queried
+    table = load_night(date, output_dir)
 
-    if not os.path.isfile(metadata_path):
+    if table is None:
         print(f"No files found for {date}.")
     else:
-        # science and calibration
-        Koa.download(
-            metapath = metadata_path,
-            format = 'ipac',
-            outdir = output_dir,
-            calibfile = 1  # Include calibration files
-        )
+        if not os.path.isfile(metadata_path):
+            table.write(metadata_path, format='ascii.ipac', overwrite=True)
+
+        # science and calibration, in the same lev0/ and calib/ layout as Koa.download
+        download_table(table, os.path.join(output_dir, 'lev0'), max_workers=max_workers,
+                       calibfile=True, calib_dir=os.path.join(output_dir, 'calib'))
+
+        # header-only check; bad files are downloaded again
+        if verify:
+            verify_and_repair(table, os.path.join(output_dir, 'lev0'), calib_dir=os.path.join(output_dir, 'calib'),
+                              download_workers=max_workers)
 
         print(f"files downloaded on directory: {output_dir}")
 
@@ -28,11 +37,16 @@ def main():
     parser = argparse.ArgumentParser(description="Download KCWI data from the Keck Observatory Archive (KOA) by date.")
     parser.add_argument('date', type=str, help="Fecha de la observación en formato 'YYYY-MM-DD'.")
     parser.add_argument('--output_dir', type=str, default='./outputKC/', help="Directorio de salida (por defecto, donde estás en la terminal).")
+    parser.add_argument('--max_workers', type=int, default=4, help="Number of files downloaded at the same time (default 4).")
+    parser.add_argument('--no_verify', action='store_true', help="Don't check the downloaded files (header-only check, bad files are downloaded again).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        download_files_by_date(date = args.date, output_dir = args.output_dir)
+        with profiled(args.profile):
+            download_files_by_date(date = args.date, output_dir = args.output_dir, max_workers = args.max_workers, verify = not args.no_verify)
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
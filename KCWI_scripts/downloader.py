@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from KCWI_scripts.frame_store import default_store
+from KCWI_scripts.koa_client import default_client, KoaError
+from KCWI_scripts import trace
+
+# Parallel, resumable replacement for Koa.download.
+#
+# Files are fetched by a pool of workers into '<koaid>.part' and renamed once
+# complete, so an interrupted transfer resumes with an HTTP range request.
+# Transfers go through the shared KOA client (koa_client.py), which limits
+# the request rate and the transfers in flight (apart from the metadata
+# queries) and retries transient failures with backoff. Every finished file is
+# appended to a manifest (download_manifest.jsonl in the output directory), and
+# files already present and complete are skipped.
+#
+# With a FrameStore (frame_store.py) frames are downloaded into the store once
+# and the output directories only get links to them.
+
+FITS_BLOCK = 2880
+MANIFEST_NAME = 'download_manifest.jsonl'
+
+
+class DownloadEngine:
+    def __init__(self, outdir, max_workers=4, timeout=60, calibfile=False, calib_dir=None,
+                 getkoa_url=None, caliblist_url=None, instrument='kcwi', verbose=True, store=None, client=None):
+        self.outdir = outdir
+        self.store = store
+        self.client = client or default_client()
+        self.calib_dir = calib_dir or outdir
+        self.timeout = timeout
+        self.calibfile = calibfile
+        self.instrument = instrument
+        self.verbose = verbose
+        if getkoa_url is None or caliblist_url is None:
+            # the endpoints of the client's Koa (pykoa's unless replaced, e.g. by a test double)
+            getkoa_url = getkoa_url or self.client.koa.getkoa_url
+            caliblist_url = caliblist_url or self.client.koa.caliblist_url
+        self.getkoa_url = getkoa_url
+        self.caliblist_url = caliblist_url
+
+        os.makedirs(self.outdir, exist_ok=True)
+        os.makedirs(self.calib_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(self.outdir, MANIFEST_NAME)
+        self.manifest = self._read_manifest()
+
+        self.downloaded = []
+        self.skipped = []
+        self.failed = []
+        self.bytes = 0
+
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._futures = []
+        self._queued = 0
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.wait()
+
+    def _read_manifest(self):
+        manifest = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        manifest[entry['koaid']] = entry
+                    except (ValueError, KeyError):
+                        continue
+        return manifest
+
+    def _record(self, koaid, path, size):
+        entry = {'koaid': koaid, 'path': os.path.abspath(path), 'size': size, 'time': time.time()}
+        with self._lock:
+            self.manifest[koaid] = entry
+            with open(self.manifest_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def _session(self):
+        # requests sessions are not thread-safe, keep one per worker
+        if not hasattr(self._local, 'session'):
+            import requests
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def is_complete(self, koaid, path):
+        if not os.path.isfile(path):
+            return False
+        size = os.path.getsize(path)
+        if koaid in self.manifest:
+            return self.manifest[koaid].get('size') == size
+        # not downloaded by this engine (e.g. by Koa.download): trust whole FITS blocks
+        return size > 0 and size % FITS_BLOCK == 0
+
+    def _have(self, koaid, path):
+        if self.store is None:
+            return self.is_complete(koaid, path)
+        if self.store.has(koaid):
+            return True
+        # a complete file from a download made without the store is moved into it
+        return self.is_complete(koaid, path) and self.store.adopt(koaid, path)
+
+    # queue one file; companion calibrations are queued after it when calibfile is set
+    def submit(self, koaid, filehand, calib=False):
+        koaid = str(koaid).strip()
+        with self._lock:
+            if koaid in self._seen:
+                return
+            self._seen.add(koaid)
+            self._queued += 1
+            trace.gauge("download.queue", self._queued)
+            future = self._executor.submit(self._download, koaid, str(filehand).strip(), calib)
+            self._futures.append(future)
+
+    def submit_table(self, table):
+        for row in table:
+            self.submit(row['koaid'], row['filehand'])
+
+    # block until every queued file (and its companions) is done
+    def wait(self):
+        while True:
+            with self._lock:
+                pending = [f for f in self._futures if not f.done()]
+            if not pending:
+                break
+            wait(pending)
+        self._executor.shutdown(wait=True)
+        return self.report()
+
+    def report(self):
+        return {
+            'downloaded': list(self.downloaded),
+            'skipped': list(self.skipped),
+            'failed': list(self.failed),
+            'bytes': self.bytes,
+        }
+
+    def _download(self, koaid, filehand, calib):
+        with self._lock:
+            self._queued -= 1
+            trace.gauge("download.queue", self._queued)
+        dest_dir = self.calib_dir if calib else self.outdir
+        path = os.path.join(dest_dir, koaid)
+
+        try:
+            if self._have(koaid, path):
+                with self._lock:
+                    self.skipped.append(koaid)
+            else:
+                target = path if self.store is None else self.store.path(koaid)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                size = self._fetch(self.getkoa_url + 'filehand=' + filehand, target)
+                if self.store is not None:
+                    self.store.add(koaid)
+                self._record(koaid, path, size)
+                with self._lock:
+                    self.downloaded.append(koaid)
+                    self.bytes += size
+                if self.verbose:
+                    print(f"📥 {koaid} ({size / 1e6:.1f} MB)")
+
+            if self.store is not None:
+                self.store.link(koaid, dest_dir)
+        except Exception as e:
+            with self._lock:
+                self.failed.append((koaid, str(e)))
+            print(f"❌ {koaid} download error: {e}")
+            return
+
+        if self.calibfile and not calib:
+            self._submit_companions(koaid)
+
+    # queue the calibration files KOA associates with a frame
+    def _submit_companions(self, koaid):
+        rows = self.store.companions(koaid) if self.store is not None else None
+        if rows is None:
+            url = self.caliblist_url + f'instrument={self.instrument}&koaid={koaid}'
+            try:
+                response = self._request(url)
+                rows = response.json().get('table', [])
+            except Exception as e:
+                if self.verbose:
+                    print(f"⚠️ No associated calibration list for {koaid}: {e}")
+                return
+            if self.store is not None:
+                self.store.set_companions(koaid, rows)
+
+        for row in rows:
+            self.submit(row['koaid'], row['filehand'], calib=True)
+
+    def _request(self, url):
+        response = self.client.get(self._session(), url, name=f"caliblist {url.rsplit('=', 1)[-1]}", timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    # download url into path through path.part, resuming a previous partial
+    # file; transient failures are retried by the KOA client (each retry
+    # resumes where the last stopped), an error answer from KOA is not
+    def _fetch(self, url, path):
+        return self.client.transfer(f"download {os.path.basename(path)}", self._fetch_once, url, path)
+
+    def _fetch_once(self, url, path):
+        part_path = path + '.part'
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        with trace.span("download", file=os.path.basename(path)), \
+                self._session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # the partial file is not a prefix of this file anymore
+                os.remove(part_path)
+                raise KoaError("range not satisfiable, restarting")
+            response.raise_for_status()
+
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                raise IOError(response.text[:200])
+
+            if response.status_code == 206:
+                mode = 'ab'
+            else:
+                # the server ignored the range request
+                mode, offset = 'wb', 0
+
+            length = response.headers.get('Content-Length')
+            expected = offset + int(length) if length is not None else None
+            # a dropped connection ends the body instead of raising (and losing
+            # the chunk being read), so what arrived is kept in the .part file;
+            # the size check below still fails the transfer
+            response.raw.enforce_content_length = False
+
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+                    trace.count("bytes.download", len(chunk))
+
+        size = os.path.getsize(part_path)
+        if expected is not None and size != expected:
+            raise KoaError(f"incomplete transfer ({size} of {expected} bytes)")
+
+        os.replace(part_path, path)
+        return size
+
+
+# download every frame of a metadata table (columns koaid and filehand)
+def download_table(table, outdir, max_workers=4, calibfile=True, calib_dir=None, **kwargs):
+    kwargs.setdefault('store', default_store())
+    with DownloadEngine(outdir, max_workers=max_workers, calibfile=calibfile, calib_dir=calib_dir, **kwargs) as engine:
+        engine.submit_table(table)
+    report = engine.report()
+
+    print(f"\n📥 {len(report['downloaded'])} files downloaded ({report['bytes'] / 1e6:.1f} MB), "
+          f"{len(report['skipped'])} already present, {len(report['failed'])} failed.")
+    return report
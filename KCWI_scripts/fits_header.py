@@ -0,0 +1,76 @@
+import mmap
+
+# Header-only reader for the primary HDU of a FITS file.
+#
+# The file is memory-mapped and scanned card by card (80 bytes) up to END, so
+# only the pages holding the header are read from disk, whatever the size of
+# the data that follows.
+
+CARD = 80
+FITS_BLOCK = 2880
+
+
+def parse_value(raw):
+    raw = raw.strip()
+    if raw.startswith("'"):
+        # quoted string, '' is an escaped quote
+        value, i = [], 1
+        while i < len(raw):
+            if raw[i] == "'":
+                if raw[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(raw[i])
+            i += 1
+        return "".join(value).rstrip()
+
+    raw = raw.split("/", 1)[0].strip()
+    if raw == "T":
+        return True
+    if raw == "F":
+        return False
+    for cast in (int, float):
+        try:
+            return cast(raw)
+        except ValueError:
+            pass
+    return raw or None
+
+
+# parse the header starting at offset of an mmap'ed file; returns
+# ({keyword: value}, offset of the data) (only keys are parsed when given)
+def scan_header(m, offset=0, keys=None):
+    header = {}
+    for card_offset in range(offset, len(m) - CARD + 1, CARD):
+        card = m[card_offset:card_offset + CARD]
+        key = card[:8].decode("ascii", "replace").strip()
+        if key == "END":
+            end = card_offset + CARD
+            return header, end + (-end % FITS_BLOCK)
+        if card[8:10] != b"= " or (keys is not None and key not in keys):
+            continue
+        header[key] = parse_value(card[10:].decode("ascii", "replace"))
+
+    raise ValueError("no END card in the header")
+
+
+# bytes of data following a header, without the padding to a full block
+def data_size(header):
+    naxis = header.get("NAXIS", 0)
+    if not naxis:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= header[f"NAXIS{i}"]
+    return abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + size)
+
+
+# {keyword: value} of the primary header; only keys are parsed when given
+def read_primary_header(path, keys=None):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        try:
+            return scan_header(m, 0, set(keys) if keys is not None else None)[0]
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}")
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from KCWI_scripts import trace
+
+# Local store of downloaded frames, one file per koaid.
+#
+# Frames live in <root>/<night>/<koaid> (night = 'KB.20200516' part of the
+# koaid) and index.jsonl records their size and sha256. Night and output
+# directories are built as hard links into the store (symbolic links when the
+# store is on another filesystem), so a frame needed by several nights or
+# reduction sets is downloaded and stored once.
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".local", "share", "kcwi_scripts", "frames")
+INDEX_NAME = "index.jsonl"
+LINK_MODES = ("auto", "hardlink", "symlink", "reflink", "copy")
+
+# ioctl that shares the data blocks of a file (btrfs, xfs, ...) on Linux
+_FICLONE = 0x40049409
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# raises OSError when the filesystem or the platform (no fcntl on Windows)
+# can't share the blocks
+def reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+# make dst a view of src without copying data when possible: hardlink, symlink,
+# reflink or copy ('auto' tries a hardlink, then a reflink, then copies).
+# Returns the mode actually used.
+def link_file(src, dst, mode="auto"):
+    with trace.span("link", mode=mode):
+        return _link_file(src, dst, mode)
+
+
+def _link_file(src, dst, mode):
+    if mode not in LINK_MODES:
+        raise ValueError(f"unknown link mode {mode!r}, use one of {', '.join(LINK_MODES)}")
+
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return mode
+        os.remove(dst)
+
+    if mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return mode
+
+    attempts = {"auto": (os.link, reflink), "hardlink": (os.link,), "reflink": (reflink,)}.get(mode, ())
+    for attempt in attempts:
+        try:
+            attempt(src, dst)
+            return "hardlink" if attempt is os.link else "reflink"
+        except OSError:
+            continue
+
+    shutil.copy(src, dst)
+    return "copy"
+
+
+class FrameStore:
+    def __init__(self, root=None):
+        self.root = root or os.environ.get("KCWI_STORE_DIR", DEFAULT_STORE_DIR)
+        self.index_path = os.path.join(self.root, INDEX_NAME)
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        index[entry["koaid"]] = entry
+                    except (ValueError, KeyError):
+                        continue
+        return index
+
+    def path(self, koaid):
+        night = ".".join(koaid.split(".")[:2])
+        return os.path.join(self.root, night, koaid)
+
+    def has(self, koaid):
+        entry = self.index.get(koaid)
+        path = self.path(koaid)
+        return entry is not None and os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+
+    def _append(self, entry):
+        with self._lock:
+            self.index[entry["koaid"]] = entry
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    # record a frame that was written to self.path(koaid)
+    def add(self, koaid):
+        path = self.path(koaid)
+        entry = {"koaid": koaid, "size": os.path.getsize(path), "sha256": sha256sum(path), "time": time.time()}
+        self._append(entry)
+        return entry
+
+    # calibration files KOA associates with a stored frame ([{koaid, filehand}]),
+    # None if they were never looked up
+    def companions(self, koaid):
+        return self.index.get(koaid, {}).get("companions")
+
+    def set_companions(self, koaid, rows):
+        if koaid in self.index:
+            entry = dict(self.index[koaid])
+            entry["companions"] = [{"koaid": r["koaid"], "filehand": r["filehand"]} for r in rows]
+            self._append(entry)
+
+    # take an existing file into the store without copying it (False if it is
+    # on another filesystem)
+    def adopt(self, koaid, src):
+        path = self.path(koaid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(src, path)
+        except OSError:
+            return False
+        self.add(koaid)
+        return True
+
+    # drop a stored frame (e.g. found corrupted) so it is downloaded again
+    def discard(self, koaid):
+        path = self.path(koaid)
+        if os.path.lexists(path):
+            os.remove(path)
+
+    def verify(self, koaid):
+        return self.has(koaid) and sha256sum(self.path(koaid)) == self.index[koaid]["sha256"]
+
+    # make dest_dir/name point to the stored frame; returns the link path
+    def link(self, koaid, dest_dir, name=None):
+        src = self.path(koaid)
+        dest = os.path.join(dest_dir, name or koaid)
+        os.makedirs(dest_dir, exist_ok=True)
+
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return dest
+
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.link"
+        with trace.span("link", mode="store"):
+            try:
+                os.link(src, tmp)
+            except OSError:
+                # different filesystem or no hard link support
+                os.symlink(os.path.abspath(src), tmp)
+            os.replace(tmp, dest)
+        return dest
+
+    # link every stored frame of koaids into dest_dir, returns the koaids not in the store
+    def assemble(self, koaids, dest_dir):
+        missing = []
+        for koaid in koaids:
+            if self.has(koaid):
+                self.link(koaid, dest_dir)
+            else:
+                missing.append(koaid)
+        return missing
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+# process-wide store at KCWI_STORE_DIR, None when KCWI_NO_STORE is set
+def default_store():
+    global _default_store
+    if os.environ.get("KCWI_NO_STORE", "") != "":
+        return None
+    with _default_lock:
+        if _default_store is None:
+            _default_store = FrameStore()
+    return _default_store
@@ -0,0 +1,152 @@
+import numpy as np
+
+# Per-night inventory of frames grouped by image type and instrument
+# configuration, built from column arrays instead of a row loop.
+#
+# A configuration is a tuple of (key, value) pairs for the keys below that are
+# present in the metadata. Each key has columns for every frame (the first one
+# present is used) and columns for the frames of one camera: a red frame takes
+# its grating and central wavelength from rgratnam and rcwave even when the
+# table also has the blue columns.
+CONFIG_COLUMNS = {
+    'camera': (('camera',), {}),
+    'grating': (('gratname', 'grating'), {'BLUE': 'bgratnam', 'RED': 'rgratnam'}),
+    'slicer': (('ifunam', 'slicer'), {}),
+    'binning': (('binning',), {}),
+    'cwave': (('cwave',), {'BLUE': 'bcwave', 'RED': 'rcwave'}),
+}
+
+# configuration keys a calibration has to share with the science frames
+# (types not listed have to match every key)
+CALIBRATION_KEYS = {
+    'BIAS': ('camera', 'binning'),
+    'DARK': ('camera', 'binning'),
+    'OBJECT': (),
+}
+
+
+def _normalize(values):
+    return np.char.upper(np.char.strip(np.asarray(values).astype(str)))
+
+
+# normalized values of a string column; on a CompactTable only the distinct
+# values of encoded columns are normalized
+def _string_column(table, name):
+    if hasattr(table, 'map_values'):
+        return table.map_values(name, _normalize, fill='')
+    col = table[name]
+    values = _normalize(col)
+    if getattr(col, 'mask', None) is not None:
+        values[np.asarray(col.mask)] = ''
+    return values
+
+
+# normalized values of a configuration key for every frame, None when the table
+# has none of its columns; camera holds the normalized camera of every frame
+def _config_column(table, columns, camera_columns, camera):
+    columns = [c for c in columns if c in table.colnames]
+    camera_columns = {cam: c for cam, c in camera_columns.items() if c in table.colnames}
+    if not columns and not camera_columns:
+        return None
+
+    # frames of a camera without a column of its own (or without a camera)
+    # fall back to the first column found
+    values = _string_column(table, columns[0] if columns else next(iter(camera_columns.values())))
+    if camera is not None:
+        for cam, column in camera_columns.items():
+            rows = camera == cam
+            if rows.any():
+                values = np.where(rows, _string_column(table, column), values)
+    return values
+
+
+# keep only the keys a calibration type has to match on
+def project(config, cal):
+    keys = CALIBRATION_KEYS.get(cal)
+    if keys is None:
+        return config
+    return tuple((k, v) for k, v in config if k in keys)
+
+
+class NightInventory:
+    def __init__(self, table):
+        self.groups = {}  # {imtyp: {config: [koaid, ...]}}
+        self.keys = []
+
+        if table is None or len(table) == 0:
+            return
+
+        camera = _string_column(table, 'camera') if 'camera' in table.colnames else None
+        columns = []
+        for key, (candidates, camera_columns) in CONFIG_COLUMNS.items():
+            values = _config_column(table, candidates, camera_columns, camera)
+            if values is not None:
+                self.keys.append(key)
+                columns.append(values)
+
+        imtyp = _string_column(table, 'koaimtyp')
+        koaid = np.asarray(table['koaid']).astype(str)
+
+        # one string key per frame, grouped with a single sort
+        combined = imtyp
+        for values in columns:
+            combined = np.char.add(np.char.add(combined, '\x1f'), values)
+
+        unique, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+
+        for idx, members in zip(first, np.split(order, bounds)):
+            config = tuple((key, str(values[idx])) for key, values in zip(self.keys, columns))
+            self.groups.setdefault(str(imtyp[idx]), {})[config] = koaid[members].tolist()
+
+    def types(self):
+        return list(self.groups)
+
+    def configs(self, imtyp):
+        return list(self.groups.get(imtyp, {}))
+
+    # koaids of a type whose configuration matches config on the keys relevant for it
+    def koaids(self, imtyp, config=None):
+        found = []
+        for group_config, koaids in self.groups.get(imtyp, {}).items():
+            if config is None or project(group_config, imtyp) == project(config, imtyp):
+                found.extend(koaids)
+        return found
+
+    def count(self, imtyp, config=None):
+        if config is None:
+            return sum(len(k) for k in self.groups.get(imtyp, {}).values())
+        return len(self.koaids(imtyp, config))
+
+
+def config_label(config):
+    if not config:
+        return ''
+    return ' (' + ', '.join(v for _, v in config if v) + ')'
+
+
+# {(cal, configuration): frames needed} for every configuration used for
+# science in the night (any configuration if there are no science frames)
+def calibration_quotas(inventory, required_calibrations):
+    science_configs = inventory.configs('OBJECT') or [None]
+    quotas = {}
+    for cal, n in required_calibrations.items():
+        for config in science_configs:
+            quotas[(cal, config and project(config, cal))] = n
+    return quotas
+
+
+# take as many matching frames of each open quota as are still needed, updating
+# missing in place; returns {(cal, configuration): [koaid, ...]} taken
+def take_calibrations(missing, inventory):
+    taken = {}
+    for (cal, config), n in missing.items():
+        if n <= 0:
+            continue
+
+        koaids = inventory.koaids(cal, config)[:n]
+        if koaids:
+            taken[(cal, config)] = koaids
+            missing[(cal, config)] -= len(koaids)
+    return taken
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from KCWI_scripts import trace
+
+# Fast reader for the fixed-width IPAC tables returned by KOA.
+#
+# The data block is loaded into a 2D byte array and every column is cut out as
+# a slice of it, so tokenizing and type conversion run in numpy's C loops
+# instead of astropy's per-line Python reader. Only the requested columns are
+# converted. Column positions follow astropy's default ("ignore") IPAC
+# definition: a column is the characters between its two '|', and whatever is
+# under a '|' belongs to no column.
+# With compact=True the columns go from the byte slices straight into a
+# CompactTable (compact_table.py), without a unicode copy of the strings.
+
+_INT_TYPES = ('int', 'i', 'long', 'l')
+_FLOAT_TYPES = ('double', 'd', 'float', 'f', 'real', 'r')
+
+
+# split the raw file into the header ('|' lines) and the offset of the data block
+def _parse_header(raw):
+    header = []
+    pos = 0
+    while pos < len(raw):
+        end = raw.find(b'\n', pos)
+        if end == -1:
+            end = len(raw)
+        line = raw[pos:end]
+
+        if line.startswith(b'|'):
+            header.append(line.rstrip())
+        elif header:
+            # first data line
+            break
+        elif line.strip() and not line.startswith(b'\\'):
+            raise ValueError("IPAC table data found before the header")
+        pos = end + 1
+
+    if not header:
+        raise ValueError("At least one header line beginning and ending with '|' is required")
+
+    return header, pos
+
+
+def _header_fields(line, pipes):
+    return [line[a + 1:b].decode().strip() for a, b in zip(pipes[:-1], pipes[1:])]
+
+
+# 2D uint8 array (rows x characters) with the data block
+def _data_chars(block):
+    if not block.strip():
+        return np.zeros((0, 0), dtype=np.uint8)
+
+    if not block.endswith(b'\n'):
+        block += b'\n'
+
+    # fast path: KOA writes fixed-length lines, so the block reshapes directly
+    width = block.find(b'\n') + 1
+    if len(block) % width == 0:
+        chars = np.frombuffer(block, dtype=np.uint8).reshape(-1, width)
+        if np.all(chars[:, -1] == ord('\n')):
+            return chars[:, :-1]
+
+    lines = [line for line in block.split(b'\n') if line.strip()]
+    width = max(len(line) for line in lines)
+    return np.array(lines, dtype=f'S{width}').view(np.uint8).reshape(len(lines), width)
+
+
+def _column_strings(chars, start, end):
+    end = min(end, chars.shape[1])
+    if end <= start:
+        return np.full(len(chars), b'', dtype='S1')
+
+    field = np.ascontiguousarray(chars[:, start:end])
+    return np.char.strip(field.view(f'S{end - start}').ravel())
+
+
+# read an IPAC table, materializing only the given columns (all by default)
+def read_ipac(path, columns=None, compact=False):
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    if b'\r' in raw:
+        raw = raw.replace(b'\r\n', b'\n')
+
+    header, data_start = _parse_header(raw)
+    pipes = [i for i, c in enumerate(header[0]) if c == ord('|')]
+
+    names = _header_fields(header[0], pipes)
+    types = _header_fields(header[1], pipes) if len(header) > 1 else ['char'] * len(names)
+    units = _header_fields(header[2], pipes) if len(header) > 2 else [''] * len(names)
+    nulls = _header_fields(header[3], pipes) if len(header) > 3 else ['null'] * len(names)
+
+    if columns is None:
+        columns = names
+    missing = [c for c in columns if c not in names]
+    if missing:
+        raise KeyError(f"Columns not found in {path}: {missing}")
+
+    chars = _data_chars(raw[data_start:])
+
+    values_by_name, masks, units_by_name = {}, {}, {}
+    for name in columns:
+        i = names.index(name)
+        start = pipes[i] + 1
+        values = _column_strings(chars, start, pipes[i + 1])
+
+        mask = (values == nulls[i].encode()) | (values == b'')
+        col_type = types[i].lower()
+
+        if col_type in _INT_TYPES or col_type in _FLOAT_TYPES:
+            values = values.copy()
+            values[mask] = b'0'
+            values = values.astype(np.int64 if col_type in _INT_TYPES else np.float64)
+        elif not compact or (values.size and values.view(np.uint8).max() >= 128):
+            # non-ASCII text fails here as it does for the Table
+            values = values.astype(str)
+
+        values_by_name[name] = values
+        masks[name] = mask
+        if units[i]:
+            units_by_name[name] = units[i]
+
+    if compact:
+        from KCWI_scripts.compact_table import CompactTable
+        return CompactTable.from_columns(values_by_name, masks, units_by_name)
+
+    from astropy.table import Table, MaskedColumn
+    import astropy.units as u
+
+    table = Table()
+    for name, values in values_by_name.items():
+        if masks[name].any():
+            table[name] = MaskedColumn(values, name=name, mask=masks[name])
+        else:
+            table[name] = values
+        if name in units_by_name:
+            table[name].unit = u.Unit(units_by_name[name], parse_strict='silent')
+    return table
+
+
+# read a KOA metadata table with the fast reader, falling back to astropy's
+# reader for files it does not understand
+def read_metadata(path, columns=None, compact=False):
+    with trace.span("parse", file=os.path.basename(path)):
+        try:
+            return read_ipac(path, columns, compact)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            from astropy.table import Table
+            table = Table.read(path, format='ascii.ipac')
+            table = table[columns] if columns is not None else table
+            if compact:
+                from KCWI_scripts.compact_table import CompactTable
+                return CompactTable.from_table(table)
+            return table
+
+
+# read_metadata into a CompactTable (what the metadata cache and the lookups use)
+def read_compact(path, columns=None):
+    return read_metadata(path, columns, compact=True)
@@ -0,0 +1,261 @@
+import os
+import sys
+import io
+import time
+import random
+import threading
+from KCWI_scripts import trace
+
+# Shared client for every call to KOA (metadata queries and file transfers).
+#
+# Calls go through a token bucket (KCWI_KOA_RATE requests per second) and an
+# AIMD concurrency limit: the number of calls in flight grows by one for every
+# window of successful calls, up to KCWI_KOA_MAX_CONCURRENCY, and is halved
+# when KOA fails or throttles. Queries and file transfers have limits of their
+# own, so metadata queries don't wait behind long downloads. Calls failing with
+# a transient error (KOA errors, 429 and 5xx answers, timeouts, dropped
+# connections) are retried KCWI_KOA_RETRIES times with jittered exponential
+# backoff; other errors (404, bad arguments, local I/O) are not. Calls that
+# still fail are kept for the end-of-run failure report, so a night that could
+# not be queried is never taken for a night without frames.
+
+DEFAULT_RATE = 5.0
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+
+
+# KOA failed to answer (errors printed by pykoa, incomplete transfers); retried
+class KoaError(Exception):
+    pass
+
+
+# errors that can go away when the call is repeated
+def is_transient(error):
+    if isinstance(error, (KoaError, TimeoutError, ConnectionError)):
+        return True
+    # requests is only imported by the calls that use it
+    requests = sys.modules.get('requests')
+    if requests is None:
+        return False
+    if isinstance(error, requests.HTTPError):
+        status = getattr(error.response, 'status_code', None)
+        return status is not None and (status == 429 or status >= 500)
+    return isinstance(error, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    def __init__(self, initial=2, minimum=1, maximum=DEFAULT_MAX_CONCURRENCY, cooldown=1.0):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok):
+        with self._cond:
+            self.in_flight -= 1
+            if ok:
+                # additive increase: +1 per limit successful calls
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif time.monotonic() - self._last_decrease > self.cooldown:
+                # multiplicative decrease, once for a burst of failures
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = time.monotonic()
+            self._cond.notify_all()
+
+
+# sys.stdout wrapper that sends the output of capturing threads to their own
+# buffer (pykoa reports errors by printing them instead of raising, and the
+# service returns what an operation printed)
+class _ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_output_lock = threading.Lock()
+
+
+# run fn and return (result, what it printed in this thread); captures nest
+def capture_output(fn, *args, **kwargs):
+    with _output_lock:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        output = sys.stdout
+    previous = getattr(output.local, 'buffer', None)
+    output.local.buffer = io.StringIO()
+    try:
+        result = fn(*args, **kwargs)
+        return result, output.local.buffer.getvalue()
+    finally:
+        output.local.buffer = previous
+
+
+class KoaClient:
+    def __init__(self, rate=None, max_concurrency=None, retries=None, backoff=None, koa=None, verbose=True):
+        rate = float(rate if rate is not None else os.environ.get('KCWI_KOA_RATE', DEFAULT_RATE))
+        max_concurrency = int(max_concurrency if max_concurrency is not None
+                              else os.environ.get('KCWI_KOA_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY))
+        self.retries = int(retries if retries is not None else os.environ.get('KCWI_KOA_RETRIES', DEFAULT_RETRIES))
+        self.backoff = float(backoff if backoff is not None else DEFAULT_BACKOFF)
+        self._koa = koa
+        self.verbose = verbose
+
+        self.bucket = TokenBucket(rate)
+        self.limit = AdaptiveLimit(initial=min(2, max_concurrency), maximum=max_concurrency)
+        self.transfer_limit = AdaptiveLimit(initial=min(2, max_concurrency), maximum=max_concurrency)
+
+        self.calls = 0
+        self.retried = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    # pykoa is imported on the first query, not with this module
+    @property
+    def koa(self):
+        if self._koa is None:
+            from pykoa.koa import Koa
+            self._koa = Koa
+        return self._koa
+
+    def _sleep(self, attempt):
+        # full jitter
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    # run fn(*args, **kwargs) under the rate and query concurrency limits,
+    # retrying transient errors; the last error is raised once the retries are
+    # used up, and any other error at once
+    def call(self, name, fn, *args, **kwargs):
+        return self._call(self.limit, name, fn, args, kwargs)
+
+    # as call, for file transfers, under their own concurrency limit
+    def transfer(self, name, fn, *args, **kwargs):
+        return self._call(self.transfer_limit, name, fn, args, kwargs)
+
+    def _call(self, limit, name, fn, args, kwargs):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            limit.acquire()
+            ok, transient = False, True
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            except Exception as e:
+                transient = is_transient(e)
+                if attempt == self.retries or not transient:
+                    with self._lock:
+                        self.failures.append({'call': name, 'error': str(e), 'attempts': attempt + 1})
+                    raise
+                with self._lock:
+                    self.retried += 1
+                if self.verbose:
+                    print(f"⚠️ {name}: {e}, retrying...")
+            finally:
+                # only KOA failing or throttling says to slow down
+                limit.release(ok or not transient)
+                with self._lock:
+                    self.calls += 1
+            self._sleep(attempt)
+
+    # pykoa query into outpath; errors printed by pykoa are raised as KoaError.
+    # No file and no error means KOA has nothing for the query.
+    def _query(self, method, outpath, **kwargs):
+        label = {'night': kwargs['date']} if 'date' in kwargs else {'pos': kwargs.get('pos')}
+
+        def run():
+            with trace.span(f"koa.{method}", **label):
+                _, output = capture_output(getattr(self.koa, method), instrument='kcwi', outpath=outpath, overwrite=True, **kwargs)
+                errors = [line.strip() for line in output.splitlines() if 'error' in line.lower() or 'failed' in line.lower()]
+                if errors and not os.path.isfile(outpath):
+                    raise KoaError(' '.join(errors)[:300])
+            if os.path.isfile(outpath):
+                trace.count("bytes.metadata", os.path.getsize(outpath))
+        return run
+
+    def query_date(self, date, outpath):
+        self.call(f"query_date {date}", self._query('query_date', outpath, date=date))
+
+    def query_position(self, pos, outpath):
+        self.call(f"query_position {pos}", self._query('query_position', outpath, pos=pos))
+
+    # HTTP GET through the limits; 429 and 5xx answers are retried
+    def get(self, session, url, name=None, **kwargs):
+        import requests
+
+        def run():
+            with trace.span("koa.get", call=name):
+                response = session.get(url, **kwargs)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.close()
+                raise requests.HTTPError(f"{response.status_code} from KOA", response=response)
+            return response
+        return self.call(name or url, run)
+
+    def report(self):
+        with self._lock:
+            return {'calls': self.calls, 'retried': self.retried, 'failures': list(self.failures)}
+
+    # print the failures (from the since-th one on, for a part of a long run)
+    def print_report(self, since=0):
+        report = self.report()
+        failures = report['failures'][since:]
+        if failures:
+            print(f"\n⚠️ {len(failures)} KOA requests failed after {self.retries} retries "
+                  f"(results for them are incomplete, run again to complete them):")
+            for failure in failures:
+                print(f"   ❌ {failure['call']}: {failure['error']}")
+        return report
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+# process-wide client configured from the KCWI_KOA_* environment variables
+def default_client():
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = KoaClient()
+    return _default_client
@@ -0,0 +1,132 @@
+import os
+import hashlib
+import threading
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import Future
+from KCWI_scripts.cache import default_cache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# Coordination of concurrent metadata fetches.
+#
+# single_flight() makes threads asking for the same thing share one call,
+# file_lock() serializes processes (and threads) writing the same file, and
+# atomic_output() lets a file appear at its final path only once complete.
+# Lock files live in <cache_dir>/locks, not next to the data. File locks use
+# flock, msvcrt.locking on Windows, and only serialize threads of this process
+# where neither exists.
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+# run fn() once for concurrent callers with the same key; the others wait and
+# get the same result (or exception)
+def single_flight(key, fn):
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[key] = future
+
+    if not owner:
+        return future.result()
+
+    try:
+        result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def _lock_path(path):
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(default_cache().cache_dir, "locks", f"{digest}.lock")
+
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    elif msvcrt is not None:
+        # the first byte stands for the whole file
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                continue
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# exclusive lock on path, held until the block ends
+@contextmanager
+def file_lock(path):
+    lock_path = _lock_path(path)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    if fcntl is None and msvcrt is None:
+        with _thread_locks_lock:
+            lock = _thread_locks.setdefault(lock_path, threading.Lock())
+        with lock:
+            yield
+        return
+
+    with open(lock_path, "a+") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+
+# locks on several paths, always taken in the same order
+@contextmanager
+def file_locks(paths):
+    with ExitStack() as stack:
+        for path in sorted(set(os.path.abspath(p) for p in paths)):
+            stack.enter_context(file_lock(path))
+        yield
+
+
+# yields a temporary path to write to; it replaces path when the block ends
+# without error (if it was written at all)
+@contextmanager
+def atomic_output(path):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        if os.path.isfile(tmp_path):
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_table(table, path):
+    with atomic_output(path) as tmp_path:
+        table.write(tmp_path, format="ascii.ipac", overwrite=True)
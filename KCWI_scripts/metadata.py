@@ -0,0 +1,218 @@
+import os
+import time
+import numpy as np
+from KCWI_scripts.cache import default_cache
+from KCWI_scripts.ipac_reader import read_compact
+from KCWI_scripts.sky_index import default_sky_index, fetch_radius
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts import trace
+from KCWI_scripts.locking import single_flight, file_lock, file_locks, atomic_output, write_table
+
+
+def night_metadata_path(outpath, date):
+    return os.path.join(outpath, f'koa_metadata_{date}.tbl')
+
+
+def night_cache_key(date):
+    return ('query_date', 'kcwi', date)
+
+
+# dates at +-1, +-2, ... +-days_to_check around the given date, nearest first
+def window_dates(date, days_to_check):
+    import pandas as pd
+    return [
+        (pd.to_datetime(date) + pd.Timedelta(days=delta)).strftime('%Y-%m-%d')
+        for offset in range(1, days_to_check + 1)
+        for delta in [-offset, offset]
+    ]
+
+
+# a metadata file from an earlier query can be read instead of asking KOA again
+# while it is younger than ttl (None: forever, for nights that don't change)
+def is_fresh(path, ttl):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return False
+    return ttl is None or time.time() - mtime < ttl
+
+
+# query KOA into path, replacing what an earlier query left there
+def _query(path, query, *args):
+    with atomic_output(path) as tmp_path:
+        query(*args, tmp_path)
+        if not os.path.isfile(tmp_path) and os.path.isfile(path):
+            # KOA has nothing for it now
+            os.remove(path)
+
+
+# query KOA for a single night (if not already cached or fresh on disk) and read the
+# table (a CompactTable, as from every loader here). Concurrent calls for the same night share one query, in this process
+# (single_flight) and across processes (a lock on the metadata file). parse
+# reads a metadata file (pipeline.py passes one that can use a process pool).
+def load_night(date, outpath, parse=read_compact):
+    cache = default_cache()
+    table = cache.get(night_cache_key(date))
+    if table is not None:
+        return table
+
+    metadata_path = night_metadata_path(outpath, date)
+    with trace.span("night", night=date):
+        return single_flight(('night', os.path.abspath(metadata_path)), lambda: _load_night(date, metadata_path, parse))
+
+
+def _load_night(date, metadata_path, parse):
+    cache = default_cache()
+
+    with file_lock(metadata_path):
+        # another thread or process may have fetched it while we waited
+        table = cache.get(night_cache_key(date))
+        if table is not None:
+            return table
+
+        if not is_fresh(metadata_path, cache.night_ttl(date)):
+            try:
+                _query(metadata_path, default_client().query_date, date)
+            except Exception as e:
+                print(f"❌ Error querying metadata for {date}: {e}")
+                return None
+
+        if not os.path.isfile(metadata_path):
+            print(f"⚠️ No metadata found for {date}.")
+            return None
+
+        table = parse(metadata_path)
+        cache.put(night_cache_key(date), table, ttl=cache.night_ttl(date))
+    return table
+
+
+# cone search around (ra, dec) with radius in arcsec. Cones inside one already
+# fetched are answered by the local sky index; otherwise a slightly larger cone
+# (see sky_index.fetch_radius) is asked to KOA and added to the index.
+def load_position(ra, dec, radius, outpath, parse=read_compact):
+    index = default_sky_index()
+    if index is not None and index.covers(ra, dec, radius):
+        return index.search(ra, dec, radius)
+
+    fetched = fetch_radius(radius) if index is not None else radius
+    metadata_path = os.path.join(outpath, f'position_search_{ra}_{dec}_{fetched}.tbl')
+    with trace.span("position", ra=ra, dec=dec, radius=fetched):
+        table = single_flight(('position', os.path.abspath(metadata_path)),
+                              lambda: _load_position(ra, dec, fetched, metadata_path, index, parse))
+
+    if table is None or index is None:
+        return table
+    return index.search(ra, dec, radius)
+
+
+def _load_position(ra, dec, fetched, metadata_path, index, parse):
+    pos = f'circle {ra} {dec} {fetched / 3600}'  # Convert radius to degrees
+
+    with file_lock(metadata_path):
+        # a cone search can always find new frames
+        if not is_fresh(metadata_path, default_cache().ttl):
+            try:
+                _query(metadata_path, default_client().query_position, pos)
+            except Exception as e:
+                print(f"❌ Error querying metadata for position {pos}: {e}")
+                return None
+
+        if not os.path.isfile(metadata_path):
+            print(f"⚠️ No metadata found for position {pos}.")
+            return None
+
+        table = parse(metadata_path)
+        if index is not None:
+            # covered as of when KOA was asked
+            index.add(ra, dec, fetched, table, fetched_at=os.path.getmtime(metadata_path))
+    return table
+
+
+# split a multi-night table into {date: table} using the date_obs column
+def split_by_night(table, dates):
+    if len(table) == 0:
+        return {d: table[:0] for d in dates}
+
+    night = np.array([str(v)[:10] for v in table['date_obs']])
+    return {d: table[night == d] for d in dates}
+
+
+# group sorted dates into runs of nights at most max_gap days apart
+def contiguous_runs(dates, max_gap=1):
+    import pandas as pd
+    runs = []
+    for d in sorted(dates):
+        if runs and pd.to_datetime(d) - pd.to_datetime(runs[-1][-1]) <= pd.Timedelta(days=max_gap):
+            runs[-1].append(d)
+        else:
+            runs.append([d])
+    return runs
+
+
+# query KOA once for the span of the given nights and write one table per
+# night. The night files stay locked during the query, so load_night calls for
+# the same nights from other threads or processes wait for it instead of
+# querying again. With refresh, nights already cached are queried again too.
+def fetch_range(nights, outpath, refresh=False, parse=read_compact):
+    start, end = nights[0], nights[-1]
+    range_path = os.path.join(outpath, f'koa_metadata_{start}_{end}.tbl')
+    with trace.span("range", night=f'{start}/{end}'):
+        return single_flight(('range', os.path.abspath(range_path), refresh),
+                             lambda: _fetch_range(nights, outpath, range_path, refresh, parse))
+
+
+def _fetch_range(nights, outpath, range_path, refresh, parse):
+    start, end = nights[0], nights[-1]
+    cache = default_cache()
+
+    with file_locks([night_metadata_path(outpath, night) for night in nights]):
+        # an overlapping fetch may have got these nights while we waited
+        cached = {night: cache.get(night_cache_key(night)) for night in nights}
+        if not refresh and all(table is not None for table in cached.values()):
+            return cached
+
+        with atomic_output(range_path) as tmp_path:
+            default_client().query_date(f'{start}/{end}', tmp_path)
+
+        if not os.path.isfile(range_path):
+            print(f"⚠️ No metadata found between {start} and {end}.")
+            return {night: None for night in nights}
+
+        range_table = parse(range_path)
+        os.remove(range_path)
+
+        tables = split_by_night(range_table, nights)
+        for night, night_table in tables.items():
+            write_table(night_table, night_metadata_path(outpath, night))
+            cache.put(night_cache_key(night), night_table, ttl=cache.night_ttl(night))
+
+    return tables
+
+
+# fetch metadata for all the given nights with one KOA range query per run of
+# uncached nights (bridging gaps of cached nights up to max_gap days, e.g. the
+# science night), falling back to per-night queries for nights the range
+# queries did not cover
+def fetch_window(dates, outpath, max_gap=2, parse=read_compact):
+    cache = default_cache()
+    tables = {}
+    for night in set(dates):
+        table = cache.get(night_cache_key(night))
+        if table is not None:
+            tables[night] = table
+
+    missing = [d for d in set(dates) if d not in tables and not is_fresh(night_metadata_path(outpath, d), cache.night_ttl(d))]
+
+    for nights in contiguous_runs(missing, max_gap=max_gap):
+        if len(nights) == 1:
+            continue
+        try:
+            tables.update(fetch_range(nights, outpath, parse=parse))
+        except Exception as e:
+            print(f"❌ Error querying metadata for {nights[0]}/{nights[-1]}, falling back to per-night queries: {e}")
+
+    for night in dates:
+        if night not in tables:
+            tables[night] = load_night(night, outpath, parse)
+
+    return tables
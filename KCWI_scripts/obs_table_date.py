@@ -1,35 +1,21 @@
 import argparse
 import os
-from astropy.table import Table
-from pykoa.koa import Koa
+from KCWI_scripts.query import Query, query_nights, night_range, RELEVANT_COLUMNS
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.service import call_or_run
+from KCWI_scripts.trace import profiled
 
-def obs_table_date(date, output_dir='.', data_type='both'):
+# frames of a night (or of the nights from date to end) as a CompactTable with
+# the given columns, filtered by data type and the predicates of query.Query
+# (imtype, camera, target, ra_range, dec_range); empty when there are none
+def obs_table_date(date, output_dir='.', data_type='both', end=None, columns=RELEVANT_COLUMNS, **predicates):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-        
-    outpath = os.path.join(output_dir, f'koa_metadata_{date}.tbl')
-    
-    if not os.path.isfile(outpath):
-        try:
-            Koa.query_date(instrument='kcwi', date=date, outpath=outpath, overwrite=True)
-        except Exception as e:
-            print(f"❌ Error querying metadata for {date}: {e}")
-            return None, None, None
 
-     # Query by date
-    table = Table.read(outpath, format='ascii.ipac')
-    
-    # filter by data type
-    if data_type.lower() == 'science':
-        table = table[[val == 'object' for val in table['koaimtyp']]]
-    elif data_type.lower() == 'calibration':
-        table = table[[val != 'object' for val in table['koaimtyp']]]
-    
-    # Relevant columns
-    relevant_columns = ['koaid', 'ofname', 'targname', 'koaimtyp', 'ra', 'dec', 'date_obs', 'camera']
-    table = table[relevant_columns]
-    
-    return table
+    # Query by date (through the shared metadata cache, reading only the needed columns)
+    query = Query(columns, data_type=data_type, **predicates)
+    dates = night_range(date, end) if end else [date]
+    return query_nights(dates, output_dir, query)
 
 
 def main():
@@ -37,13 +23,32 @@ def main():
     parser.add_argument('date', type=str, help="Fecha de la observación en formato 'YYYY-MM-DD'.")
     parser.add_argument('--data_type', type=str, default='both', choices=['both', 'science', 'calibration'],
                         help="Tipo de datos: 'both', 'science' o 'calibration' (por defecto 'both').")
+    parser.add_argument('--end', type=str, default=None, help="Last night 'YYYY-MM-DD', to query every night from date to end.")
+    parser.add_argument('--imtype', type=str, default=None, help="Comma-separated image types to keep (e.g. 'bias,arclamp').")
+    parser.add_argument('--camera', type=str, default=None, help="Comma-separated cameras to keep (e.g. 'blue').")
+    parser.add_argument('--target', type=str, default=None, help="Comma-separated target names to keep, with wildcards (e.g. 'NGC*').")
+    parser.add_argument('--ra_range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'), help="Keep frames with RA in this range, in degrees (MIN > MAX wraps through 0).")
+    parser.add_argument('--dec_range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'), help="Keep frames with DEC in this range, in degrees.")
+    parser.add_argument('--columns', type=str, default=','.join(RELEVANT_COLUMNS), help="Comma-separated columns to show (by default the relevant ones).")
     parser.add_argument('--outpath', type=str, default='.', help="Directorio de salida (por defecto './outputKC/').")
+    parser.add_argument('--pipeline', action='store_true', help="Run the lookup with the asyncio pipeline (KOA queries on an event loop, large tables parsed in a process pool).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        table = obs_table_date(date = args.date, data_type = args.data_type, output_dir = args.outpath)
-        print(table)
+        with profiled(args.profile):
+            arguments = dict(date = args.date, data_type = args.data_type, output_dir = args.outpath, end = args.end,
+                             columns = args.columns, imtype = args.imtype, camera = args.camera, target = args.target,
+                             ra_range = args.ra_range, dec_range = args.dec_range)
+            if args.pipeline:
+                from KCWI_scripts import pipeline
+                table = pipeline.run(pipeline.obs_table_date, **arguments)
+            else:
+                # answered by kcwi_service when one is running
+                table = call_or_run('obs_table_date', obs_table_date, **arguments)
+            print(table if len(table) else "⚠️ No observations found.")
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
@@ -1,34 +1,19 @@
 import argparse
-from astropy.table import Table
-from pykoa.koa import Koa
+from KCWI_scripts.query import Query, query_position, RELEVANT_COLUMNS
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.service import call_or_run
+from KCWI_scripts.trace import profiled
 import os
 
-def obs_table_target(ra, dec, radius=30, output_dir='.', data_type='both'):
+# frames within radius arcsec of (ra, dec) as a CompactTable with the given
+# columns, filtered by data type and the predicates of query.Query (imtype,
+# camera, target, start, end...); empty when there are none
+def obs_table_target(ra, dec, radius=30, output_dir='.', data_type='both', columns=RELEVANT_COLUMNS, **predicates):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    pos = f'circle {ra} {dec} {radius / 3600}'  # Convert radius to degrees
-    outpath = os.path.join(output_dir, f'position_search_{ra}_{dec}_{radius}.tbl')
-    # Check if the file already exists
-    if not os.path.isfile(outpath):
-        try:
-            Koa.query_position(instrument='kcwi', pos=pos, outpath=outpath, overwrite=True)
-        except Exception as e:
-            print(f"❌ Error querying metadata for position {pos}: {e}")
-            return None, None, None
-
-    table = Table.read(outpath, format='ascii.ipac')
-
-    # Filter by data type
-    if data_type.lower() == 'science':
-        table = table[[val == 'object' for val in table['koaimtyp']]]
-    elif data_type.lower() == 'calibration':
-        table = table[[val != 'object' for val in table['koaimtyp']]]
-
-    # Relevant columns
-    relevant_columns = ['koaid', 'ofname', 'targname', 'koaimtyp', 'ra', 'dec', 'date_obs', 'camera']
-    table = table[relevant_columns]
-    
-    return table
+    # Query by position (through the shared metadata cache)
+    query = Query(columns, data_type=data_type, **predicates)
+    return query_position(ra, dec, radius, output_dir, query)
 
 
 def main():
@@ -38,14 +23,32 @@ def main():
     parser.add_argument('--data_type', type=str, default='both', choices=['both', 'science', 'calibration'],
                         help="Tipo de datos: 'both', 'science' o 'calibration' (por defecto 'both').")
     parser.add_argument('--radius', type=float, default=30, help="Radio de búsqueda en arcsec (por defecto 30'').")
+    parser.add_argument('--start', type=str, default=None, help="Keep frames from this night on ('YYYY-MM-DD').")
+    parser.add_argument('--end', type=str, default=None, help="Keep frames up to this night ('YYYY-MM-DD').")
+    parser.add_argument('--imtype', type=str, default=None, help="Comma-separated image types to keep (e.g. 'object').")
+    parser.add_argument('--camera', type=str, default=None, help="Comma-separated cameras to keep (e.g. 'blue').")
+    parser.add_argument('--target', type=str, default=None, help="Comma-separated target names to keep, with wildcards (e.g. 'NGC*').")
+    parser.add_argument('--columns', type=str, default=','.join(RELEVANT_COLUMNS), help="Comma-separated columns to show (by default the relevant ones).")
     parser.add_argument('--outpath', type=str, default='.', help="Directorio de salida (por defecto './outputKC/').")
+    parser.add_argument('--pipeline', action='store_true', help="Run the lookup with the asyncio pipeline (KOA queries on an event loop, large tables parsed in a process pool).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
 
     args = parser.parse_args()
 
     try:
-        table = obs_table_target(ra=args.ra, dec=args.dec, data_type=args.data_type, radius=args.radius)
-        print(table)
+        with profiled(args.profile):
+            arguments = dict(ra=args.ra, dec=args.dec, data_type=args.data_type, radius=args.radius, output_dir=args.outpath,
+                             columns=args.columns, start=args.start, end=args.end, imtype=args.imtype, camera=args.camera,
+                             target=args.target)
+            if args.pipeline:
+                from KCWI_scripts import pipeline
+                table = pipeline.run(pipeline.obs_table_target, **arguments)
+            else:
+                # answered by kcwi_service when one is running
+                table = call_or_run('obs_table_target', obs_table_target, **arguments)
+            print(table if len(table) else "⚠️ No observations found.")
         
+            default_client().print_report()
     except Exception as e:
         print(f"Error: {e}")
 
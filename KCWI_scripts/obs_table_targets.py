@@ -0,0 +1,141 @@
+import os
+import csv
+import math
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from KCWI_scripts.metadata import load_position
+from KCWI_scripts.crossmatch import frame_coords
+from KCWI_scripts.standard_stars import parse_angles
+from KCWI_scripts.sky_index import unit_vectors
+from KCWI_scripts.query import Query, RELEVANT_COLUMNS
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts import trace
+
+
+# load targets from a csv file (Name,RA,DEC[,Radius]) as (names, ra, dec, radius)
+# arrays; RA/DEC in degrees or sexagesimal, radius in arcsec
+def load_targets(path, default_radius=30):
+    names, ras, decs, radii = [], [], [], []
+    with open(path, mode="r") as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            if row:
+                names.append(row[0].strip())
+                ras.append(row[1].strip())
+                decs.append(row[2].strip())
+                radii.append(float(row[3]) if len(row) > 3 and row[3].strip() else default_radius)
+
+    return np.array(names, dtype=str), parse_angles(ras, hours=True), parse_angles(decs, hours=False), np.array(radii)
+
+
+# group targets closer than merge_arcsec into cones that contain all their
+# search regions; returns [(ra, dec, radius)]
+def merge_cones(ra, dec, radius, merge_arcsec=300):
+    from scipy.spatial import cKDTree
+    vectors = unit_vectors(ra, dec)
+    tree = cKDTree(vectors)
+    chord = 2 * math.sin(math.radians(merge_arcsec / 3600) / 2)
+    assigned = np.zeros(len(ra), dtype=bool)
+
+    cones = []
+    for i in range(len(ra)):
+        if assigned[i]:
+            continue
+        members = [j for j in tree.query_ball_point(vectors[i], chord) if not assigned[j]]
+        assigned[members] = True
+
+        center = vectors[members].sum(axis=0)
+        center /= np.linalg.norm(center)
+        sep = np.degrees(2 * np.arcsin(np.clip(np.linalg.norm(vectors[members] - center, axis=1) / 2, 0, 1))) * 3600
+        cones.append((float(np.degrees(np.arctan2(center[1], center[0])) % 360),
+                      float(np.degrees(np.arcsin(center[2]))),
+                      float(np.max(sep + radius[members]))))
+    return cones
+
+
+# the table of no observations, with the columns of one with some
+def no_observations():
+    return CompactTable.empty(['target'] + RELEVANT_COLUMNS).to_table()
+
+
+def obs_table_targets(targets_file, output_dir='.', data_type='both', default_radius=30, merge_arcsec=300, max_workers=4):
+    from astropy.table import vstack, unique
+    from astropy.coordinates import SkyCoord, search_around_sky
+    import astropy.units as u
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    names, ra, dec, radius = load_targets(targets_file, default_radius)
+    if len(names) == 0:
+        print(f"No targets found in {targets_file}.")
+        return no_observations()
+
+    cones = merge_cones(ra, dec, radius, merge_arcsec)
+    print(f"{len(names)} targets merged into {len(cones)} archive queries.")
+
+    # the cones are queried concurrently (each one through the sky index)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(lambda cone: load_position(*cone, output_dir), cones))
+
+    tables = [t for t in tables if t is not None and len(t)]
+    if not tables:
+        print("⚠️ No observations found for any target.")
+        return no_observations()
+
+    frames = unique(vstack([t.to_table() for t in tables], join_type="outer", metadata_conflicts="silent"), keys="koaid")
+    frames = Query(RELEVANT_COLUMNS, data_type=data_type).apply(frames).to_table()
+
+    # every target against every frame in one pass, then each target's own radius
+    coords, rows = frame_coords(frames)
+    if len(coords) == 0:
+        print("⚠️ No observations found for any target.")
+        return no_observations()
+    with trace.span("coords", n=len(ra)):
+        targets = SkyCoord(ra=ra * u.deg, dec=dec * u.deg)
+    with trace.span("crossmatch", frames=len(coords), stars=len(targets)):
+        target_idx, frame_idx, sep, _ = search_around_sky(targets, coords, radius.max() * u.arcsec)
+    sep = sep.arcsecond
+    keep = sep <= radius[target_idx]
+    target_idx, frame_idx, sep = target_idx[keep], frame_idx[keep], sep[keep]
+    order = np.lexsort((sep, target_idx))
+
+    table = frames[rows[frame_idx[order]]]
+    table.add_column(names[target_idx[order]], name='target', index=0)
+
+    found = len(set(target_idx))
+    print(f"✅ {len(table)} observations of {found} of {len(names)} targets.")
+
+    output_path = os.path.join(output_dir, f"targets_{os.path.splitext(os.path.basename(targets_file))[0]}.tbl")
+    table.write(output_path, format='ascii.ipac', overwrite=True)
+    print(f"📝 Table saved to: {output_path}")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query KCWI observations for a list of targets.")
+    parser.add_argument('targets_file', type=str, help="CSV file with columns Name,RA,DEC and optionally Radius (arcsec).")
+    parser.add_argument('--data_type', type=str, default='both', choices=['both', 'science', 'calibration'],
+                        help="Tipo de datos: 'both', 'science' o 'calibration' (por defecto 'both').")
+    parser.add_argument('--radius', type=float, default=30, help="Radio de búsqueda en arcsec para los targets sin radio (por defecto 30'').")
+    parser.add_argument('--merge_arcsec', type=float, default=300, help="Targets closer than this (arcsec) share one archive query (default 300).")
+    parser.add_argument('--max_workers', type=int, default=4, help="Number of archive queries at the same time (default 4).")
+    parser.add_argument('--outpath', type=str, default='.', help="Directorio de salida (por defecto '.').")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
+
+    args = parser.parse_args()
+
+    try:
+        with trace.profiled(args.profile):
+            table = obs_table_targets(args.targets_file, output_dir=args.outpath, data_type=args.data_type,
+                                      default_radius=args.radius, merge_arcsec=args.merge_arcsec, max_workers=args.max_workers)
+            print(table if len(table) else "⚠️ No observations found.")
+            default_client().print_report()
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
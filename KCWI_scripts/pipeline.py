@@ -0,0 +1,213 @@
+import os
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from KCWI_scripts.cache import default_cache
+from KCWI_scripts.ipac_reader import read_compact
+from KCWI_scripts.metadata import load_night, load_position, fetch_window, window_dates, night_cache_key, contiguous_runs
+from KCWI_scripts.query import Query, night_range, RELEVANT_COLUMNS
+from KCWI_scripts.compact_table import concatenate
+from KCWI_scripts.scheduler import run_nearest_first_async, offset_rings
+from KCWI_scripts.koa_client import DEFAULT_MAX_CONCURRENCY
+from KCWI_scripts import trace
+
+# asyncio API: find_calibrations, obs_table_date and obs_table_target as
+# coroutines, for applications that already run an event loop, and run() to
+# call them from synchronous code (the scripts' --pipeline option).
+#
+# A lookup is a pipeline of three stages:
+#   fetch  KOA queries and cache reads, at most max_concurrency at a time on
+#          one executor shared by every call (pykoa itself is blocking), with
+#          the same caching, coalescing and locking as the scripts (metadata.py)
+#   parse  metadata files from process_parse_bytes on are parsed in a process
+#          pool, so large tables neither hold the GIL nor wait behind it;
+#          smaller ones cost less to parse than to send between processes
+#   match  on the event loop, night by night as they arrive (nearest first),
+#          cancelling the remaining fetches once everything was found; for
+#          obs_table_date, the query runs on every run of nights as it arrives
+#          while the others are still being fetched
+# The executors are created once per Pipeline (default_pipeline() is shared by
+# the process), not per call.
+
+DEFAULT_PROCESS_PARSE_BYTES = 4 * 1024**2
+
+
+class Pipeline:
+    def __init__(self, max_concurrency=None, parse_workers=None, process_parse_bytes=None):
+        max_concurrency = int(max_concurrency if max_concurrency is not None
+                              else os.environ.get('KCWI_KOA_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY))
+        self.parse_workers = parse_workers or min(4, os.cpu_count() or 1)
+        self.process_parse_bytes = int(process_parse_bytes if process_parse_bytes is not None
+                                       else os.environ.get('KCWI_PROCESS_PARSE_BYTES', DEFAULT_PROCESS_PARSE_BYTES))
+        self._fetchers = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="kcwi-fetch")
+        self._parsers = None
+        self._lock = threading.Lock()
+
+    # started on the first large table; forkserver, as the process has threads
+    # (spawn where there is no forkserver, e.g. Windows)
+    def _parser_pool(self):
+        with self._lock:
+            if self._parsers is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._parsers = ProcessPoolExecutor(self.parse_workers, mp_context=multiprocessing.get_context(method))
+            return self._parsers
+
+    # parse stage, called by the fetch stage with the file it got
+    def parse(self, path):
+        if self.process_parse_bytes <= 0 or os.path.getsize(path) < self.process_parse_bytes:
+            return read_compact(path)
+        with trace.span("parse", file=os.path.basename(path), process=True):
+            return self._parser_pool().submit(read_compact, path).result()
+
+    # run a blocking call of the fetch stage without blocking the event loop
+    async def fetch(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._fetchers, functools.partial(fn, *args, **kwargs))
+
+    async def load_night(self, date, outpath):
+        return await self.fetch(load_night, date, outpath, self.parse)
+
+    async def load_position(self, ra, dec, radius, outpath):
+        return await self.fetch(load_position, ra, dec, radius, outpath, self.parse)
+
+    async def fetch_window(self, dates, outpath, max_gap=2):
+        return await self.fetch(fetch_window, dates, outpath, max_gap, self.parse)
+
+    def close(self):
+        self._fetchers.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            if self._parsers is not None:
+                self._parsers.shutdown(wait=False, cancel_futures=True)
+                self._parsers = None
+
+
+_default_pipeline = None
+_default_lock = threading.Lock()
+
+
+def default_pipeline():
+    global _default_pipeline
+    with _default_lock:
+        if _default_pipeline is None:
+            _default_pipeline = Pipeline()
+    return _default_pipeline
+
+
+# run a coroutine function of this module from synchronous code
+def run(fn, *args, **kwargs):
+    return asyncio.run(fn(*args, **kwargs))
+
+
+# same result as obs_table_date.obs_table_date: cached nights are read with only
+# the query's columns, and the other nights fetched with one range query per
+# run of nights (all at once, up to max_concurrency); each night is queried as
+# soon as its fetch is done
+async def obs_table_date(date, output_dir='.', data_type='both', end=None, columns=RELEVANT_COLUMNS, pipeline=None,
+                         **predicates):
+    pipeline = pipeline or default_pipeline()
+    os.makedirs(output_dir, exist_ok=True)
+    query = Query(columns, data_type=data_type, **predicates)
+    dates = night_range(date, end) if end else [date]
+    cache = default_cache()
+
+    async def read_cached(night):
+        return {night: await pipeline.fetch(cache.get, night_cache_key(night), query.read_columns())}
+
+    tables, results = {}, {}
+
+    def match(found):
+        for night, table in found.items():
+            tables[night] = table
+            if table is not None:
+                results[night] = query.apply(table)
+
+    for result in asyncio.as_completed([read_cached(night) for night in dates]):
+        match(await result)
+    runs = contiguous_runs([night for night in dates if tables[night] is None], max_gap=2)
+    for result in asyncio.as_completed([pipeline.fetch_window(nights, output_dir) for nights in runs]):
+        match(await result)
+
+    # the matching frames of every night, in order
+    ordered = [results[night] for night in dates if night in results]
+    return concatenate([table for table in ordered if len(table)] or ordered[:1], query.columns or ())
+
+
+# same result as obs_table_target.obs_table_target; a cone is one KOA query,
+# so the stages only follow each other: the fetch (and a large table's parse)
+# off the event loop, then the query on it
+async def obs_table_target(ra, dec, radius=30, output_dir='.', data_type='both', columns=RELEVANT_COLUMNS, pipeline=None,
+                           **predicates):
+    pipeline = pipeline or default_pipeline()
+    os.makedirs(output_dir, exist_ok=True)
+    query = Query(columns, data_type=data_type, **predicates)
+    return query.apply(await pipeline.load_position(ra, dec, radius, output_dir))
+
+
+# same search, output and result (the CalibrationSearch) as
+# calib_finder.find_calibrations. In window mode one ring of nights is fetched
+# ahead of the one being matched (prefetch_rings), at the cost of one query
+# more when the search ends early; per night, max_workers nights are fetched
+# at once.
+async def find_calibrations(date, outpath='./downloads/', days_to_check=7, tolerance_arcsec=5, summary=False, max_workers=4,
+                            bias_min_nframes=7, flatlamp_min_nframes=6, domeflat_min_nframes=3,
+                            twiflat_min_nframes=1, dark_min_nframes=3, arc_min_nframes=1, contbars_min_nframes=1,
+                            window_fetch=True, standards_file=None, download=False, download_dir=None, download_workers=4,
+                            prefetch_rings=1, pipeline=None):
+    from KCWI_scripts.calib_finder import (CalibrationSearch, required_calibrations, wait_for_downloads,
+                                           print_outcome, summary_path)
+    from KCWI_scripts.downloader import DownloadEngine
+    from KCWI_scripts.frame_store import default_store
+
+    pipeline = pipeline or default_pipeline()
+    os.makedirs(outpath, exist_ok=True)
+
+    engine = None
+    if download:
+        engine = DownloadEngine(download_dir or outpath, max_workers=download_workers, calibfile=True, store=default_store())
+
+    required = required_calibrations(bias_min_nframes, flatlamp_min_nframes, domeflat_min_nframes, twiflat_min_nframes,
+                                     dark_min_nframes, arc_min_nframes, contbars_min_nframes)
+    try:
+        # the catalog is read from disk the first time
+        search = await pipeline.fetch(CalibrationSearch, date, required, tolerance_arcsec, standards_file, engine)
+
+        print(f"Checking calibrations for {date}...")
+        table = await pipeline.load_night(date, outpath)
+        if table is None:
+            return None
+
+        search.start(table, *search.check(date, table))
+        if search.is_done():
+            print("\n✅ All required calibrations and a standard star are present.")
+            return search
+
+        check_dates = window_dates(date, days_to_check)
+        if window_fetch:
+            units = offset_rings(check_dates)
+            max_in_flight = 1 + prefetch_rings
+        else:
+            units = [(None, [d]) for d in check_dates]
+            max_in_flight = max_workers
+
+        async def process_unit(unit):
+            lo, nights = unit
+            if lo is not None:
+                tables = await pipeline.fetch_window(nights, outpath, max_gap=2 * lo)
+            else:
+                tables = {nights[0]: await pipeline.load_night(nights[0], outpath)}
+            return [(night, tables.get(night)) for night in nights]
+
+        def on_result(results):
+            for check_date, table in results:
+                if table is not None:
+                    search.add(check_date, table, *search.check(check_date, table))
+
+        skipped = await run_nearest_first_async(units, process_unit, on_result, search.is_done, max_in_flight=max_in_flight)
+        print_outcome(search, skipped, len(check_dates), summary, summary_path(outpath, date, days_to_check))
+        return search
+    finally:
+        if engine is not None:
+            await pipeline.fetch(wait_for_downloads, engine)
@@ -0,0 +1,178 @@
+import fnmatch
+import numpy as np
+from KCWI_scripts.cache import default_cache, read_table
+from KCWI_scripts.ipac_reader import read_compact
+from KCWI_scripts.compact_table import CompactTable, concatenate
+from KCWI_scripts.metadata import fetch_window, load_position, night_cache_key
+from KCWI_scripts import trace
+
+# Column-projected, vectorized queries over KOA metadata.
+#
+# A Query has the columns to return (all by default) and predicates on the
+# frames, all of which have to hold:
+#   data_type            'science' (koaimtyp object), 'calibration' (any other
+#                        koaimtyp) or 'both'
+#   imtype, camera       koaimtyp / camera is one of the given values
+#   target               targname matches one of the given names, which can
+#                        have shell wildcards ('NGC*')
+#   start, end           date_obs from start to end ('YYYY-MM-DD', inclusive)
+#   ra_range, dec_range  (min, max) in degrees; an ra_range with min > max
+#                        wraps through 0
+# String comparisons ignore case and surrounding spaces; frames with a null
+# value in a predicate's column never match it. Only the returned columns and
+# the ones the predicates need are read, from the IPAC file or the cache entry,
+# and every predicate is one vectorized mask (over the distinct values of
+# dictionary-encoded columns). Results are always CompactTables, empty when
+# nothing matches or there is no metadata.
+#
+#   query = Query(['koaid', 'koaimtyp', 'date_obs'], data_type='calibration', camera='blue')
+#   table = query_file('koa_metadata_2024-03-01.tbl', query)
+#   table = query_nights(night_range('2024-03-01', '2024-03-31'), './downloads', query)
+
+DATA_TYPES = ('both', 'science', 'calibration')
+
+# columns of the obs_table_* tables
+RELEVANT_COLUMNS = ['koaid', 'ofname', 'targname', 'koaimtyp', 'ra', 'dec', 'date_obs', 'camera']
+
+
+def _as_list(values):
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = values.split(',')
+    return [str(v).strip().upper() for v in values if str(v).strip()]
+
+
+def _columns(columns):
+    if isinstance(columns, str):
+        columns = columns.split(',')
+    columns = [c.strip() for c in columns or () if c.strip()]
+    return columns or None
+
+
+def _normalize(values):
+    return np.char.upper(np.char.strip(np.asarray(values).astype(str)))
+
+
+# mask of the string column values matching any of the (upper-case) patterns;
+# each distinct value is matched once
+def _matcher(patterns):
+    literal = not any(c in p for p in patterns for c in '*?[')
+
+    def match(values):
+        values = _normalize(values)
+        if literal:
+            return np.isin(values, patterns)
+        distinct, inverse = np.unique(values, return_inverse=True)
+        hits = np.array([any(fnmatch.fnmatchcase(v, p) for p in patterns) for v in distinct], dtype=bool)
+        return hits[inverse.ravel()]
+    return match
+
+
+class Query:
+    def __init__(self, columns=None, data_type='both', imtype=None, camera=None, target=None,
+                 start=None, end=None, ra_range=None, dec_range=None):
+        if data_type.lower() not in DATA_TYPES:
+            raise ValueError(f"data_type must be one of {', '.join(DATA_TYPES)}, not '{data_type}'")
+        self.columns = _columns(columns)
+        self.data_type = data_type.lower()
+        self.imtype = _as_list(imtype)
+        self.camera = _as_list(camera)
+        self.target = _as_list(target)
+        self.start = start
+        self.end = end
+        self.ra_range = tuple(float(v) for v in ra_range) if ra_range is not None else None
+        self.dec_range = tuple(float(v) for v in dec_range) if dec_range is not None else None
+
+    # columns the predicates read
+    def predicate_columns(self):
+        columns = []
+        if self.data_type != 'both' or self.imtype:
+            columns.append('koaimtyp')
+        if self.camera:
+            columns.append('camera')
+        if self.target:
+            columns.append('targname')
+        if self.start or self.end:
+            columns.append('date_obs')
+        if self.ra_range is not None:
+            columns.append('ra')
+        if self.dec_range is not None:
+            columns.append('dec')
+        return columns
+
+    # columns to read for this query, None for all
+    def read_columns(self):
+        if self.columns is None:
+            return None
+        return self.columns + [c for c in self.predicate_columns() if c not in self.columns]
+
+    def mask(self, table):
+        table = CompactTable.from_table(table)
+        mask = np.ones(len(table), dtype=bool)
+        if self.data_type == 'science':
+            mask &= table.map_values('koaimtyp', _matcher(['OBJECT']), fill=False)
+        elif self.data_type == 'calibration':
+            mask &= ~table.map_values('koaimtyp', _matcher(['OBJECT']), fill=True)
+        for name, patterns in (('koaimtyp', self.imtype), ('camera', self.camera), ('targname', self.target)):
+            if patterns:
+                mask &= table.map_values(name, _matcher(patterns), fill=False)
+
+        if self.start or self.end:
+            start, end = self.start or '', self.end or '9999-12-31'
+
+            def in_dates(values):
+                days = np.asarray(values).astype('U10')
+                return (days >= start) & (days <= end)
+            mask &= table.map_values('date_obs', in_dates, fill=False)
+
+        for name, bounds in (('ra', self.ra_range), ('dec', self.dec_range)):
+            if bounds is None:
+                continue
+            values = np.ma.filled(np.ma.asarray(table[name], dtype=float), np.nan)
+            lo, hi = bounds
+            if name == 'ra' and lo > hi:
+                mask &= (values >= lo) | (values <= hi)
+            else:
+                mask &= (values >= lo) & (values <= hi)
+        return mask
+
+    # the matching rows of table (a CompactTable or Table) with the query's columns
+    def apply(self, table):
+        if table is None:
+            return CompactTable.empty(self.columns or ())
+        table = CompactTable.from_table(table)
+        with trace.span("query", rows=len(table)):
+            table = table[self.mask(table)]
+        return table[self.columns] if self.columns is not None else table
+
+
+# nights from start to end, inclusive
+def night_range(start, end):
+    import pandas as pd
+    return [d.strftime('%Y-%m-%d') for d in pd.date_range(start, end, freq='D')]
+
+
+# query a local metadata file, through the cache
+def query_file(path, query):
+    return query.apply(read_table(path, query.read_columns()))
+
+
+# query the given nights: cached nights are read with only the needed columns,
+# the others are fetched from KOA (one range query per run of nights, see
+# metadata.fetch_window). parse as in metadata.py.
+def query_nights(dates, outpath, query, parse=read_compact):
+    cache = default_cache()
+    tables = {night: cache.get(night_cache_key(night), query.read_columns()) for night in dates}
+    missing = [night for night, table in tables.items() if table is None]
+    if missing:
+        tables.update(fetch_window(missing, outpath, parse=parse))
+
+    # the matching frames of every night, in order
+    results = [query.apply(tables[night]) for night in dates if tables[night] is not None]
+    return concatenate([table for table in results if len(table)] or results[:1], query.columns or ())
+
+
+# query the frames within radius arcsec of (ra, dec), see metadata.load_position
+def query_position(ra, dec, radius, outpath, query, parse=read_compact):
+    return query.apply(load_position(ra, dec, radius, outpath, parse))
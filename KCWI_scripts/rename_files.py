@@ -1,83 +1,123 @@
 import os
-from astropy.table import Table
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from KCWI_scripts.cache import read_table
+from KCWI_scripts.fits_header import read_primary_header
+from KCWI_scripts.frame_store import link_file, LINK_MODES
+from KCWI_scripts.trace import profiled
 import argparse
-import shutil
 
 
-def rename_fits_files(output_dir = "./renamed_files", directory=".", metadata_file = None): 
-    if metadata_file is not None and not os.path.isabs(metadata_file):
-        metadata_file = os.path.join(directory, metadata_file)
-    
-    # Change to the specified directory
-    if directory != ".":  
-        os.chdir(directory)
+# {koaid: ofname} from the metadata table, None if it can't be used
+def names_from_table(metadata_file):
+    if not os.path.exists(metadata_file):
+        print(f"Metadata file {metadata_file} does not exist.")
+        return None
+
+    # Check if the table has the required columns (only those are read)
+    try:
+        table = read_table(metadata_file, columns=['koaid', 'ofname'])
+    except KeyError:
+        print(f"Metadata file {metadata_file} is missing 'koaid' or 'ofname' columns.")
+        return None
+
+    # frames without an original name (empty or null in KOA) are not renamed
+    return {row['koaid']: str(row['ofname']) for row in table
+            if row['ofname'] is not np.ma.masked and str(row['ofname']).strip()}
+
 
+# OFNAME of the primary header, read without loading the data
+def name_from_header(path):
+    ofname = read_primary_header(path, keys=['OFNAME']).get('OFNAME')
+    return str(ofname).strip() if ofname else None
+
+
+def rename_fits_files(output_dir = "./renamed_files", directory=".", metadata_file = None, mode = "auto",
+                      from_header = False, max_workers = 8):
+    # everything works on absolute paths, relative ones are inside directory
+    directory = os.path.abspath(directory)
+    output_dir = os.path.normpath(os.path.join(directory, output_dir))
+    if metadata_file is not None:
+        metadata_file = os.path.join(directory, metadata_file)
 
     # search for the metadata file if not provided
-    if metadata_file is None:
-        for file in os.listdir():
+    if metadata_file is None and not from_header:
+        for file in sorted(os.listdir(directory)):
             if file.endswith("_filtered.tbl"):
-                metadata_file = file
+                metadata_file = os.path.join(directory, file)
                 break
 
-    if metadata_file is None:
-        print("No metadata file found.")
-        return
-    
-    elif not os.path.exists(metadata_file):
-        print(f"Metadata file {metadata_file} does not exist.")
-        return
-
-    table = Table.read(metadata_file, format='ascii.ipac')
+    fits_files = sorted(f for f in os.listdir(directory) if f.endswith(".fits"))
 
-    # Check if the table has the required columns
-    if 'koaid' not in table.colnames or 'ofname' not in table.colnames:
-        print(f"Metadata file {metadata_file} is missing 'koaid' or 'ofname' columns.")
-        return
-    
-    # Make dictonary with format {koaid: ofname}
-    rename_map = {row['koaid']: row['ofname'] for row in table if row['ofname'].strip()}
+    if metadata_file is not None and not from_header:
+        rename_map = names_from_table(metadata_file)
+        if rename_map is None:
+            return
+    else:
+        print("No metadata file, reading OFNAME from the FITS headers.")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            names = executor.map(_safe_name_from_header, [os.path.join(directory, f) for f in fits_files])
+        rename_map = {fits: name for fits, name in zip(fits_files, names) if name}
 
     # Create the output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Rename the files
-    fits_files = [f for f in os.listdir() if f.endswith(".fits")]
-    renamed_count = 0
-
+    jobs = []
     for fits in fits_files:
         if fits in rename_map:
             new_name = rename_map[fits]
             if not new_name.endswith(".fits"):
                 new_name += ".fits"  # Asegurar que termine en .fits
+            jobs.append((fits, new_name))
 
-            src_path = os.path.join(directory, fits)
-            dst_path = os.path.join(output_dir, new_name) 
-
-            try:
-                shutil.copy(src_path, dst_path)  # Copy the file to the new location
-                print(f"{fits} → {new_name}")
-                renamed_count += 1
-            except Exception as e:
-                print(f"Failed to rename {fits}: {e}")
+    # links are instant; the pool is for the files that end up being copied
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda job: _rename(directory, output_dir, mode, *job), jobs))
 
-    if renamed_count == 0:
+    used = [r for r in results if r is not None]
+    if not used:
         print("No files found to rename.")
     else:
-        print(f"\n {renamed_count} files were copied and renamed into '{output_dir}'.")
+        counts = ', '.join(f"{used.count(m)} {m}" for m in LINK_MODES if used.count(m))
+        print(f"\n {len(used)} files were renamed into '{output_dir}' ({counts}).")
+
+
+def _safe_name_from_header(path):
+    try:
+        return name_from_header(path)
+    except Exception as e:
+        print(f"Failed to read the header of {os.path.basename(path)}: {e}")
+        return None
+
+
+def _rename(directory, output_dir, mode, fits, new_name):
+    try:
+        used = link_file(os.path.join(directory, fits), os.path.join(output_dir, new_name), mode)
+        print(f"{fits} → {new_name}")
+        return used
+    except Exception as e:
+        print(f"Failed to rename {fits}: {e}")
+        return None
+
 
 def main():
     parser = argparse.ArgumentParser(description="Rename KCWI FITS files according to the 'ofname' column in the metadata file.")
     parser.add_argument('--output_dir', type=str, default='./renamed_files', help="Directory to save renamed files (default: ./renamed_files).")
     parser.add_argument('--directory', type=str, default='.', help="Directory where the FITS files are located (default: current directory).")
     parser.add_argument('--metadata_file', type=str, default=None, help="Path to the metadata file (default: search for *_filtered.tbl in the directory).")
+    parser.add_argument('--mode', type=str, default='auto', choices=LINK_MODES, help="How renamed files are made: hardlink, symlink, reflink or copy (default: auto, a hardlink or reflink when possible, otherwise a copy).")
+    parser.add_argument('--from_header', action='store_true', help="Take the new names from the OFNAME keyword of the FITS headers instead of a metadata file.")
+    parser.add_argument('--max_workers', type=int, default=8, help="Number of files processed at the same time (default 8).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
     args = parser.parse_args()
 
     try:
-        rename_fits_files(args.output_dir, args.directory, args.metadata_file)
+        with profiled(args.profile):
+            rename_fits_files(args.output_dir, args.directory, args.metadata_file, mode = args.mode,
+                              from_header = args.from_header, max_workers = args.max_workers)
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from KCWI_scripts import trace
+
+
+# Run process(unit) for each unit in the given order (nearest night first) with
+# at most max_in_flight units running at once, handing every result to
+# on_result in completion order. As soon as is_done() returns True nothing else
+# is dispatched and pending work is cancelled. Returns the units never run.
+def run_nearest_first(units, process, on_result, is_done, max_in_flight=4):
+    pending = list(units)
+    in_flight = set()
+    executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight and not is_done():
+                in_flight.add(executor.submit(process, pending.pop(0)))
+            trace.gauge("scheduler.in_flight", len(in_flight))
+
+            if not in_flight:
+                break
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_result(future.result())
+
+            if is_done():
+                break
+    finally:
+        # results of units still running are not needed anymore
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return pending
+
+
+# asyncio version for the pipeline (pipeline.py): process(unit) is a coroutine
+# function and on_result gets the results in the order of the units (nearest
+# night first) as soon as all nearer units are done, so the outcome does not
+# depend on which query answers first. Tasks still running once is_done()
+# returns True are cancelled.
+async def run_nearest_first_async(units, process, on_result, is_done, max_in_flight=4):
+    pending = list(units)
+    in_flight = {}  # task: position of its unit
+    finished = {}   # position: result, waiting for the nearer units
+    dispatched = 0
+    delivered = 0
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight and not is_done():
+                in_flight[asyncio.ensure_future(process(pending.pop(0)))] = dispatched
+                dispatched += 1
+            trace.gauge("scheduler.in_flight", len(in_flight))
+
+            if not in_flight:
+                break
+
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                finished[in_flight.pop(task)] = task.result()
+
+            while delivered in finished and not is_done():
+                on_result(finished.pop(delivered))
+                delivered += 1
+
+            if is_done():
+                break
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+    return pending
+
+
+# group dates ordered by |offset| (as from metadata.window_dates) into rings
+# of offsets 1, 2-3, 4-7, 8-15, ... that double in width
+def offset_rings(check_dates):
+    rings = []
+    lo = 1
+    while 2 * (lo - 1) < len(check_dates):
+        hi = 2 * lo - 1
+        rings.append((lo, check_dates[2 * (lo - 1):2 * hi]))
+        lo = hi + 1
+    return rings
@@ -0,0 +1,359 @@
+import os
+import hmac
+import json
+import time
+import signal
+import socket
+import secrets
+import argparse
+import importlib
+import threading
+import numpy as np
+from urllib.parse import urlparse, parse_qsl
+from KCWI_scripts.cache import default_cache
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts.koa_client import default_client, capture_output
+from KCWI_scripts.trace import profiled
+
+# Long-running local service that answers the lookups of the scripts from one
+# warm process.
+#
+# kcwi_service listens for HTTP on a Unix socket (KCWI_SERVICE_SOCKET, by
+# default <cache_dir>/service.sock) only its user can open, and optionally on a
+# localhost TCP port, where every request needs the header
+# "Authorization: Bearer <token>" with the token the service writes next to the
+# socket (<socket>.token, also only readable by its user). It
+# keeps up to --max_memory_mb of parsed metadata tables and sky index frames in
+# memory (see cache.py), and the standard-star catalog stays loaded, so a
+# repeated lookup touches neither the disk nor KOA. obs_table_date,
+# obs_table_target and calib_finder send their lookup to the service when one is
+# listening (KCWI_NO_SERVICE disables it) and run it themselves otherwise.
+#
+#   POST /<operation> with the arguments as a JSON object, or
+#   GET  /<operation>?name=value&...
+# answers {"output": what the operation printed, "table": table or null} or
+# {"error": message}; GET /status answers the memory and KOA usage. Messages
+# printed by worker threads of an operation go to the service's own output.
+
+
+def _bool(value):
+    return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes")
+
+
+# a list, or comma-separated values in a query string
+def _strings(value):
+    return [str(v) for v in value] if isinstance(value, list) else str(value)
+
+
+def _floats(value):
+    return [float(v) for v in (value if isinstance(value, list) else str(value).split(","))]
+
+
+# predicates of query.Query
+QUERY_ARGUMENTS = {"columns": _strings, "imtype": _strings, "camera": _strings, "target": _strings}
+
+
+# operation: (module, function, {argument: type})
+OPERATIONS = {
+    "obs_table_date": ("KCWI_scripts.obs_table_date", "obs_table_date",
+                       {"date": str, "output_dir": str, "data_type": str, "end": str, "ra_range": _floats,
+                        "dec_range": _floats, **QUERY_ARGUMENTS}),
+    "obs_table_target": ("KCWI_scripts.obs_table_target", "obs_table_target",
+                         {"ra": float, "dec": float, "radius": float, "output_dir": str, "data_type": str, "start": str,
+                          "end": str, **QUERY_ARGUMENTS}),
+    "find_calibrations": ("KCWI_scripts.calib_finder", "find_calibrations",
+                          {"date": str, "outpath": str, "days_to_check": int, "tolerance_arcsec": float,
+                           "summary": _bool, "max_workers": int, "bias_min_nframes": int,
+                           "flatlamp_min_nframes": int, "domeflat_min_nframes": int, "twiflat_min_nframes": int,
+                           "dark_min_nframes": int, "arc_min_nframes": int, "contbars_min_nframes": int,
+                           "window_fetch": _bool, "standards_file": str}),
+}
+
+# arguments sent as absolute paths, the service does not share the caller's cwd
+PATH_ARGUMENTS = ("output_dir", "outpath", "standards_file")
+
+DEFAULT_MAX_MEMORY_MB = 1024
+
+
+def socket_path():
+    return os.environ.get("KCWI_SERVICE_SOCKET", os.path.join(default_cache().cache_dir, "service.sock"))
+
+
+# file with the token of the TCP port of the service listening on path
+def token_path(path=None):
+    return f"{path or socket_path()}.token"
+
+
+def table_to_json(table):
+    units = table.units if isinstance(table, CompactTable) else {}
+    columns = []
+    for name in table.colnames:
+        col = table[name]
+        data = np.asarray(col)
+        if data.dtype.kind == "O":
+            data = data.astype(str)
+        values = data.tolist()
+        for i in np.flatnonzero(np.ma.getmaskarray(col)):
+            values[i] = None
+        unit = units.get(name) or getattr(col, "unit", None)
+        columns.append({"name": name, "dtype": data.dtype.str, "unit": str(unit) if unit else None, "data": values})
+    return {"columns": columns}
+
+
+# the CompactTable sent by table_to_json, as the operation run here returns it
+def table_from_json(data):
+    values, masks, units = {}, {}, {}
+    for col in data["columns"]:
+        name, dtype = col["name"], np.dtype(col["dtype"])
+        fill = "" if dtype.kind == "U" else 0
+        masks[name] = np.array([v is None for v in col["data"]], dtype=bool)
+        values[name] = np.array([fill if v is None else v for v in col["data"]], dtype=dtype)
+        if col["unit"]:
+            units[name] = col["unit"]
+    return CompactTable.from_columns(values, masks, units)
+
+
+def convert_arguments(operation, arguments):
+    types = OPERATIONS[operation][2]
+    unknown = [name for name in arguments if name not in types]
+    if unknown:
+        raise ValueError(f"unknown arguments for {operation}: {', '.join(unknown)}")
+    return {name: None if value is None else types[name](value) for name, value in arguments.items()}
+
+
+# run an operation here, returning the response sent by the service
+def run_operation(operation, arguments):
+    module, function, _ = OPERATIONS[operation]
+    fn = getattr(importlib.import_module(module), function)
+    client = default_client()
+    since = len(client.report()["failures"])
+
+    def run():
+        result = fn(**arguments)
+        client.print_report(since)
+        return result
+
+    result, output = capture_output(run)
+    table = result if hasattr(result, "colnames") else None
+    return {"output": output, "table": table_to_json(table) if table is not None else None}
+
+
+# send an operation to the service listening on path; raises OSError when no
+# service answers there
+def request(operation, arguments, path=None, timeout=None):
+    import http.client
+
+    arguments = {name: os.path.abspath(value) if name in PATH_ARGUMENTS and value is not None else value
+                 for name, value in arguments.items()}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        raise
+
+    connection = http.client.HTTPConnection("localhost", timeout=timeout)
+    connection.sock = sock
+    try:
+        connection.request("POST", f"/{operation}", json.dumps(arguments), {"Content-Type": "application/json"})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+# run fn(**arguments) in the service when one is listening, and here
+# otherwise. Prints what the operation printed and returns its table.
+def call_or_run(operation, fn, **arguments):
+    if os.environ.get("KCWI_NO_SERVICE", "") == "":
+        path = socket_path()
+        if os.path.exists(path):
+            try:
+                response = request(operation, arguments, path)
+            except OSError:
+                # stale socket of a service that is not running anymore
+                response = None
+            if response is not None:
+                if "error" in response:
+                    raise RuntimeError(f"kcwi_service: {response['error']}")
+                print(response["output"], end="")
+                return table_from_json(response["table"]) if response["table"] is not None else None
+    return fn(**arguments)
+
+
+class _Service:
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def status(self):
+        koa = default_client().report()
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "requests": self.requests,
+            "memory": default_cache().memory_usage(),
+            "koa": {"calls": koa["calls"], "retried": koa["retried"], "failures": len(koa["failures"])},
+        }
+
+
+# token: what requests have to send as "Authorization: Bearer <token>", None
+# to accept every request (on the Unix socket, which only the user can open)
+def _handler(service, verbose, token=None):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "kcwi_service"
+
+        # client_address is '' on a Unix socket
+        def address_string(self):
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+        def _reply(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self):
+            if token is None:
+                return True
+            sent = self.headers.get("Authorization", "")
+            return hmac.compare_digest(sent.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+
+        def _dispatch(self, path, arguments):
+            if not self._authorized():
+                return self._reply(401, {"error": "missing or wrong token"})
+            operation = path.strip("/")
+            if operation == "status":
+                return self._reply(200, service.status())
+            if operation not in OPERATIONS:
+                return self._reply(404, {"error": f"unknown operation '{operation}'"})
+            try:
+                arguments = convert_arguments(operation, arguments)
+            except (TypeError, ValueError) as e:
+                return self._reply(400, {"error": str(e)})
+
+            service.count()
+            try:
+                self._reply(200, run_operation(operation, arguments))
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            self._dispatch(url.path, dict(parse_qsl(url.query)))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                arguments = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                return self._reply(400, {"error": f"invalid JSON: {e}"})
+            self._dispatch(urlparse(self.path).path, arguments)
+
+    return Handler
+
+
+# load what every lookup needs before the first request
+def _warm_up():
+    from KCWI_scripts.standard_stars import load_catalog
+    from KCWI_scripts.sky_index import default_sky_index
+
+    load_catalog()
+    index = default_sky_index()
+    if index is not None:
+        index.frames()
+
+
+def serve(path=None, port=None, max_memory_mb=DEFAULT_MAX_MEMORY_MB, verbose=False):
+    import socketserver
+    from http.server import ThreadingHTTPServer
+
+    path = path or socket_path()
+    default_cache().memory_bytes = int(max_memory_mb * 1024**2)
+
+    if os.path.exists(path):
+        try:
+            request("status", {}, path, timeout=5)
+        except OSError:
+            os.remove(path)
+        else:
+            raise RuntimeError(f"a service is already listening on {path}")
+
+    _warm_up()
+    service = _Service()
+    handler = _handler(service, verbose)
+
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # the socket and the token are created only accessible by the user,
+    # there is no moment where someone else could open them
+    umask = os.umask(0o077)
+    try:
+        servers = [UnixServer(path, handler)]
+        if port:
+            token = secrets.token_urlsafe(32)
+            with open(token_path(path), "w") as f:
+                f.write(token)
+            servers.append(ThreadingHTTPServer(("127.0.0.1", port), _handler(service, verbose, token)))
+    finally:
+        os.umask(umask)
+
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"✅ kcwi_service listening on {path}" + (f" and http://127.0.0.1:{port}" if port else "")
+          + f" (pid {os.getpid()}, {max_memory_mb} MB of tables in memory).")
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.server_close()
+        for stale in (path, token_path(path)):
+            if os.path.exists(stale):
+                os.remove(stale)
+        print("kcwi_service stopped.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep KCWI metadata, catalogs and indexes in memory and answer lookups from the scripts.")
+    parser.add_argument('--socket', type=str, default=None, help="Unix socket to listen on (default: KCWI_SERVICE_SOCKET or <cache dir>/service.sock).")
+    parser.add_argument('--port', type=int, default=None, help="Also listen for HTTP on this localhost port (e.g. for a dashboard); requests need the token in <socket>.token.")
+    parser.add_argument('--max_memory_mb', type=float, default=DEFAULT_MAX_MEMORY_MB, help=f"Memory for parsed tables and the sky index, in MB (default {DEFAULT_MAX_MEMORY_MB}).")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+    parser.add_argument('--status', action='store_true', help="Print the status of the running service and exit.")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
+
+    args = parser.parse_args()
+
+    try:
+        with profiled(args.profile):
+            if args.status:
+                print(json.dumps(request("status", {}, args.socket, timeout=10), indent=2))
+            else:
+                serve(path=args.socket, port=args.port, max_memory_mb=args.max_memory_mb, verbose=args.verbose)
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import os
+import json
+import math
+import time
+import weakref
+import threading
+import numpy as np
+from KCWI_scripts.cache import default_cache, save_table, load_table
+from KCWI_scripts.compact_table import CompactTable, concatenate
+from KCWI_scripts.locking import file_lock
+from KCWI_scripts import trace
+
+# Local sky index of the frames returned by KOA cone searches.
+#
+# Every cone fetched from KOA is recorded as complete coverage (all frames in
+# it, for every night up to the moment it was fetched) until it expires after
+# the cache TTL. A cone search fully inside a recorded cone is answered from
+# the index with KD-trees on unit vectors, without asking KOA. The frames are
+# kept in <cache_dir>/sky_index as segments, each with its own KD-tree, and
+# the coverage in coverage.json; adding a cone writes only its new frames as a
+# segment and then the coverage, under one file lock, so no process sees
+# coverage for frames that aren't there. When the cache keeps tables in memory
+# (the service), the loaded frames and their KD-trees count against that
+# budget and are dropped with the least recently used tables.
+
+# cones are fetched from KOA with the radius rounded up to this step (arcsec),
+# so slightly different radii or nearby targets are answered locally next time
+FETCH_STEP_ARCSEC = 60
+
+# the frames are kept in segments frames.<n>.npz, numbered in the order they
+# were added; frames.npz, from before the index had segments, comes first
+SEGMENT_PREFIX, SEGMENT_SUFFIX = "frames.", ".npz"
+FRAMES_NAME = "frames.npz"
+COVERAGE_NAME = "coverage.json"
+
+# memory per frame besides its row: the unit vectors, the KD-tree's copy of
+# them and its index (64 bytes), and its koaid in the set of indexed koaids
+INDEX_BYTES_PER_FRAME = 160
+
+
+def unit_vectors(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def separation_arcsec(ra1, dec1, ra2, dec2):
+    v1, v2 = unit_vectors([ra1], [dec1])[0], unit_vectors([ra2], [dec2])[0]
+    return math.degrees(2 * math.asin(min(1.0, np.linalg.norm(v1 - v2) / 2))) * 3600
+
+
+# radius of the cone asked to KOA for a request of radius arcsec
+def fetch_radius(radius):
+    return max(FETCH_STEP_ARCSEC, math.ceil(radius / FETCH_STEP_ARCSEC) * FETCH_STEP_ARCSEC)
+
+
+class SkyIndex:
+    # memory: the MetadataCache whose in-memory tables the loaded frames are
+    # kept with, when it keeps any; otherwise they are kept until replaced
+    def __init__(self, index_dir, ttl, memory=None):
+        self.index_dir = index_dir
+        self.ttl = ttl
+        self.memory = memory
+        self.coverage_path = os.path.join(index_dir, COVERAGE_NAME)
+        self._lock = threading.Lock()
+        self._segments = None
+        self._trees = weakref.WeakKeyDictionary()  # segment -> its KD-tree
+        self.coverage = self._read_coverage()
+        if self.memory is not None:
+            self.memory._forget(self._memory_key())
+
+    def _read_coverage(self):
+        try:
+            with open(self.coverage_path) as f:
+                coverage = json.load(f)
+        except (OSError, ValueError):
+            return []
+        now = time.time()
+        return [cone for cone in coverage if cone["expires"] > now]
+
+    def _write_coverage(self):
+        tmp_path = f"{self.coverage_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.coverage, f)
+        os.replace(tmp_path, self.coverage_path)
+
+    def _memory_key(self):
+        return (os.path.join(self.index_dir, SEGMENT_PREFIX),)
+
+    def _bounded(self):
+        return self.memory is not None and self.memory.memory_bytes > 0
+
+    def _keep(self, segments):
+        if self._bounded():
+            self._segments = None
+            self.memory._remember(self._memory_key(), segments, 0, size=segments.nbytes())
+        else:
+            self._segments = segments
+
+    def _kept(self):
+        return self.memory._recall(self._memory_key()) if self._bounded() else self._segments
+
+    def _segment_names(self):
+        try:
+            names = os.listdir(self.index_dir)
+        except OSError:
+            return []
+        return sorted((name for name in names if _segment_number(name) is not None), key=_segment_number)
+
+    # segments (a new _Segments when None) brought up to date with the segment
+    # files; the index file lock must be held, as adds merge and remove them
+    def _refresh(self, segments=None):
+        segments = segments if segments is not None else _Segments()
+        names = self._segment_names()
+        if names == list(segments.tables):
+            return segments
+
+        tables = {}
+        for name in names:
+            table = segments.tables.get(name)
+            if table is None:
+                try:
+                    table = load_table(os.path.join(self.index_dir, name))
+                except (OSError, KeyError, ValueError):
+                    continue
+            tables[name] = table
+        # only another process merging segments removes any
+        if all(name in tables for name in segments.tables):
+            new = [table for name, table in tables.items() if name not in segments.tables]
+        else:
+            segments.koaids, new = set(), list(tables.values())
+        for table in new:
+            segments.koaids.update(_koaids(table))
+        segments.tables = tables
+        self._keep(segments)
+        return segments
+
+    def _loaded(self):
+        segments = self._kept()
+        if segments is None and os.path.isdir(self.index_dir):
+            with file_lock(self.index_dir):
+                segments = self._refresh()
+        return segments
+
+    # all the indexed frames, None when there are none yet
+    def frames(self):
+        with self._lock:
+            segments = self._loaded()
+        if segments is None or not segments.tables:
+            return None
+        return _stack(list(segments.tables.values()))
+
+    # the recorded cone that fully contains the requested one, if any
+    def covering_cone(self, ra, dec, radius):
+        now = time.time()
+        for cone in self.coverage:
+            if cone["expires"] > now and separation_arcsec(ra, dec, cone["ra"], cone["dec"]) + radius <= cone["radius"]:
+                return cone
+        return None
+
+    def covers(self, ra, dec, radius):
+        return self.covering_cone(ra, dec, radius) is not None
+
+    # indexed frames within radius arcsec of (ra, dec), in index order; every
+    # segment has its own KD-tree, so adding frames doesn't rebuild the others
+    def search(self, ra, dec, radius):
+        with self._lock, trace.span("sky_index.search"):
+            segments = self._loaded()
+            if segments is None or not segments.tables:
+                return None
+            center = unit_vectors([ra], [dec])[0]
+            chord = 2 * math.sin(math.radians(radius / 3600) / 2)
+            found = []
+            for table in segments.tables.values():
+                tree = self._trees.get(table)
+                if tree is None:
+                    from scipy.spatial import cKDTree
+                    tree = self._trees[table] = cKDTree(unit_vectors(table["ra"], table["dec"]))
+                idx = sorted(tree.query_ball_point(center, chord))
+                if idx:
+                    found.append(table[idx])
+        if not found:
+            return next(iter(segments.tables.values()))[[]]
+        return _stack(found)
+
+    # add the result of a KOA cone search and record its coverage, as of
+    # fetched_at (the time of the search, now by default). Only the frames not
+    # indexed yet are written, as a new segment; a frame's metadata doesn't
+    # change, so the rows already in the index are kept.
+    def add(self, ra, dec, radius, table, fetched_at=None):
+        os.makedirs(self.index_dir, exist_ok=True)
+        with self._lock, file_lock(self.index_dir):
+            # another process may have added frames since they were loaded
+            segments = self._refresh(self._kept())
+            if table is not None and len(table):
+                table = CompactTable.from_table(table)
+                koaids = _koaids(table)
+                _, first = np.unique(koaids, return_index=True)
+                new = np.zeros(len(table), dtype=bool)
+                new[first] = True
+                new &= ~_masked(table["ra"]) & ~_masked(table["dec"])
+                new &= np.array([koaid not in segments.koaids for koaid in koaids], dtype=bool)
+                if new.any():
+                    self._append(segments, table[new])
+
+            now = time.time()
+            fetched_at = now if fetched_at is None else fetched_at
+            self.coverage = [c for c in self._read_coverage() if c["expires"] > now]
+            self.coverage.append({"ra": ra, "dec": dec, "radius": radius, "fetched": fetched_at, "expires": fetched_at + self.ttl})
+            self._write_coverage()
+
+    # write table as the newest segment, then merge the newest segments while
+    # the one before is no larger: there are O(log n) segments and every frame
+    # is rewritten O(log n) times however small the adds are
+    def _append(self, segments, table):
+        names = list(segments.tables)
+        number = _segment_number(names[-1]) + 1 if names else 1
+        name = f"{SEGMENT_PREFIX}{number}{SEGMENT_SUFFIX}"
+        save_table(os.path.join(self.index_dir, name), table)
+        segments.tables[name] = table
+        segments.koaids.update(_koaids(table))
+
+        while len(segments.tables) > 1:
+            (older, older_table), (newer, newer_table) = list(segments.tables.items())[-2:]
+            if len(older_table) > len(newer_table):
+                break
+            number += 1
+            name = f"{SEGMENT_PREFIX}{number}{SEGMENT_SUFFIX}"
+            merged = _stack([older_table, newer_table])
+            # the merged segment is written before the two are removed, so a
+            # reader never misses frames
+            save_table(os.path.join(self.index_dir, name), merged)
+            for old in (older, newer):
+                del segments.tables[old]
+                os.remove(os.path.join(self.index_dir, old))
+            segments.tables[name] = merged
+        self._keep(segments)
+
+
+# the loaded segments, {file name: frames} in the order they were added, and
+# the koaids in any of them
+class _Segments:
+    def __init__(self):
+        self.tables = {}
+        self.koaids = set()
+
+    def nbytes(self):
+        frames = sum(len(table) for table in self.tables.values())
+        return sum(table.nbytes for table in self.tables.values()) + INDEX_BYTES_PER_FRAME * frames
+
+
+# number of a segment file, None for other files; frames.npz, from before the
+# index had segments, is the first
+def _segment_number(name):
+    if name == FRAMES_NAME:
+        return 0
+    if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+        return None
+    number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+    return int(number) if number.isdigit() else None
+
+
+def _koaids(table):
+    return np.asarray(table["koaid"]).astype(str)
+
+
+# one table from segments, joining their columns if they differ
+def _stack(tables):
+    if len({tuple(table.colnames) for table in tables}) == 1:
+        return concatenate(tables)
+    from astropy.table import vstack
+    return CompactTable.from_table(vstack([table.to_table() for table in tables], join_type="outer",
+                                          metadata_conflicts="silent"))
+
+
+def _masked(col):
+    mask = getattr(col, "mask", None)
+    if mask is None:
+        return np.zeros(len(col), dtype=bool)
+    return np.asarray(mask)
+
+
+_default_index = None
+
+
+# process-wide index in the metadata cache directory, None when the cache is disabled
+def default_sky_index():
+    global _default_index
+    cache = default_cache()
+    if not cache.enabled:
+        return None
+    if _default_index is None:
+        _default_index = SkyIndex(os.path.join(cache.cache_dir, "sky_index"), cache.ttl, memory=cache)
+    return _default_index
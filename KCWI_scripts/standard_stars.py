@@ -0,0 +1,115 @@
+import os
+import csv
+import hashlib
+import threading
+import numpy as np
+from importlib.resources import files
+from KCWI_scripts.cache import default_cache
+from KCWI_scripts import trace
+
+# Standard-star catalogs (Name,RA,DEC csv files) parsed into a single SkyCoord.
+#
+# RA/DEC may be sexagesimal ('01 37 59.34', '-04 59 44.3', RA in hours) or
+# decimal degrees. The parsed degrees are kept in memory for the life of the
+# process and in a binary .npz sidecar in the metadata cache directory, keyed
+# by the sha1 of the csv so an edited catalog is parsed again.
+
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def default_catalog_path():
+    return str(files("KCWI_scripts").joinpath("data", "standard_stars.csv"))
+
+
+# load standard stars from csv file as (Name, RA, DEC) string tuples
+def load_stars(path=None):
+    data_file = path or default_catalog_path()
+    stars = []
+    with open(data_file, mode="r") as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            if row:
+                stars.append((row[0].strip(), row[1].strip(), row[2].strip()))  # (Name, RA, DEC)
+
+    return stars
+
+
+# vectorized sexagesimal/decimal parse, returns degrees
+def parse_angles(values, hours):
+    values = np.asarray(values, dtype=str)
+    degrees = np.empty(len(values))
+    if len(values) == 0:
+        return degrees
+
+    parts = np.char.split(np.char.replace(np.char.strip(values), ':', ' '))
+    sexagesimal = np.array([len(p) > 1 for p in parts], dtype=bool)
+
+    if np.any(~sexagesimal):
+        degrees[~sexagesimal] = values[~sexagesimal].astype(float)
+
+    if np.any(sexagesimal):
+        fields = np.array([(p + ['0', '0'])[:3] for p in parts[sexagesimal]], dtype=float)
+        sign = np.where(np.char.startswith(values[sexagesimal], '-'), -1.0, 1.0)
+        value = np.abs(fields[:, 0]) + fields[:, 1] / 60 + fields[:, 2] / 3600
+        degrees[sexagesimal] = sign * value * (15.0 if hours else 1.0)
+
+    return degrees
+
+
+def _sidecar_path(digest):
+    return os.path.join(default_cache().cache_dir, "catalogs", f"{digest}.npz")
+
+
+def _read_sidecar(digest):
+    try:
+        with np.load(_sidecar_path(digest), allow_pickle=False) as data:
+            return data["names"], data["ra"], data["dec"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_sidecar(digest, names, ra, dec):
+    path = _sidecar_path(digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, names=names, ra=ra, dec=dec)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+# Return (names, SkyCoord) for a catalog, the package catalog by default.
+# Parsed once per process and reused, so the crossmatch KD-tree cached on the
+# SkyCoord is also reused.
+def load_catalog(path=None):
+    path = os.path.abspath(path or default_catalog_path())
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+
+    with _lock:
+        if key in _catalogs:
+            return _catalogs[key]
+
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+
+        cached = _read_sidecar(digest)
+        if cached is not None:
+            names, ra, dec = cached
+        else:
+            stars = load_stars(path)
+            names = np.array([name for name, _, _ in stars], dtype=str)
+            ra = parse_angles([ra for _, ra, _ in stars], hours=True)
+            dec = parse_angles([dec for _, _, dec in stars], hours=False)
+            _write_sidecar(digest, names, ra, dec)
+
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+        with trace.span("coords", n=len(names)):
+            catalog = ([str(name) for name in names], SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame='icrs'))
+        _catalogs[key] = catalog
+        return catalog
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from KCWI_scripts.metadata import fetch_range
+from KCWI_scripts.downloader import download_table
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts.trace import profiled
+
+# Incremental mirror of the KCWI metadata (and optionally the frames).
+#
+# <mirror_dir>/sync_state.json keeps the watermark, the last night up to which
+# every night is synced, and <mirror_dir>/state/<date>.json the koaids seen for
+# each night. A run fetches the nights after the watermark plus the last
+# recheck_days nights before it (KOA may still add or update frames there), one
+# range query per chunk of nights, and downloads only koaids not held yet. The
+# state is written after every night, so an interrupted run resumes where it
+# stopped.
+
+STATE_NAME = 'sync_state.json'
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _dates(start, end):
+    import pandas as pd
+    return [d.strftime('%Y-%m-%d') for d in pd.date_range(start, end)]
+
+
+def _shift(date, days):
+    import pandas as pd
+    return (pd.to_datetime(date) + pd.Timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+class SyncState:
+    def __init__(self, mirror_dir):
+        self.path = os.path.join(mirror_dir, STATE_NAME)
+        self.nights_dir = os.path.join(mirror_dir, 'state')
+        os.makedirs(self.nights_dir, exist_ok=True)
+        self.watermark = _read_json(self.path, {}).get('watermark')
+
+    def night(self, date):
+        return _read_json(os.path.join(self.nights_dir, f'{date}.json'), None)
+
+    def save_night(self, date, night):
+        _write_json(os.path.join(self.nights_dir, f'{date}.json'), night)
+
+    def advance(self, date):
+        if self.watermark is None or date > self.watermark:
+            self.watermark = date
+            _write_json(self.path, {'watermark': date, 'updated': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    # nights with frames still missing from an earlier run
+    def pending_frames(self):
+        pending = []
+        for name in sorted(os.listdir(self.nights_dir)):
+            if name.endswith('.json'):
+                night = _read_json(os.path.join(self.nights_dir, name), {})
+                if night.get('frames') is False:
+                    pending.append(name[:-5])
+        return pending
+
+
+# nights a run has to fetch: everything after the watermark (or from start on
+# the first run) up to end, the recheck window before the watermark, and
+# nights with frames left to download
+def nights_to_sync(state, start, end, recheck_days, frames=False):
+    if state.watermark is None:
+        if start is None:
+            raise ValueError("the first sync needs a start date")
+        nights = set(_dates(start, end))
+    else:
+        nights = set(_dates(_shift(state.watermark, 1), end)) if state.watermark < end else set()
+        nights.update(_dates(_shift(state.watermark, 1 - recheck_days), state.watermark) if recheck_days > 0 else [])
+        if start is not None:
+            nights = {d for d in nights if d >= start}
+    if frames:
+        nights.update(state.pending_frames())
+    return sorted(nights)
+
+
+def _chunks(nights, chunk_days):
+    import pandas as pd
+    chunk = []
+    for night in nights:
+        if chunk and (len(chunk) >= chunk_days or pd.to_datetime(night) - pd.to_datetime(chunk[-1]) > pd.Timedelta(days=1)):
+            yield chunk
+            chunk = []
+        chunk.append(night)
+    if chunk:
+        yield chunk
+
+
+def sync_archive(mirror_dir='.', start=None, end=None, recheck_days=3, frames=False, chunk_days=30, max_workers=4):
+    metadata_dir = os.path.join(mirror_dir, 'metadata')
+    frames_dir = os.path.join(mirror_dir, 'frames')
+    os.makedirs(metadata_dir, exist_ok=True)
+
+    state = SyncState(mirror_dir)
+    end = end or time.strftime('%Y-%m-%d', time.gmtime())
+    nights = nights_to_sync(state, start, end, recheck_days, frames)
+
+    if not nights:
+        print(f"✅ Mirror is up to date (watermark {state.watermark}).")
+        return state
+
+    print(f"Syncing {len(nights)} nights ({nights[0]} to {nights[-1]}), watermark {state.watermark}...")
+    changed = []
+
+    for chunk in _chunks(nights, chunk_days):
+        try:
+            tables = fetch_range(chunk, metadata_dir, refresh=True)
+        except Exception as e:
+            print(f"❌ Error querying metadata for {chunk[0]}/{chunk[-1]}, stopping (run again to resume): {e}")
+            break
+
+        for night in chunk:
+            table = tables.get(night)
+            koaids = sorted(np.asarray(table['koaid']).astype(str)) if table is not None and len(table) else []
+            digest = hashlib.sha1('\n'.join(koaids).encode()).hexdigest()
+            previous = state.night(night) or {}
+
+            if previous.get('digest') != digest:
+                changed.append(night)
+
+            frames_done = previous.get('frames')
+            if frames and koaids and (frames_done is not True or previous.get('digest') != digest):
+                # only koaids not held yet (everything again after a failed run)
+                held = set(previous.get('koaids', [])) if frames_done is True else set()
+                new = np.array([k not in held for k in np.asarray(table['koaid']).astype(str)], dtype=bool)
+                report = download_table(table[new], os.path.join(frames_dir, night), max_workers=max_workers, calibfile=False)
+                frames_done = not report['failed']
+            elif frames and not koaids:
+                frames_done = True
+
+            state.save_night(night, {
+                'koaids': koaids,
+                'digest': digest,
+                'frames': frames_done if frames else previous.get('frames'),
+                'synced': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+            state.advance(night)
+
+    print(f"\n📊 {len(changed)} nights new or changed: {', '.join(changed) if changed else 'none'}.")
+    print(f"📝 Watermark: {state.watermark}")
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a local mirror of KCWI metadata (and frames) up to date.")
+    parser.add_argument('--mirror_dir', type=str, default='.', help="Directory of the mirror (default: current directory).")
+    parser.add_argument('--start', type=str, default=None, help="First night 'YYYY-MM-DD' (needed for the first sync).")
+    parser.add_argument('--end', type=str, default=None, help="Last night 'YYYY-MM-DD' (default: today, UT).")
+    parser.add_argument('--recheck_days', type=int, default=3, help="Nights before the watermark fetched again, KOA may still update them (default 3).")
+    parser.add_argument('--frames', action='store_true', help="Download the frames too (only the ones not held yet).")
+    parser.add_argument('--chunk_days', type=int, default=30, help="Nights fetched with one archive query (default 30).")
+    parser.add_argument('--max_workers', type=int, default=4, help="Number of files downloaded at the same time (default 4).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
+
+    args = parser.parse_args()
+
+    try:
+        with profiled(args.profile):
+            sync_archive(mirror_dir = args.mirror_dir, start = args.start, end = args.end, recheck_days = args.recheck_days,
+                         frames = args.frames, chunk_days = args.chunk_days, max_workers = args.max_workers)
+            default_client().print_report()
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Tracing of where a run spends its time (--profile on every script).
+#
+# span(name, **args) times a block (KOA queries, downloads, IPAC parsing,
+# coordinate building, crossmatches, links...), count() adds to a counter
+# (bytes, cache hits and misses) and gauge() records a level over time (queue
+# depth of the thread pools). Nothing is recorded unless start() was called:
+# span() then returns one shared no-op context, so the instrumentation costs a
+# function call and a flag check.
+#
+# export() writes Chrome trace format (open it in chrome://tracing or
+# https://ui.perfetto.dev) with a "summary" of per-stage and per-night timings
+# and the counters next to the events.
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+_counters = {}
+_threads = {}
+_started = 0
+_NULL = nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def start():
+    global _enabled, _started
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _threads.clear()
+        _started = time.perf_counter_ns()
+        _enabled = True
+
+
+def stop():
+    global _enabled
+    _enabled = False
+
+
+def _now_us():
+    return (time.perf_counter_ns() - _started) / 1e3
+
+
+def _tid():
+    ident = threading.get_ident()
+    tid = _threads.get(ident)
+    if tid is None:
+        with _lock:
+            tid = _threads.setdefault(ident, (len(_threads) + 1, threading.current_thread().name))
+    return tid[0]
+
+
+class _Span:
+    __slots__ = ("name", "args", "begin")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = _now_us()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        event = {"name": self.name, "cat": self.name.split(".")[0], "ph": "X", "ts": self.begin,
+                 "dur": end - self.begin, "pid": os.getpid(), "tid": _tid(), "args": self.args}
+        with _lock:
+            _events.append(event)
+        return False
+
+
+# time the block as a stage; args (e.g. night=..., path=...) go to the trace
+def span(name, **args):
+    if not _enabled:
+        return _NULL
+    return _Span(name, args)
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    if not _enabled:
+        return
+    event = {"name": name, "ph": "C", "ts": _now_us(), "pid": os.getpid(), "args": {"value": value}}
+    with _lock:
+        _events.append(event)
+
+
+# per-stage and per-night totals (seconds), counters and the peak of every gauge
+def summary():
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+
+    stages, nights, gauges = {}, {}, {}
+    for event in events:
+        if event["ph"] == "C":
+            gauges[event["name"]] = max(gauges.get(event["name"], 0), event["args"]["value"])
+            continue
+        seconds = event["dur"] / 1e6
+        stage = stages.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+        stage["count"] += 1
+        stage["total"] += seconds
+        stage["max"] = max(stage["max"], seconds)
+        night = event["args"].get("night")
+        if night:
+            per_night = nights.setdefault(str(night), {})
+            per_night[event["name"]] = per_night.get(event["name"], 0.0) + seconds
+
+    return {
+        "wall": _now_us() / 1e6,
+        "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total"])),
+        "nights": dict(sorted(nights.items())),
+        "counters": counters,
+        "peaks": gauges,
+    }
+
+
+def export(path, report=None):
+    report = report or summary()
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+             for tid, name in threads.values()]
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": names + events, "displayTimeUnit": "ms", "summary": report}, f)
+    os.replace(tmp_path, path)
+
+
+def print_summary(report, top=10):
+    print(f"\n⏱️ Profile ({report['wall']:.2f} s):")
+    for name, stage in list(report["stages"].items())[:top]:
+        print(f"   {name:24s} {stage['count']:6d} x  {stage['total']:8.3f} s total  {stage['max']:7.3f} s max")
+    for name, value in sorted(report["counters"].items()):
+        print(f"   {name:24s} {value}")
+    for name, value in sorted(report["peaks"].items()):
+        print(f"   {name:24s} peak {value}")
+
+
+# trace the block when path is given and write the trace there at the end
+@contextmanager
+def profiled(path):
+    if not path:
+        yield
+        return
+
+    start()
+    try:
+        yield
+    finally:
+        stop()
+        report = summary()
+        export(path, report)
+        print_summary(report)
+        print(f"📝 Profile saved to: {path}")
@@ -0,0 +1,171 @@
+import os
+import mmap
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from KCWI_scripts.cache import read_table
+from KCWI_scripts.fits_header import scan_header, data_size, FITS_BLOCK
+from KCWI_scripts.frame_store import default_store
+from KCWI_scripts.downloader import DownloadEngine
+from KCWI_scripts.koa_client import default_client
+from KCWI_scripts import trace
+
+# Integrity check of downloaded frames that only reads headers: the size must
+# be whole FITS blocks, every HDU header must parse (through mmap, the pixel
+# data is never read) and its data must fit in the file, and KOAID of the
+# primary header must agree with the metadata table. Only those faults make a
+# file bad (and downloaded again); an IMTYPE that differs from the metadata's
+# koaimtyp is a warning, the archive would send the same file.
+
+
+# (fault, warning) of one file: the fault that makes it bad, None if it looks
+# complete and valid, and a warning about a valid file, None if there is none
+def check_frame(path, koaid=None, imtyp=None):
+    size = os.path.getsize(path)
+    if size == 0:
+        return "empty file", None
+    if size % FITS_BLOCK:
+        return f"size {size} is not a multiple of {FITS_BLOCK} bytes (truncated?)", None
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:9] != b"SIMPLE  =":
+            return "not a FITS file", None
+
+        offset, primary = 0, None
+        while offset < size:
+            if primary is not None and m[offset:offset + 8] != b"XTENSION":
+                break
+            try:
+                header, offset = scan_header(m, offset)
+                offset += data_size(header) + (-data_size(header) % FITS_BLOCK)
+            except (ValueError, KeyError, TypeError) as e:
+                return f"bad header: {e}", None
+            if primary is None:
+                primary = header
+            if offset > size:
+                return f"data ends at byte {offset}, file has {size} (truncated)", None
+
+    if koaid is not None and primary.get("KOAID") not in (None, koaid):
+        return f"KOAID {primary['KOAID']} does not match {koaid}", None
+    if imtyp and imtyp.strip().upper() not in ("", "UNDEFINED") and primary.get("IMTYPE") \
+            and str(primary["IMTYPE"]).strip().upper() != imtyp.strip().upper():
+        return None, f"IMTYPE {primary['IMTYPE']} does not match the metadata ({imtyp})"
+    return None, None
+
+
+def _check(args):
+    path, koaid, imtyp = args
+    try:
+        return (os.path.basename(path),) + check_frame(path, koaid, imtyp)
+    except Exception as e:
+        return os.path.basename(path), f"unreadable: {e}", None
+
+
+# {koaid: koaimtyp} of a metadata table
+def expected_types(table):
+    if table is None or 'koaimtyp' not in table.colnames:
+        return {}
+    return dict(zip(np.asarray(table['koaid']).astype(str), np.asarray(table['koaimtyp']).astype(str)))
+
+
+# check every .fits file of the directories over a process pool;
+# returns {file name: fault} of the bad files (warnings are only printed)
+def verify_directory(directories, table=None, max_workers=4, verbose=True):
+    if isinstance(directories, str):
+        directories = [directories]
+    types = expected_types(table)
+
+    jobs = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".fits"):
+                jobs.append((os.path.join(directory, name), name, types.get(name)))
+
+    bad, warned = {}, 0
+    if not jobs:
+        return bad
+
+    with trace.span("verify", files=len(jobs)), ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for name, fault, warning in executor.map(_check, jobs, chunksize=max(1, len(jobs) // (4 * max_workers))):
+            if fault is not None:
+                bad[name] = fault
+                if verbose:
+                    print(f"❌ {name}: {fault}")
+            elif warning is not None:
+                warned += 1
+                if verbose:
+                    print(f"⚠️ {name}: {warning}")
+
+    if verbose:
+        print(f"\n🔍 {len(jobs)} files verified, {len(bad)} bad" + (f", {warned} with warnings." if warned else "."))
+    return bad
+
+
+# verify, then remove and download again the bad files of a metadata table
+# (columns koaid and filehand) once; returns the files still bad afterwards
+def verify_and_repair(table, outdir, calib_dir=None, max_workers=4, download_workers=4):
+    directories = [outdir] + ([calib_dir] if calib_dir and calib_dir != outdir else [])
+    bad = verify_directory(directories, table, max_workers=max_workers)
+    if not bad:
+        return bad
+
+    store = default_store()
+    filehands = {}
+    if table is not None and 'filehand' in table.colnames:
+        filehands.update(zip(np.asarray(table['koaid']).astype(str), np.asarray(table['filehand']).astype(str)))
+    science = set(filehands)
+    if store is not None:
+        # companion calibrations are not in the night table
+        for entry in list(store.index.values()):
+            filehands.update((row['koaid'], row['filehand']) for row in entry.get('companions') or [])
+
+    print(f"📥 Downloading {len(bad)} bad files again...")
+    with DownloadEngine(outdir, max_workers=download_workers, calib_dir=calib_dir, store=store, verbose=False) as engine:
+        for koaid in bad:
+            if koaid not in filehands:
+                print(f"⚠️ No file handle for {koaid}, it can't be downloaded again.")
+                continue
+            for directory in directories:
+                path = os.path.join(directory, koaid)
+                if os.path.lexists(path):
+                    os.remove(path)
+                    engine.manifest.pop(koaid, None)
+            if store is not None:
+                store.discard(koaid)
+            engine.submit(koaid, filehands[koaid], calib=koaid not in science)
+
+    return verify_directory(directories, table, max_workers=max_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that downloaded KCWI FITS files are complete and match their metadata, reading only the headers.")
+    parser.add_argument('directory', type=str, nargs='+', help="Directories with the FITS files.")
+    parser.add_argument('--metadata_file', type=str, default=None, help="Metadata table to cross-check KOAID (and IMTYPE, with a warning) against, and to download bad files again.")
+    parser.add_argument('--redownload', action='store_true', help="Download the bad files again (needs --metadata_file).")
+    parser.add_argument('--max_workers', type=int, default=4, help="Number of processes checking files (default 4).")
+    parser.add_argument('--profile', type=str, default=None, help="Write a timing trace of the run to this JSON file (Chrome trace format).")
+    args = parser.parse_args()
+
+    try:
+        with trace.profiled(args.profile):
+            table = read_table(args.metadata_file, columns=['koaid', 'koaimtyp', 'filehand']) if args.metadata_file else None
+            if args.redownload:
+                if table is None:
+                    parser.error("--redownload needs --metadata_file")
+                bad = verify_and_repair(table, args.directory[0], calib_dir=args.directory[1] if len(args.directory) > 1 else None,
+                                        max_workers = args.max_workers)
+            else:
+                bad = verify_directory(args.directory, table, max_workers = args.max_workers)
+
+            if bad:
+                print(f"⚠️ {len(bad)} files are still bad: {', '.join(sorted(bad))}")
+            else:
+                print("✅ All files are valid.")
+            default_client().print_report()
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
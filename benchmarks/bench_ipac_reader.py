@@ -0,0 +1,57 @@
+import argparse
+import time
+import numpy as np
+from astropy.table import Table
+from KCWI_scripts.ipac_reader import read_ipac
+
+# Compare KCWI_scripts.ipac_reader against astropy's ASCII IPAC reader on
+# recorded KOA metadata files (koa_metadata_{date}.tbl, position_search_*.tbl).
+#
+#   python benchmarks/bench_ipac_reader.py downloads/koa_metadata_*.tbl
+
+PROJECTED_COLUMNS = ['koaid', 'koaimtyp', 'ra', 'dec', 'ofname']
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def same_column(a, b):
+    a_mask = np.ma.getmaskarray(a)
+    b_mask = np.ma.getmaskarray(b)
+    if not np.array_equal(a_mask, b_mask):
+        return False
+    return np.array_equal(np.asarray(a)[~a_mask], np.asarray(b)[~b_mask])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fast IPAC reader against astropy's reader.")
+    parser.add_argument('files', nargs='+', help="Recorded KOA metadata files (IPAC format).")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of repetitions, the best time is reported (default 5).")
+    args = parser.parse_args()
+
+    print(f"{'file':40s} {'rows':>6s} {'cols':>5s} {'astropy':>9s} {'fast':>9s} {'projected':>9s} {'speedup':>8s}")
+    for path in args.files:
+        reference = Table.read(path, format='ascii.ipac')
+        fast = read_ipac(path)
+
+        for name in reference.colnames:
+            if not same_column(reference[name], fast[name]):
+                print(f"⚠️ {path}: column {name} differs from astropy's reader")
+
+        columns = [c for c in PROJECTED_COLUMNS if c in reference.colnames]
+        t_astropy = best_time(lambda: Table.read(path, format='ascii.ipac'), args.repeat)
+        t_fast = best_time(lambda: read_ipac(path), args.repeat)
+        t_projected = best_time(lambda: read_ipac(path, columns), args.repeat)
+
+        print(f"{path[-40:]:40s} {len(reference):6d} {len(reference.colnames):5d} "
+              f"{t_astropy * 1e3:7.1f}ms {t_fast * 1e3:7.1f}ms {t_projected * 1e3:7.1f}ms {t_astropy / t_projected:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
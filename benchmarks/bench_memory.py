@@ -0,0 +1,86 @@
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from KCWI_scripts.ipac_reader import read_metadata
+from KCWI_scripts.inventory import NightInventory
+from synthetic_archive import SyntheticArchive
+
+# Memory of a semester of KCWI metadata held in one process, as astropy Tables
+# (read_metadata) and as CompactTables (read_compact, what the cache and the
+# lookups use). Every night of a SyntheticArchive is written as the IPAC file
+# KOA would return, then all of them are read in each representation and kept;
+# tracemalloc gives the memory they retain and the peak while reading. The
+# inventory of every night (what the calibration finders compute) is timed on
+# both, and has to come out the same.
+#
+#   PYTHONPATH=. python benchmarks/bench_memory.py [--start 2024-02-01] [--nights 182] [--extra_columns 90]
+
+
+# tracemalloc slows reading down, so the time is taken on a second read
+def load_all(paths, compact):
+    gc.collect()
+    tracemalloc.start()
+    tables = [read_metadata(path, compact=compact) for path in paths]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for path in paths:
+        read_metadata(path, compact=compact)
+    seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    inventories = [NightInventory(table).types() for table in tables]
+    inventory_seconds = time.perf_counter() - start
+    return tables, inventories, {"retained_mb": retained / 1024**2, "peak_mb": peak / 1024**2,
+                                 "read_seconds": seconds, "inventory_seconds": inventory_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory of a semester of metadata as Tables and as CompactTables.")
+    parser.add_argument('--start', type=str, default='2024-02-01', help="First night (default 2024-02-01, semester 2024A).")
+    parser.add_argument('--nights', type=int, default=182, help="Number of nights (default 182).")
+    parser.add_argument('--extra_columns', type=int, default=90, help="Filler columns besides the ones the scripts use (default 90).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    archive = SyntheticArchive(start=args.start, nights=args.nights, seed=args.seed, extra_columns=args.extra_columns).generate()
+    with tempfile.TemporaryDirectory(prefix="kcwi_memory_") as directory:
+        paths = []
+        for date in archive.dates:
+            text = archive.ipac_date(date)
+            if text is not None:
+                paths.append(os.path.join(directory, f"koa_metadata_{date}.tbl"))
+                with open(paths[-1], "w") as f:
+                    f.write(text)
+
+        tables, table_inventories, table_result = load_all(paths, compact=False)
+        rows, columns = sum(len(t) for t in tables), len(tables[0].colnames)
+        del tables
+        compact, compact_inventories, compact_result = load_all(paths, compact=True)
+
+    if table_inventories != compact_inventories:
+        print("❌ The inventories of the Tables and the CompactTables differ.")
+        return 1
+
+    print(f"{len(paths)} nights, {rows} frames, {columns} columns")
+    print(f"{'':14s} {'retained MB':>12s} {'peak MB':>9s} {'read s':>8s} {'inventory s':>12s}")
+    for name, result in (("Table", table_result), ("CompactTable", compact_result)):
+        print(f"{name:14s} {result['retained_mb']:12.1f} {result['peak_mb']:9.1f} {result['read_seconds']:8.2f} {result['inventory_seconds']:12.2f}")
+    print(f"\nCompactTables retain {table_result['retained_mb'] / compact_result['retained_mb']:.1f}x less memory.")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"nights": len(paths), "frames": rows, "columns": columns,
+                       "table": table_result, "compact": compact_result}, f, indent=2)
+        print(f"📝 Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import argparse
+import time
+import numpy as np
+from astropy.coordinates import SkyCoord, match_coordinates_sky
+from astropy.table import Table
+import astropy.units as u
+import KCWI_scripts.standard_stars as standard_stars
+from KCWI_scripts.crossmatch import match_standard_stars
+
+# Startup-to-first-match latency of the standard-star lookup:
+#   before: read the csv, build one SkyCoord per star from sexagesimal strings
+#           and call match_coordinates_sky once per star
+#   cold:   load_catalog() parsing the csv (no sidecar, empty process cache)
+#   sidecar: load_catalog() from the binary sidecar
+#   warm:   load_catalog() from the in-process cache
+# each followed by one night's crossmatch.
+#
+#   python benchmarks/bench_standard_stars.py [--metadata koa_metadata_2020-05-16.tbl]
+
+
+def synthetic_night(nframes=300):
+    rng = np.random.default_rng(0)
+    return Table({
+        'koaid': [f'KB.20200516.{i:05d}.fits' for i in range(nframes)],
+        'ra': rng.uniform(0, 360, nframes),
+        'dec': rng.uniform(-30, 60, nframes),
+    })
+
+
+def before(table, tolerance_arcsec):
+    stars = standard_stars.load_stars()
+    star_skycoords = [(name, SkyCoord(ra, dec, frame='icrs', unit=(u.hourangle, u.deg))) for name, ra, dec in stars]
+    ra_dec_coords = SkyCoord(ra=table['ra'] * u.deg, dec=table['dec'] * u.deg)
+    for name, coord in star_skycoords:
+        idx, sep, _ = match_coordinates_sky(coord, ra_dec_coords)
+        if sep.arcsecond <= tolerance_arcsec:
+            break
+
+
+def after(table, tolerance_arcsec):
+    names, coords = standard_stars.load_catalog()
+    match_standard_stars(coords, table, tolerance_arcsec)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup-to-first-match latency of the standard-star catalog.")
+    parser.add_argument('--metadata', type=str, default=None, help="Recorded KOA metadata file to match against (default: 300 random frames).")
+    parser.add_argument('--tolerance_arcsec', type=float, default=5)
+    args = parser.parse_args()
+
+    table = Table.read(args.metadata, format='ascii.ipac') if args.metadata else synthetic_night()
+
+    # run once to write the sidecar and import the matching code, then time each path
+    after(table, args.tolerance_arcsec)
+    standard_stars._catalogs.clear()
+    sidecar = timed(after, table, args.tolerance_arcsec)
+    warm = timed(after, table, args.tolerance_arcsec)
+
+    standard_stars._catalogs.clear()
+    real_read_sidecar = standard_stars._read_sidecar
+    standard_stars._read_sidecar = lambda digest: None
+    cold = timed(after, table, args.tolerance_arcsec)
+    standard_stars._read_sidecar = real_read_sidecar
+
+    old = timed(before, table, args.tolerance_arcsec)
+
+    print(f"before (per-star SkyCoord + match): {old * 1e3:8.1f} ms")
+    print(f"after, cold (csv parse):            {cold * 1e3:8.1f} ms")
+    print(f"after, binary sidecar:              {sidecar * 1e3:8.1f} ms")
+    print(f"after, in-process cache:            {warm * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import json
+import time
+import random
+import threading
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Offline stand-in for KOA, serving a SyntheticArchive (synthetic_archive.py).
+#
+# FakeKoa has the query_date/query_position interface of pykoa's Koa (it is
+# passed to KoaClient(koa=...)) and writes IPAC tables as pykoa does, or prints
+# an "Error: ..." line and writes nothing. Its getkoa_url/caliblist_url point to
+# a FakeKoaServer on localhost, which serves the FITS files (with Range
+# requests) and the calibration lists the downloads ask for. Latency, error
+# rate and bandwidth are configurable; every call and byte is counted.
+#
+#   archive = SyntheticArchive(nights=30)
+#   with FakeKoaServer(archive, bandwidth_mbps=50) as server:
+#       koa = FakeKoa(archive, server=server, latency=0.2)
+#       koa_client._default_client = KoaClient(koa=koa)
+
+
+class _Faults:
+    def __init__(self, latency, error_rate, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # wait the latency (+-25%), True when this call should fail
+    def next(self):
+        with self._lock:
+            jitter = self._random.uniform(0.75, 1.25)
+            failed = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency * jitter)
+        return failed
+
+
+class FakeKoa:
+    def __init__(self, archive, server=None, latency=0.0, error_rate=0.0, seed=0):
+        self.archive = archive
+        self.faults = _Faults(latency, error_rate, seed)
+        self.calls = {"query_date": 0, "query_position": 0, "errors": 0}
+        self._lock = threading.Lock()
+        if server is not None:
+            self.getkoa_url = f"{server.url}/getKOA?"
+            self.caliblist_url = f"{server.url}/getCaliblist?"
+
+    def _count(self, name, failed):
+        with self._lock:
+            self.calls[name] += 1
+            self.calls["errors"] += failed
+
+    def _write(self, text, outpath):
+        # pykoa writes no file when nothing matches
+        if text is not None:
+            with open(outpath, "w") as f:
+                f.write(text)
+
+    def query_date(self, instrument, date, outpath, overwrite=False, format="ipac", **kwargs):
+        failed = self.faults.next()
+        self._count("query_date", failed)
+        if failed:
+            print("Error: [Server error]: query failed (injected)")
+            return
+        self._write(self.archive.ipac_date(date), outpath)
+
+    # pos is 'circle ra dec radius_deg'
+    def query_position(self, instrument, pos, outpath, overwrite=False, format="ipac", **kwargs):
+        failed = self.faults.next()
+        self._count("query_position", failed)
+        if failed:
+            print("Error: [Server error]: query failed (injected)")
+            return
+        shape, ra, dec, radius = pos.split()
+        if shape != "circle":
+            print(f"Error: unsupported position shape {shape}")
+            return
+        self._write(self.archive.ipac_cone(float(ra), float(dec), float(radius)), outpath)
+
+    def report(self):
+        with self._lock:
+            return dict(self.calls)
+
+
+class FakeKoaServer:
+    def __init__(self, archive, latency=0.0, error_rate=0.0, bandwidth_mbps=None, seed=0):
+        self.archive = archive
+        self.faults = _Faults(latency, error_rate, seed)
+        self.bandwidth = bandwidth_mbps * 1e6 / 8 if bandwidth_mbps else None
+        self.requests = {"getKOA": 0, "getCaliblist": 0, "errors": 0}
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, name, failed, nbytes=0):
+        with self._lock:
+            self.requests[name] += 1
+            self.requests["errors"] += failed
+            self.bytes += nbytes
+
+    def report(self):
+        with self._lock:
+            return dict(self.requests, bytes=self.bytes)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+
+                chunk = 64 * 1024
+                for start in range(0, len(body), chunk):
+                    self.wfile.write(body[start:start + chunk])
+                    if server.bandwidth:
+                        time.sleep(min(chunk, len(body) - start) / server.bandwidth)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                name = url.path.strip("/")
+                query = dict(parse_qsl(url.query))
+                if name not in ("getKOA", "getCaliblist"):
+                    return self._send(404, b"not found", "text/plain")
+
+                failed = server.faults.next()
+                if failed:
+                    server._count(name, True)
+                    return self._send(503, b"service unavailable (injected)", "text/plain")
+
+                if name == "getCaliblist":
+                    body = json.dumps({"table": server.archive.companions(query["koaid"])}).encode("utf-8")
+                    server._count(name, False)
+                    return self._send(200, body, "application/json")
+
+                koaid = query.get("filehand", "").rsplit("/", 1)[-1]
+                try:
+                    data = server.archive.fits_bytes(koaid)
+                except (KeyError, IndexError, ValueError):
+                    body = json.dumps({"status": "error", "msg": f"{koaid} not found"}).encode("utf-8")
+                    return self._send(200, body, "application/json")
+
+                offset = 0
+                if self.headers.get("Range", "").startswith("bytes="):
+                    offset = int(self.headers["Range"][len("bytes="):].split("-")[0] or 0)
+                if offset >= len(data) and offset:
+                    server._count(name, False)
+                    return self._send(416, b"", "text/plain")
+
+                server._count(name, False, len(data) - offset)
+                if offset:
+                    self._send(206, data[offset:], "application/octet-stream",
+                               [("Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}")])
+                else:
+                    self._send(200, data, "application/octet-stream")
+
+        return Handler
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+from KCWI_scripts import trace, cache, frame_store, sky_index, standard_stars, koa_client
+from KCWI_scripts.koa_client import KoaClient
+from synthetic_archive import SyntheticArchive
+from fake_koa import FakeKoa, FakeKoaServer
+
+# Repeatable end-to-end benchmarks, offline: KOA is replaced by FakeKoa (with
+# latency, errors and bandwidth as configured) serving a SyntheticArchive.
+#
+# Every scenario runs in a fresh temporary cache, frame store and working
+# directory, with the process-wide singletons reset, so cold runs are cold;
+# warm scenarios first run the same lookup once untimed. The results (wall
+# time, KOA queries, downloads and the time per stage from trace.py) are
+# written as JSON, with the commit and configuration, to compare across
+# changes:
+#
+#   PYTHONPATH=. python benchmarks/run_benchmarks.py [--scenarios find_calibrations_cold,...]
+#       [--latency 0.2] [--error_rate 0] [--bandwidth_mbps 100] [--repeat 3] [--output benchmarks.json]
+
+START = "2024-01-01"
+NIGHTS = 60
+NIGHT = "2024-01-31"
+
+
+class Environment:
+    def __init__(self, archive, args):
+        self.archive = archive
+        self.args = args
+        self._tmp = tempfile.TemporaryDirectory(prefix="kcwi_bench_")
+        self.dir = self._tmp.name
+        self._environ = dict(os.environ)
+        os.environ.update(KCWI_CACHE_DIR=os.path.join(self.dir, "cache"), KCWI_STORE_DIR=os.path.join(self.dir, "frames"),
+                          KCWI_NO_SERVICE="1")
+        for name in ("KCWI_NO_CACHE", "KCWI_NO_STORE"):
+            os.environ.pop(name, None)
+        self._reset()
+
+        self.server = FakeKoaServer(archive, latency=args.download_latency, error_rate=args.error_rate,
+                                    bandwidth_mbps=args.bandwidth_mbps, seed=args.seed)
+        self.server.start()
+        self.koa = FakeKoa(archive, server=self.server, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+        koa_client._default_client = KoaClient(koa=self.koa, verbose=False)
+        self.results = None
+
+    def _reset(self):
+        cache._default_cache = None
+        frame_store._default_store = None
+        sky_index._default_index = None
+        standard_stars._catalogs.clear()
+        koa_client._default_client = None
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def close(self):
+        self.server.stop()
+        self._reset()
+        os.environ.clear()
+        os.environ.update(self._environ)
+        self._tmp.cleanup()
+
+    # time the block; what it printed is discarded
+    @contextlib.contextmanager
+    def measure(self):
+        queries, requests = self.koa.report(), self.server.report()
+        trace.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            trace.stop()
+            report = trace.summary()
+            after_queries, after_requests = self.koa.report(), self.server.report()
+            self.results = {
+                "seconds": seconds,
+                "koa_queries": after_queries["query_date"] + after_queries["query_position"]
+                               - queries["query_date"] - queries["query_position"],
+                "downloads": after_requests["getKOA"] - requests["getKOA"],
+                "caliblists": after_requests["getCaliblist"] - requests["getCaliblist"],
+                "bytes": after_requests["bytes"] - requests["bytes"],
+                "injected_errors": after_queries["errors"] + after_requests["errors"]
+                                   - queries["errors"] - requests["errors"],
+                "stages": {name: round(stage["total"], 4) for name, stage in report["stages"].items()},
+                "counters": report["counters"],
+            }
+
+
+def find_calibrations_cold(env):
+    from KCWI_scripts.calib_finder import find_calibrations
+    with env.measure():
+        find_calibrations(NIGHT, outpath=env.path("downloads"))
+
+
+def find_calibrations_warm(env):
+    from KCWI_scripts.calib_finder import find_calibrations
+    find_calibrations(NIGHT, outpath=env.path("downloads"))
+    with env.measure():
+        find_calibrations(NIGHT, outpath=env.path("downloads"))
+
+
+def find_calibrations_pipeline(env):
+    from KCWI_scripts import pipeline
+    with env.measure():
+        pipeline.run(pipeline.find_calibrations, NIGHT, outpath=env.path("downloads"))
+
+
+def calib_batch_30_nights(env):
+    from KCWI_scripts.calib_batch import plan_calibrations
+    dates = env.archive.dates[15:45]
+    with env.measure():
+        plan_calibrations(dates, outpath=env.path("downloads"))
+
+
+def download_files_night(env):
+    from KCWI_scripts.download_files_by_date import download_files_by_date
+    with env.measure():
+        download_files_by_date(NIGHT, output_dir=env.path("night"), verify=True)
+
+
+# 1000 frames of consecutive nights with their metadata, renamed by OFNAME
+def rename_files_1000(env):
+    from astropy.table import vstack
+    from KCWI_scripts.rename_files import rename_fits_files
+
+    directory = env.path("raw")
+    tables = []
+    for date in env.archive.dates:
+        tables.append(env.archive.write_night(date, directory, fits=True))
+        if sum(len(t) for t in tables) >= 1000:
+            break
+    table = vstack([t for t in tables if len(t)])[:1000]
+    for name in os.listdir(directory):
+        if name.endswith(".fits") and name not in set(table["koaid"]):
+            os.remove(os.path.join(directory, name))
+    table["koaid", "ofname"].write(os.path.join(directory, "koa_metadata_filtered.tbl"), format="ascii.ipac")
+
+    with env.measure():
+        rename_fits_files(output_dir="renamed", directory=directory)
+
+
+# a month of cached nights filtered down to two columns
+def query_month_warm(env):
+    from KCWI_scripts.obs_table_date import obs_table_date
+    query = dict(end=env.archive.dates[29], data_type="calibration", camera="blue", columns=["koaid", "date_obs"],
+                 output_dir=env.path("month"))
+    obs_table_date(env.archive.dates[0], **query)
+    with env.measure():
+        obs_table_date(env.archive.dates[0], **query)
+
+
+def _cone(env):
+    from KCWI_scripts.obs_table_target import obs_table_target
+    _, ra, dec = env.archive.fields[0]
+    return lambda: obs_table_target(ra, dec, radius=30, output_dir=env.path("cone"))
+
+
+def cone_search_cold(env):
+    search = _cone(env)
+    with env.measure():
+        search()
+
+
+def cone_search_warm(env):
+    search = _cone(env)
+    search()
+    with env.measure():
+        search()
+
+
+SCENARIOS = {
+    "find_calibrations_cold": find_calibrations_cold,
+    "find_calibrations_warm": find_calibrations_warm,
+    "find_calibrations_pipeline": find_calibrations_pipeline,
+    "calib_batch_30_nights": calib_batch_30_nights,
+    "download_files_night": download_files_night,
+    "rename_files_1000": rename_files_1000,
+    "query_month_warm": query_month_warm,
+    "cone_search_cold": cone_search_cold,
+    "cone_search_warm": cone_search_warm,
+}
+
+
+def run_scenario(name, archive, args):
+    runs = []
+    for _ in range(args.repeat):
+        env = Environment(archive, args)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                SCENARIOS[name](env)
+            runs.append(env.results)
+        finally:
+            env.close()
+
+    # the run with the median time, with the times of all runs
+    runs.sort(key=lambda run: run["seconds"])
+    result = dict(runs[len(runs) // 2])
+    result["seconds"] = round(statistics.median(run["seconds"] for run in runs), 4)
+    result["runs"] = [round(run["seconds"], 4) for run in runs]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline benchmark scenarios against a fake KOA.")
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS), help=f"Comma-separated scenarios (default all: {', '.join(SCENARIOS)}).")
+    parser.add_argument('--latency', type=float, default=0.2, help="Latency of a metadata query, in seconds (default 0.2).")
+    parser.add_argument('--download_latency', type=float, default=0.02, help="Latency of a file or calibration list request, in seconds (default 0.02).")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Fraction of queries and requests that fail (default 0).")
+    parser.add_argument('--bandwidth_mbps', type=float, default=100, help="Bandwidth of every transfer, in Mbit/s (default 100, 0 for unlimited).")
+    parser.add_argument('--fits_pixels', type=int, default=32, help="Side of the synthetic images (default 32).")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario, the median is reported (default 3).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmarks.json', help="JSON file for the results (default benchmarks.json).")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    archive = SyntheticArchive(start=START, nights=NIGHTS, seed=args.seed, fits_pixels=args.fits_pixels).generate()
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "scenarios")},
+        "scenarios": {},
+    }
+
+    print(f"{'scenario':26s} {'seconds':>9s} {'queries':>8s} {'files':>6s} {'MB':>7s}")
+    for name in names:
+        result = run_scenario(name, archive, args)
+        results["scenarios"][name] = result
+        print(f"{name:26s} {result['seconds']:9.3f} {result['koa_queries']:8d} {result['downloads']:6d} {result['bytes'] / 1e6:7.2f}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n📝 Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
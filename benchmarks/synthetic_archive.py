@@ -0,0 +1,283 @@
+import os
+import random
+import argparse
+import numpy as np
+import pandas as pd
+from astropy.table import Table, vstack
+from KCWI_scripts.standard_stars import load_stars, parse_angles
+from KCWI_scripts.sky_index import unit_vectors
+
+# Synthetic KCWI archive for the benchmarks: reproducible nights of KOA
+# metadata and the matching (small) FITS files, without network.
+#
+# Every night is generated from (seed, date): most nights have an afternoon
+# calibration sequence (bias, contbars, arcs, flats, dome flats, sometimes
+# twilight flats and darks) for each configuration used that night, science
+# frames of a fixed set of fields, and one or two pointings at stars of the
+# standard-star catalog; some nights have no KCWI data at all. Besides the
+# columns the scripts use, every row has extra_columns filler columns, so the
+# tables are as wide as real KOA metadata.
+#
+#   python benchmarks/synthetic_archive.py --start 2024-01-01 --nights 30 --output_dir ./synthetic --fits
+
+# (grating, slicer, binning, central wavelength)
+CONFIGURATIONS = [
+    ("BL", "Medium", "2,2", 4500.0),
+    ("BM", "Small", "1,1", 4800.0),
+    ("BH3", "Large", "2,2", 5100.0),
+    ("BL", "Large", "2,2", 4550.0),
+]
+
+# (type, frames, probability of the type being taken on a night)
+CALIBRATION_SEQUENCE = [
+    ("bias", 7, 0.95),
+    ("contbars", 1, 0.9),
+    ("arclamp", 2, 0.9),
+    ("flatlamp", 6, 0.85),
+    ("domeflat", 3, 0.7),
+    ("twiflat", 3, 0.4),
+    ("dark", 3, 0.3),
+]
+
+COLUMNS = ["koaid", "instrume", "ofname", "targname", "koaimtyp", "date_obs", "ut", "ra", "dec", "camera",
+           "gratname", "ifunam", "binning", "bcwave", "exptime", "frameno", "progid", "semid", "airmass", "filehand"]
+DTYPES = ["U30", "U8", "U24", "U24", "U10", "U10", "U11", "f8", "f8", "U5",
+          "U5", "U8", "U4", "f8", "f8", "i8", "U8", "U10", "f8", "U60"]
+
+CARD = 80
+FITS_BLOCK = 2880
+
+
+def _card(key, value):
+    if isinstance(value, str):
+        text = f"{key:<8}= '{value:<8}'"
+    elif isinstance(value, bool):
+        text = f"{key:<8}= {'T' if value else 'F':>20}"
+    else:
+        text = f"{key:<8}= {value:>20}"
+    return text.ljust(CARD)[:CARD].encode("ascii")
+
+
+def _ipac_value(value):
+    if isinstance(value, float):
+        return repr(float(value))
+    return str(value)
+
+
+class SyntheticArchive:
+    def __init__(self, start="2024-01-01", nights=365, seed=0, extra_columns=60, empty_fraction=0.1,
+                 fields=50, fits_pixels=32, standards_file=None):
+        self.dates = [d.strftime("%Y-%m-%d") for d in pd.date_range(start, periods=nights)]
+        self.seed = seed
+        self.extra_columns = extra_columns
+        self.empty_fraction = empty_fraction
+        self.fits_pixels = fits_pixels
+        self._rows = {}
+        self._tables = {}
+        self._frames = {}
+        self._ipac_lines = {}
+        self._ipac_widths = None
+
+        stars = load_stars(standards_file)
+        self.stars = [(name, float(ra), float(dec)) for (name, _, _), ra, dec in
+                      zip(stars, parse_angles([s[1] for s in stars], hours=True), parse_angles([s[2] for s in stars], hours=False))]
+
+        rng = random.Random(f"{seed}-fields")
+        self.fields = [(f"field{i:03d}", rng.uniform(0, 360), rng.uniform(-30, 70)) for i in range(fields)]
+
+    def _names(self):
+        return COLUMNS + [f"extra_{i:02d}" for i in range(self.extra_columns)]
+
+    def _dtypes(self):
+        return DTYPES + ["f8" if i % 2 else "U16" for i in range(self.extra_columns)]
+
+    # rows of one night (none outside the archive and on nights without data)
+    def rows(self, date):
+        if date in self._rows:
+            return self._rows[date]
+        if date not in self.dates:
+            return []
+
+        rng = random.Random(f"{self.seed}-{date}")
+        compact = date.replace("-", "")
+        rows = []
+        seconds = 3600 + rng.randint(0, 600)
+
+        def add(imtyp, targname, ra, dec, config, exptime):
+            nonlocal seconds
+            frameno = len(rows) + 1
+            koaid = f"KB.{compact}.{seconds:05d}.{rng.randint(0, 99):02d}.fits"
+            grating, slicer, binning, cwave = config
+            rows.append([koaid, "KCWI", f"kb{compact[2:]}_{frameno:05d}.fits" if rng.random() > 0.05 else "",
+                         targname, imtyp, date, f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.00",
+                         ra, dec, "BLUE", grating, slicer, binning, cwave, exptime, frameno,
+                         f"C{rng.randint(200, 299)}", f"{date[:4]}B_C{rng.randint(200, 299)}",
+                         round(rng.uniform(1.0, 2.0), 3), f"/koadata/KCWI/{compact}/lev0/{koaid}"]
+                        + [rng.uniform(0, 100) if i % 2 else f"value{rng.randint(0, 9)}" for i in range(self.extra_columns)])
+            self._frames[koaid] = (date, imtyp, config, rows[-1][2])
+            seconds += int(exptime) + rng.randint(30, 120)
+
+        if rng.random() >= self.empty_fraction:
+            configs = rng.sample(CONFIGURATIONS, rng.choice([1, 1, 2]))
+            telescope = (rng.uniform(0, 360), rng.uniform(-30, 70))
+
+            for config in configs:
+                for imtyp, n, probability in CALIBRATION_SEQUENCE:
+                    if rng.random() < probability:
+                        exptime = 0.0 if imtyp == "bias" else rng.choice([1.0, 6.0, 30.0])
+                        for _ in range(n):
+                            add(imtyp, imtyp.upper(), *telescope, config, exptime)
+
+            seconds += 3 * 3600
+            for _ in range(rng.randint(2, 6)):
+                targname, ra, dec = rng.choice(self.fields)
+                config = rng.choice(configs)
+                for _ in range(rng.randint(1, 4)):
+                    add("object", targname, ra + rng.gauss(0, 1e-4), dec + rng.gauss(0, 1e-4), config, 1200.0)
+
+            for _ in range(rng.randint(1, 2)):
+                name, ra, dec = rng.choice(self.stars)
+                add("object", name, ra + rng.gauss(0, 2e-4), dec + rng.gauss(0, 2e-4), rng.choice(configs), 30.0)
+
+        self._rows[date] = rows
+        return rows
+
+    # metadata table of one night
+    def night(self, date):
+        if date not in self._tables:
+            rows = self.rows(date)
+            self._tables[date] = Table(rows=rows or None, names=self._names(), dtype=self._dtypes())
+        return self._tables[date]
+
+    # nights of 'YYYY-MM-DD' or 'YYYY-MM-DD/YYYY-MM-DD', as Koa.query_date
+    def query_dates(self, date):
+        if "/" in date:
+            start, end = date.split("/")
+            return [d.strftime("%Y-%m-%d") for d in pd.date_range(start, end)]
+        return [date]
+
+    def query_date(self, date):
+        tables = [self.night(d) for d in self.query_dates(date)]
+        return vstack(tables) if len(tables) > 1 else tables[0]
+
+    # rows of a night within radius (degrees) of (ra, dec)
+    def _in_cone(self, date, ra, dec, radius):
+        table = self.night(date)
+        if not len(table):
+            return np.zeros(0, dtype=bool)
+        center = unit_vectors([ra], [dec])[0]
+        return unit_vectors(table["ra"], table["dec"]) @ center >= np.cos(np.radians(radius))
+
+    # every frame of the archive within radius (degrees) of (ra, dec)
+    def query_cone(self, ra, dec, radius):
+        tables = [self.night(date)[self._in_cone(date, ra, dec, radius)] for date in self.dates]
+        return vstack(tables)
+
+    # IPAC text as KOA returns it. Every night is formatted with the same
+    # column widths, so the lines of several nights are simply joined.
+    def _widths(self):
+        if self._ipac_widths is None:
+            widths = []
+            for name, dtype in zip(self._names(), self._dtypes()):
+                size = int(dtype[1:]) if dtype.startswith("U") else 12 if dtype == "i8" else 20
+                widths.append(max(len(name), size))
+            self._ipac_widths = widths
+        return self._ipac_widths
+
+    def _lines(self, date):
+        if date not in self._ipac_lines:
+            widths = self._widths()
+            self._ipac_lines[date] = ["".join(f" {_ipac_value(value):<{width}}"
+                                              for value, width in zip(row, widths)) + " \n"
+                                      for row in self.rows(date)]
+        return self._ipac_lines[date]
+
+    def _ipac_header(self):
+        ipac_types = {"U": "char", "f": "double", "i": "long"}
+        widths = self._widths()
+        lines = ["\\fixlen = T\n"]
+        for fields in (self._names(), [ipac_types[d[0]] for d in self._dtypes()], [""] * len(widths), ["null"] * len(widths)):
+            lines.append("".join(f"|{field:<{width}}" for field, width in zip(fields, widths)) + "|\n")
+        return "".join(lines)
+
+    # IPAC text of a query_date, None when KOA has no frames for it
+    def ipac_date(self, date):
+        lines = [line for d in self.query_dates(date) for line in self._lines(d)]
+        return self._ipac_header() + "".join(lines) if lines else None
+
+    # IPAC text of a cone search, None when no frame is in the cone
+    def ipac_cone(self, ra, dec, radius):
+        lines = []
+        for date in self.dates:
+            inside = self._in_cone(date, ra, dec, radius)
+            lines += [line for line, keep in zip(self._lines(date), inside) if keep]
+        return self._ipac_header() + "".join(lines) if lines else None
+
+    # build every night up front, so that a benchmark does not time it
+    def generate(self):
+        for date in self.dates:
+            self.night(date)
+            self._lines(date)
+        return self
+
+    def frame(self, koaid):
+        if koaid not in self._frames:
+            self.rows(f"{koaid[3:7]}-{koaid[7:9]}-{koaid[9:11]}")
+        return self._frames[koaid]
+
+    # calibration frames of the same night and configuration (what KOA's
+    # caliblist returns for a science frame)
+    def companions(self, koaid):
+        date, _, config, _ = self.frame(koaid)
+        table = self.night(date)
+        rows = []
+        for row in table:
+            if row["koaimtyp"] != "object" and self._frames[row["koaid"]][2] == config:
+                rows.append({"koaid": str(row["koaid"]), "instrument": "KCWI", "filehand": str(row["filehand"])})
+        return rows
+
+    # a small valid FITS file for a frame (fits_pixels x fits_pixels, 16 bits)
+    def fits_bytes(self, koaid):
+        date, imtyp, _, ofname = self.frame(koaid)
+        n = self.fits_pixels
+        cards = [_card("SIMPLE", True), _card("BITPIX", 16), _card("NAXIS", 2), _card("NAXIS1", n), _card("NAXIS2", n),
+                 _card("KOAID", koaid), _card("IMTYPE", imtyp.upper()), _card("OFNAME", ofname),
+                 _card("DATE-OBS", date), b"END".ljust(CARD)]
+        header = b"".join(cards)
+        header += b" " * (-len(header) % FITS_BLOCK)
+        data = np.zeros(n * n, dtype=">i2").tobytes()
+        return header + data + b"\0" * (-len(data) % FITS_BLOCK)
+
+    # write koa_metadata_{date}.tbl (and with fits the frames, named by koaid)
+    def write_night(self, date, output_dir, fits=False):
+        os.makedirs(output_dir, exist_ok=True)
+        table = self.night(date)
+        text = self.ipac_date(date)
+        if text is not None:
+            with open(os.path.join(output_dir, f"koa_metadata_{date}.tbl"), "w") as f:
+                f.write(text)
+        if fits:
+            for koaid in table["koaid"]:
+                with open(os.path.join(output_dir, str(koaid)), "wb") as f:
+                    f.write(self.fits_bytes(str(koaid)))
+        return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic KCWI archive (KOA metadata and small FITS files).")
+    parser.add_argument('--start', type=str, default='2024-01-01', help="First night (default 2024-01-01).")
+    parser.add_argument('--nights', type=int, default=30, help="Number of nights (default 30).")
+    parser.add_argument('--output_dir', type=str, default='./synthetic', help="Output directory (default ./synthetic).")
+    parser.add_argument('--fits', action='store_true', help="Write the FITS files too.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    archive = SyntheticArchive(start=args.start, nights=args.nights, seed=args.seed)
+    frames = 0
+    for date in archive.dates:
+        frames += len(archive.write_night(date, os.path.join(args.output_dir, date), fits=args.fits))
+    print(f"✅ {args.nights} nights, {frames} frames written to {args.output_dir}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,20 +18,28 @@ setup(
         "numpy",
         "pandas",
         "astropy",
+        "scipy",
         "pykoa",
+        "requests",
         "argparse"
     ],
 
     python_requires='>=3.10.16',
     entry_points={
         "console_scripts": [
+            "kcwi=KCWI_scripts.cli:main",
+            "calib_batch=KCWI_scripts.calib_batch:main",
             "calib_date_finder=KCWI_scripts.calib_date_finder:main",
             "calib_finder=KCWI_scripts.calib_finder:main",
             "download_files_by_date=KCWI_scripts.download_files_by_date:main",
             "download_files=KCWI_scripts.download_files:main",
             "obs_table_date=KCWI_scripts.obs_table_date:main",
             "obs_table_target=KCWI_scripts.obs_table_target:main",
+            "obs_table_targets=KCWI_scripts.obs_table_targets:main",
             "rename_files=KCWI_scripts.rename_files:main",
+            "kcwi_service=KCWI_scripts.service:main",
+            "sync_archive=KCWI_scripts.sync_archive:main",
+            "verify_frames=KCWI_scripts.verify_frames:main",
         ]
     },
 )
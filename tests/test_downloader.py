@@ -0,0 +1,137 @@
+import os
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from KCWI_scripts.downloader import DownloadEngine, MANIFEST_NAME, FITS_BLOCK
+from KCWI_scripts.koa_client import KoaClient
+
+# Offline tests of DownloadEngine against a local http.server that serves one
+# FITS file and can cut a transfer short, as a dropped connection would.
+
+KOAID = "KB.20200516.12345.fits"
+DATA = bytes(range(256)) * (3 * FITS_BLOCK // 256)
+
+
+class FileServer:
+    def __init__(self, data):
+        self.data = data
+        self.truncate = []  # bytes sent by the next responses before the connection drops
+        self.errors = []  # status of the next responses, instead of the file
+        self.requests = []  # (path, Range header) of every request
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/getKOA?"
+
+    def _handler(self):
+        files = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                files.requests.append((self.path, self.headers.get("Range")))
+                if files.errors:
+                    self.send_error(files.errors.pop(0))
+                    return
+                offset = 0
+                if self.headers.get("Range", "").startswith("bytes="):
+                    offset = int(self.headers["Range"][len("bytes="):].split("-")[0])
+                body = files.data[offset:]
+                self.send_response(206 if offset else 200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                if offset:
+                    self.send_header("Content-Range", f"bytes {offset}-{len(files.data) - 1}/{len(files.data)}")
+                self.end_headers()
+                if files.truncate:
+                    body = body[:files.truncate.pop(0)]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    files = FileServer(DATA)
+    thread = threading.Thread(target=files.server.serve_forever, daemon=True)
+    thread.start()
+    yield files
+    files.server.shutdown()
+    files.server.server_close()
+
+
+def engine(outdir, server, retries=3):
+    client = KoaClient(rate=1000, retries=retries, backoff=0, koa=object(), verbose=False)
+    return DownloadEngine(str(outdir), max_workers=2, getkoa_url=server.url, caliblist_url=server.url,
+                          verbose=False, client=client)
+
+
+def manifest(outdir):
+    with open(os.path.join(outdir, MANIFEST_NAME)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_truncated_transfer_is_resumed_with_a_range_request(tmp_path, server):
+    server.truncate = [FITS_BLOCK + 100]
+    with engine(tmp_path, server) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+    report = downloads.report()
+
+    assert report["downloaded"] == [KOAID] and report["failed"] == []
+    assert (tmp_path / KOAID).read_bytes() == DATA
+    assert not (tmp_path / f"{KOAID}.part").exists()
+    # the retry asks only for what the first response didn't deliver
+    assert [r for _, r in server.requests] == [None, f"bytes={FITS_BLOCK + 100}-"]
+    assert downloads.client.report()["retried"] == 1
+    assert [(e["koaid"], e["size"]) for e in manifest(tmp_path)] == [(KOAID, len(DATA))]
+
+
+def test_part_file_from_an_earlier_run_is_resumed(tmp_path, server):
+    (tmp_path / f"{KOAID}.part").write_bytes(DATA[:1000])
+    with engine(tmp_path, server) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+
+    assert (tmp_path / KOAID).read_bytes() == DATA
+    assert [r for _, r in server.requests] == ["bytes=1000-"]
+    assert downloads.report()["bytes"] == len(DATA)
+
+
+def test_retries_stop_and_the_failure_is_reported(tmp_path, server):
+    server.truncate = [100, 100, 100]
+    with engine(tmp_path, server, retries=2) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+    report = downloads.report()
+
+    assert report["downloaded"] == [] and [koaid for koaid, _ in report["failed"]] == [KOAID]
+    assert len(server.requests) == 3
+    assert not (tmp_path / KOAID).exists()
+    # what arrived is kept for the next run
+    assert (tmp_path / f"{KOAID}.part").read_bytes() == DATA[:300]
+    assert not os.path.exists(tmp_path / MANIFEST_NAME)
+
+
+def test_files_in_the_manifest_are_skipped(tmp_path, server):
+    with engine(tmp_path, server) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+    with engine(tmp_path, server) as again:
+        again.submit(KOAID, f"/kcwi/{KOAID}")
+
+    assert again.report()["skipped"] == [KOAID]
+    assert len(server.requests) == 1
+
+
+def test_server_errors_are_retried_and_missing_files_are_not(tmp_path, server):
+    server.errors = [503, 503]
+    with engine(tmp_path, server) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+    assert downloads.report()["downloaded"] == [KOAID]
+    assert len(server.requests) == 3
+
+    server.requests.clear()
+    server.errors = [404]
+    with engine(tmp_path / "other", server) as downloads:
+        downloads.submit(KOAID, f"/kcwi/{KOAID}")
+    assert [koaid for koaid, _ in downloads.report()["failed"]] == [KOAID]
+    assert len(server.requests) == 1
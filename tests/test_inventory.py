@@ -0,0 +1,52 @@
+import pytest
+from astropy.table import Table
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts.inventory import NightInventory, calibration_quotas, take_calibrations
+
+# Configurations of nights with frames of both KCWI cameras: KOA gives every
+# frame the blue and the red grating and central wavelength columns, and each
+# frame is grouped by the ones of its own camera.
+
+COLUMNS = ["koaid", "koaimtyp", "camera", "bgratnam", "rgratnam", "bcwave", "rcwave", "ifunam", "binning"]
+ROWS = [
+    ("KB.1.fits", "object", "BLUE", "BL", "RL", "4500", "7000", "Medium", "2,2"),
+    ("KR.1.fits", "object", "RED", "BL", "RL", "4500", "7000", "Medium", "2,2"),
+    ("KB.2.fits", "arclamp", "BLUE", "BL", "RH3", "4500", "8000", "Medium", "2,2"),
+    ("KR.2.fits", "arclamp", "RED", "BM", "RL", "5000", "7000", "Medium", "2,2"),
+    ("KR.3.fits", "arclamp", "RED", "BL", "RH3", "4500", "8000", "Medium", "2,2"),
+]
+
+
+@pytest.fixture(params=["Table", "CompactTable"])
+def night(request):
+    table = Table(rows=ROWS, names=COLUMNS)
+    return table if request.param == "Table" else CompactTable.from_table(table)
+
+
+def config(camera, grating, cwave):
+    return (("camera", camera), ("grating", grating), ("slicer", "MEDIUM"), ("binning", "2,2"), ("cwave", cwave))
+
+
+def test_frames_are_grouped_by_the_columns_of_their_camera(night):
+    inventory = NightInventory(night)
+
+    assert sorted(inventory.configs("OBJECT")) == [config("BLUE", "BL", "4500"), config("RED", "RL", "7000")]
+    assert inventory.koaids("ARCLAMP", config("BLUE", "BL", "4500")) == ["KB.2.fits"]
+    assert inventory.koaids("ARCLAMP", config("RED", "RL", "7000")) == ["KR.2.fits"]
+
+
+def test_red_calibrations_are_taken_for_red_science(night):
+    inventory = NightInventory(night)
+    missing = calibration_quotas(inventory, {"ARCLAMP": 1})
+    taken = take_calibrations(missing, inventory)
+
+    assert taken == {("ARCLAMP", config("BLUE", "BL", "4500")): ["KB.2.fits"],
+                     ("ARCLAMP", config("RED", "RL", "7000")): ["KR.2.fits"]}
+    assert all(n == 0 for n in missing.values())
+
+
+def test_generic_columns_without_camera_columns():
+    table = Table(rows=[("KB.1.fits", "object", "BLUE", "BL", "4500")],
+                  names=["koaid", "koaimtyp", "camera", "gratname", "cwave"])
+
+    assert NightInventory(table).configs("OBJECT") == [(("camera", "BLUE"), ("grating", "BL"), ("cwave", "4500"))]
@@ -0,0 +1,175 @@
+import time
+import threading
+import pytest
+from KCWI_scripts.koa_client import KoaClient, KoaError, TokenBucket, AdaptiveLimit, is_transient
+
+# Offline tests of the KOA client's rate limit, AIMD concurrency limits and
+# retries of transient errors, with a stub in place of pykoa's Koa that fails
+# the calls it is told to, printing the error as pykoa does.
+
+TABLE = "|koaid|\n|char|\n KB.20200516.00001.fits \n"
+
+
+class StubKoa:
+    def __init__(self, fail=(), delay=0.0):
+        self.fail = set(fail)  # numbers (from 0) of the calls that fail
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def query_date(self, instrument, date, outpath, overwrite=False, **kwargs):
+        with self._lock:
+            call, self.calls = self.calls, self.calls + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if call in self.fail:
+                print("Error: KOA is not answering (503)")
+                return
+            with open(outpath, "w") as f:
+                f.write(TABLE)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def client(koa, **kwargs):
+    kwargs.setdefault("rate", 1000)
+    return KoaClient(backoff=0, koa=koa, verbose=False, **kwargs)
+
+
+def test_failed_calls_are_retried_until_they_succeed(tmp_path):
+    koa = StubKoa(fail={0, 1})
+    koa_client = client(koa, retries=3)
+    koa_client.query_date("2020-05-16", str(tmp_path / "night.tbl"))
+
+    assert (tmp_path / "night.tbl").read_text() == TABLE
+    assert koa.calls == 3
+    assert koa_client.report() == {"calls": 3, "retried": 2, "failures": []}
+
+
+def test_retries_stop_at_KCWI_KOA_RETRIES(tmp_path, monkeypatch):
+    monkeypatch.setenv("KCWI_KOA_RETRIES", "2")
+    koa = StubKoa(fail=range(10))
+    koa_client = client(koa)
+
+    with pytest.raises(KoaError, match="503"):
+        koa_client.query_date("2020-05-16", str(tmp_path / "night.tbl"))
+    assert koa.calls == 3
+    report = koa_client.report()
+    assert report["retried"] == 2
+    assert [(f["call"], f["attempts"]) for f in report["failures"]] == [("query_date 2020-05-16", 3)]
+    assert not (tmp_path / "night.tbl").exists()
+
+
+def test_concurrency_backs_off_on_errors_and_recovers_on_successes(tmp_path):
+    koa = StubKoa()
+    koa_client = client(koa, max_concurrency=4, retries=1)
+    koa_client.limit.cooldown = 0
+    limit = koa_client.limit
+
+    # additive increase: +1 for every limit successful calls, up to the maximum
+    for i in range(20):
+        koa_client.query_date("2020-05-16", str(tmp_path / f"{i}.tbl"))
+    assert limit.limit == 4
+
+    # multiplicative decrease on the failure, then the retry succeeds
+    koa.fail = {koa.calls}
+    koa_client.query_date("2020-05-16", str(tmp_path / "failed.tbl"))
+    assert limit.limit == pytest.approx(2 + 1 / 2)
+
+    for i in range(20):
+        koa_client.query_date("2020-05-16", str(tmp_path / f"again_{i}.tbl"))
+    assert limit.limit == 4
+
+
+def test_failures_in_a_burst_halve_the_limit_once():
+    limit = AdaptiveLimit(initial=8, maximum=8, cooldown=60)
+    for _ in range(3):
+        limit.acquire()
+    for _ in range(3):
+        limit.release(False)
+    assert limit.limit == 4
+
+
+def test_calls_in_flight_stay_under_the_limit(tmp_path):
+    koa = StubKoa(delay=0.02)
+    koa_client = client(koa, max_concurrency=2)
+    threads = [threading.Thread(target=koa_client.query_date, args=("2020-05-16", str(tmp_path / f"{i}.tbl")))
+               for i in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert koa.calls == 12
+    assert koa.max_in_flight == 2
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # the first token is there already, the other 5 come at 50 per second
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+
+
+def test_errors_that_cannot_go_away_are_not_retried():
+    calls = []
+
+    def bad_arguments():
+        calls.append(1)
+        raise ValueError("bad date")
+
+    koa_client = client(StubKoa(), retries=5)
+    with pytest.raises(ValueError):
+        koa_client.call("query_date 2020-13-45", bad_arguments)
+    assert len(calls) == 1
+    assert [f["attempts"] for f in koa_client.report()["failures"]] == [1]
+
+
+@pytest.mark.parametrize("status, transient", [(404, False), (400, False), (429, True), (503, True)])
+def test_http_errors_are_retried_only_for_throttling_and_server_errors(status, transient):
+    import requests
+
+    response = requests.Response()
+    response.status_code = status
+    assert is_transient(requests.HTTPError(f"{status}", response=response)) == transient
+
+
+def test_transient_errors():
+    import requests
+
+    assert is_transient(KoaError("KOA is not answering"))
+    assert is_transient(requests.ConnectionError("connection reset"))
+    assert is_transient(requests.Timeout("read timed out"))
+    assert is_transient(TimeoutError())
+    assert not is_transient(PermissionError("output directory is read-only"))
+
+
+def test_queries_do_not_wait_behind_transfers(tmp_path):
+    koa_client = client(StubKoa(), max_concurrency=2)
+    started, release = threading.Barrier(3), threading.Event()
+
+    def transfer():
+        started.wait()
+        release.wait(10)
+
+    # the transfers take every slot of their limit
+    threads = [threading.Thread(target=koa_client.transfer, args=("download", transfer)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    try:
+        start = time.monotonic()
+        koa_client.query_date("2020-05-16", str(tmp_path / "night.tbl"))
+        assert time.monotonic() - start < 5
+        assert koa_client.transfer_limit.in_flight == 2
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
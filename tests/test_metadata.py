@@ -0,0 +1,113 @@
+import io
+import os
+import time
+import pandas as pd
+import pytest
+from KCWI_scripts import cache, koa_client, sky_index
+from KCWI_scripts.cache import MetadataCache
+from KCWI_scripts.koa_client import KoaClient
+from KCWI_scripts.ipac_reader import read_compact
+from KCWI_scripts.metadata import load_night, load_position, night_cache_key, night_metadata_path
+
+# Offline tests of when the metadata loaders ask KOA again: a metadata file
+# left in the output directory by an earlier query stands in for KOA only while
+# its results can't have changed.
+
+
+def ipac(koaids, date):
+    from astropy.table import Table
+    table = Table({"koaid": koaids, "koaimtyp": ["object"] * len(koaids), "ra": [27.29] * len(koaids),
+                   "dec": [13.55] * len(koaids), "date_obs": [date] * len(koaids)})
+    text = io.StringIO()
+    table.write(text, format="ascii.ipac")
+    return text.getvalue()
+
+
+class StubKoa:
+    def __init__(self, koaids):
+        self.koaids = koaids
+        self.queries = []
+
+    def query_date(self, instrument, date, outpath, overwrite=False, **kwargs):
+        self.queries.append(date)
+        with open(outpath, "w") as f:
+            f.write(ipac(self.koaids, date))
+
+    def query_position(self, instrument, pos, outpath, overwrite=False, **kwargs):
+        self.queries.append(pos)
+        with open(outpath, "w") as f:
+            f.write(ipac(self.koaids, "2020-05-16"))
+
+
+@pytest.fixture
+def koa(tmp_path, monkeypatch):
+    stub = StubKoa(["KB.NEW.fits"])
+    monkeypatch.setattr(cache, "_default_cache", MetadataCache(str(tmp_path / "cache"), max_bytes=1 << 30, ttl=3600))
+    monkeypatch.setattr(koa_client, "_default_client", KoaClient(rate=1000, backoff=0, koa=stub, verbose=False))
+    monkeypatch.setattr(sky_index, "_default_index", None)
+    return stub
+
+
+def age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_recent_night_is_queried_again_when_its_entry_expires(tmp_path, koa):
+    date = (pd.Timestamp.now() - pd.Timedelta(days=2)).strftime("%Y-%m-%d")
+    path = night_metadata_path(str(tmp_path), date)
+    with open(path, "w") as f:
+        f.write(ipac(["KB.OLD.fits"], date))
+    age(path, 2 * 3600)
+    cache.default_cache().put(night_cache_key(date), read_compact(path), ttl=-1)
+
+    table = load_night(date, str(tmp_path))
+
+    assert koa.queries == [date]
+    assert list(table["koaid"]) == ["KB.NEW.fits"]
+    assert "KB.NEW.fits" in open(path).read()
+
+
+def test_recent_night_file_written_within_the_ttl_is_read(tmp_path, koa):
+    date = (pd.Timestamp.now() - pd.Timedelta(days=2)).strftime("%Y-%m-%d")
+    with open(night_metadata_path(str(tmp_path), date), "w") as f:
+        f.write(ipac(["KB.OLD.fits"], date))
+
+    assert list(load_night(date, str(tmp_path))["koaid"]) == ["KB.OLD.fits"]
+    assert koa.queries == []
+
+
+def test_old_night_file_is_read_however_old(tmp_path, koa):
+    path = night_metadata_path(str(tmp_path), "2020-05-16")
+    with open(path, "w") as f:
+        f.write(ipac(["KB.OLD.fits"], "2020-05-16"))
+    age(path, 365 * 86400)
+
+    assert list(load_night("2020-05-16", str(tmp_path))["koaid"]) == ["KB.OLD.fits"]
+    assert koa.queries == []
+
+
+def test_recent_night_without_frames_anymore(tmp_path, koa):
+    date = (pd.Timestamp.now() - pd.Timedelta(days=2)).strftime("%Y-%m-%d")
+    path = night_metadata_path(str(tmp_path), date)
+    with open(path, "w") as f:
+        f.write(ipac(["KB.OLD.fits"], date))
+    age(path, 2 * 3600)
+    koa.query_date = lambda instrument, date, outpath, **kwargs: koa.queries.append(date)
+
+    assert load_night(date, str(tmp_path)) is None
+    assert koa.queries == [date] and not os.path.exists(path)
+
+
+def test_stale_position_file_is_queried_again_and_indexed_as_fresh(tmp_path, koa):
+    # the file of an earlier search, before the sky index had it
+    path = tmp_path / "position_search_27.29_13.55_60.tbl"
+    path.write_text(ipac(["KB.OLD.fits"], "2020-05-16"))
+    age(path, 2 * 3600)
+
+    table = load_position(27.29, 13.55, 30, str(tmp_path))
+
+    assert len(koa.queries) == 1
+    assert list(table["koaid"]) == ["KB.NEW.fits"]
+    cone = sky_index.default_sky_index().covering_cone(27.29, 13.55, 30)
+    assert cone is not None and cone["expires"] > time.time() + 3000
@@ -0,0 +1,48 @@
+import pytest
+from KCWI_scripts import cache, koa_client, sky_index
+from KCWI_scripts.cache import MetadataCache
+from KCWI_scripts.koa_client import KoaClient
+from KCWI_scripts.query import RELEVANT_COLUMNS
+from KCWI_scripts.obs_table_targets import obs_table_targets, main
+
+# Offline tests of obs_table_targets when nothing is found: it gives an empty
+# table with the columns of a table of observations, never None.
+
+COLUMNS = ["target"] + RELEVANT_COLUMNS
+
+
+class EmptyKoa:
+    # KOA finds nothing: pykoa writes no file
+    def query_position(self, instrument, pos, outpath, overwrite=False, **kwargs):
+        pass
+
+
+@pytest.fixture
+def targets(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_default_cache", MetadataCache(str(tmp_path / "cache"), max_bytes=1 << 30))
+    monkeypatch.setattr(koa_client, "_default_client", KoaClient(rate=1000, backoff=0, koa=EmptyKoa(), verbose=False))
+    monkeypatch.setattr(sky_index, "_default_index", None)
+    path = tmp_path / "targets.csv"
+    path.write_text("Name,RA,DEC,Radius\nM33,01 33 50.9,+30 39 37,30\nM1,83.633,22.0145,\n")
+    return path
+
+
+def test_no_observations_is_an_empty_table(tmp_path, targets):
+    table = obs_table_targets(str(targets), str(tmp_path / "out"))
+
+    assert len(table) == 0 and table.colnames == COLUMNS
+
+
+def test_no_targets_is_an_empty_table(tmp_path, targets):
+    targets.write_text("Name,RA,DEC,Radius\n")
+    table = obs_table_targets(str(targets), str(tmp_path / "out"))
+
+    assert len(table) == 0 and table.colnames == COLUMNS
+
+
+def test_main_says_nothing_was_found(tmp_path, targets, monkeypatch, capsys):
+    monkeypatch.setattr("sys.argv", ["obs_table_targets", str(targets), "--outpath", str(tmp_path / "out")])
+    main()
+
+    out = capsys.readouterr().out
+    assert "No observations found" in out and "None" not in out
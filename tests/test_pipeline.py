@@ -0,0 +1,84 @@
+import io
+import multiprocessing
+import pytest
+from KCWI_scripts import cache, koa_client, sky_index, pipeline
+from KCWI_scripts.cache import MetadataCache
+from KCWI_scripts.koa_client import KoaClient
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts.metadata import night_cache_key
+from KCWI_scripts.query import Query, query_nights, night_range
+
+# Offline tests of the asyncio pipeline: its process pool where there is no
+# forkserver, and obs_table_date giving the same table as the scripts from a mix
+# of cached nights and nights fetched from KOA.
+
+
+def night_rows(night):
+    return [(f"KB.{night.replace('-', '')}.{i:05d}.fits", imtyp, "BLUE", f"{night}T0{i}:00:00")
+            for i, imtyp in enumerate(["object", "bias", "arclamp"])]
+
+
+class StubKoa:
+    def __init__(self):
+        self.queries = []
+
+    # a night or a 'start/end' range of nights
+    def query_date(self, instrument, date, outpath, overwrite=False, **kwargs):
+        from astropy.table import Table
+        self.queries.append(date)
+        start, _, end = date.partition("/")
+        rows = [row for night in night_range(start, end or start) for row in night_rows(night)]
+        text = io.StringIO()
+        Table(rows=rows, names=["koaid", "koaimtyp", "camera", "date_obs"]).write(text, format="ascii.ipac")
+        with open(outpath, "w") as f:
+            f.write(text.getvalue())
+
+
+@pytest.fixture
+def koa(tmp_path, monkeypatch):
+    stub = StubKoa()
+    monkeypatch.setattr(cache, "_default_cache", MetadataCache(str(tmp_path / "cache"), max_bytes=1 << 30))
+    monkeypatch.setattr(koa_client, "_default_client", KoaClient(rate=1000, backoff=0, koa=stub, verbose=False))
+    monkeypatch.setattr(sky_index, "_default_index", None)
+    return stub
+
+
+def test_parser_pool_falls_back_to_spawn_without_forkserver(monkeypatch):
+    monkeypatch.setattr(multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    lookups = pipeline.Pipeline(max_concurrency=1, parse_workers=1)
+    try:
+        assert lookups._parser_pool()._mp_context.get_start_method() == "spawn"
+    finally:
+        lookups.close()
+
+
+def test_obs_table_date_matches_the_scripts(tmp_path, koa):
+    nights = night_range("2020-05-01", "2020-05-10")
+    # every third night is cached already
+    for night in nights[::3]:
+        table = CompactTable.from_columns(dict(zip(["koaid", "koaimtyp", "camera", "date_obs"],
+                                                   map(list, zip(*night_rows(night))))))
+        cache.default_cache().put(night_cache_key(night), table)
+
+    columns = ["koaid", "date_obs"]
+    lookups = pipeline.Pipeline(max_concurrency=4)
+    try:
+        table = pipeline.run(pipeline.obs_table_date, "2020-05-01", str(tmp_path / "out"), "calibration",
+                             end="2020-05-10", columns=columns, pipeline=lookups)
+    finally:
+        lookups.close()
+
+    # the uncached nights between the cached ones are fetched with range queries
+    assert all("/" in query for query in koa.queries)
+    expected = query_nights(nights, str(tmp_path / "out"), Query(columns, data_type="calibration"))
+    assert table.colnames == columns
+    assert list(table["koaid"]) == list(expected["koaid"])
+    assert len(table) == 2 * len(nights)
+
+
+def test_obs_table_date_without_metadata(tmp_path, koa, monkeypatch):
+    monkeypatch.setattr(StubKoa, "query_date", lambda self, instrument, date, outpath, **kwargs: None)
+    table = pipeline.run(pipeline.obs_table_date, "2020-05-01", str(tmp_path / "out"), end="2020-05-03",
+                         columns=["koaid", "date_obs"])
+
+    assert len(table) == 0 and table.colnames == ["koaid", "date_obs"]
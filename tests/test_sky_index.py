@@ -0,0 +1,86 @@
+import os
+import threading
+import pytest
+from KCWI_scripts import cache
+from KCWI_scripts.cache import MetadataCache, save_table
+from KCWI_scripts.compact_table import CompactTable
+from KCWI_scripts.sky_index import SkyIndex, FRAMES_NAME
+
+# The sky index keeps the frames of the cones added to it as segment files:
+# an add writes only the frames not indexed yet, and the segments are merged
+# so there stay few of them, whatever the number of adds and processes.
+
+
+def frames(first, count, ra=150.0, dec=2.0):
+    koaids = [f"KB.20200516.{i:05d}.fits" for i in range(first, first + count)]
+    return CompactTable.from_columns({"koaid": koaids, "ra": [ra + i / 3600 for i in range(first, first + count)],
+                                      "dec": [dec] * count})
+
+
+def segment_files(index_dir):
+    return sorted(name for name in os.listdir(index_dir) if name.endswith(".npz"))
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_default_cache", MetadataCache(str(tmp_path / "cache")))
+    return str(tmp_path / "sky_index")
+
+
+def test_adds_write_only_new_frames(index_dir):
+    index = SkyIndex(index_dir, ttl=3600)
+    index.add(150.0, 2.0, 120, frames(0, 10))
+    index.add(150.0, 2.0, 120, frames(5, 10))
+
+    assert len(index.frames()) == 15
+    assert sorted(index.frames()["koaid"]) == sorted(frames(0, 15)["koaid"])
+    # a cone with no new frames writes no segment
+    files = segment_files(index_dir)
+    index.add(150.0, 2.0, 60, frames(0, 15))
+    assert segment_files(index_dir) == files
+    assert len(index.coverage) == 3
+
+
+def test_segments_are_merged(index_dir):
+    index = SkyIndex(index_dir, ttl=3600)
+    for i in range(64):
+        index.add(150.0, 2.0, 120, frames(i * 3, 3))
+
+    assert len(index.frames()) == 192
+    # merged like a binary counter: at most one segment per power of two
+    assert len(segment_files(index_dir)) <= 7
+    assert len(index.search(150.0, 2.0, 10)) == 11
+
+
+def test_another_index_sees_the_frames_added(index_dir):
+    first, second = SkyIndex(index_dir, ttl=3600), SkyIndex(index_dir, ttl=3600)
+    first.add(150.0, 2.0, 120, frames(0, 4))
+    assert len(second.search(150.0, 2.0, 120)) == 4
+
+    # second loaded the first segment; first has merged it since
+    first.add(150.0, 2.0, 120, frames(4, 4))
+    second.add(150.0, 2.0, 120, frames(0, 12))
+    assert len(second.frames()) == 12
+    assert len(SkyIndex(index_dir, ttl=3600).frames()) == 12
+
+
+def test_concurrent_adds(index_dir):
+    index = SkyIndex(index_dir, ttl=3600)
+    threads = [threading.Thread(target=index.add, args=(150.0, 2.0, 120, frames(i * 5, 10))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    koaids = list(SkyIndex(index_dir, ttl=3600).frames()["koaid"])
+    assert sorted(koaids) == sorted(frames(0, 45)["koaid"])
+
+
+def test_index_from_before_segments_is_read(index_dir):
+    os.makedirs(index_dir)
+    save_table(os.path.join(index_dir, FRAMES_NAME), frames(0, 4))
+    index = SkyIndex(index_dir, ttl=3600)
+    index.add(150.0, 2.0, 120, frames(2, 6))
+
+    assert len(index.frames()) == 8
+    assert FRAMES_NAME not in segment_files(index_dir)
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+from KCWI_scripts.cli import COMMANDS
+
+# The kcwi command imports the heavy packages only in the functions that use
+# them, so --help and lookups answered from the cache start quickly. Every case
+# runs in a fresh interpreter, which reports the modules it ended up importing.
+
+# modules no --help may import
+HELP_DEFERRED = ["astropy", "pandas", "scipy", "pykoa", "requests"]
+# modules a lookup answered from the cache may not import (printing the table
+# takes astropy.table)
+LOOKUP_DEFERRED = ["pandas", "scipy", "pykoa", "requests", "astropy.coordinates"]
+
+CACHED_DATE = "2020-05-16"
+
+RUN = """
+import sys, json
+from KCWI_scripts.cli import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stderr.write("\\nMODULES " + json.dumps(sorted(sys.modules)))
+"""
+
+
+def imported(args, env):
+    result = subprocess.run([sys.executable, "-c", RUN] + args, env=env, capture_output=True, text=True, timeout=120)
+    _, _, modules = result.stderr.rpartition("\nMODULES ")
+    assert modules, result.stderr
+    return set(json.loads(modules)), result.stdout
+
+
+def deferred_in(modules, deferred):
+    return [name for name in deferred if any(m == name or m.startswith(name + ".") for m in modules)]
+
+
+@pytest.fixture
+def env(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, KCWI_CACHE_DIR=str(tmp_path / "cache"), KCWI_STORE_DIR=str(tmp_path / "frames"),
+                KCWI_NO_SERVICE="1", PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+
+
+@pytest.mark.parametrize("args", [["--help"]] + [[name, "--help"] for name in COMMANDS], ids=" ".join)
+def test_help_does_not_import_heavy_modules(args, env):
+    modules, stdout = imported(args, env)
+    assert "usage:" in stdout
+    assert deferred_in(modules, HELP_DEFERRED) == []
+
+
+def test_cached_lookup_does_not_import_query_modules(tmp_path, env):
+    from KCWI_scripts.cache import MetadataCache
+    from KCWI_scripts.compact_table import CompactTable
+    from KCWI_scripts.metadata import night_cache_key
+
+    koaids = [f"KB.{CACHED_DATE.replace('-', '')}.{i:05d}.fits" for i in range(20)]
+    table = CompactTable.from_columns({"koaid": koaids, "ofname": koaids, "targname": ["target"] * 20,
+                                       "koaimtyp": ["object", "bias"] * 10, "ra": [150.0] * 20, "dec": [2.0] * 20,
+                                       "date_obs": [CACHED_DATE] * 20, "camera": ["BLUE"] * 20})
+    MetadataCache(cache_dir=env["KCWI_CACHE_DIR"]).put(night_cache_key(CACHED_DATE), table, ttl=None)
+
+    modules, stdout = imported(["obs_table_date", CACHED_DATE, "--outpath", str(tmp_path / "out")], env)
+    assert koaids[0] in stdout
+    assert deferred_in(modules, LOOKUP_DEFERRED) == []
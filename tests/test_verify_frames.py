@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from KCWI_scripts.fits_header import FITS_BLOCK
+from KCWI_scripts.verify_frames import check_frame, verify_directory, verify_and_repair
+
+# Offline tests of the header-only check of downloaded frames: structural
+# faults make a file bad, an IMTYPE that disagrees with the metadata only
+# warns and the file is kept.
+
+
+def write_frame(path, koaid, imtype="OBJECT"):
+    hdu = fits.PrimaryHDU(np.zeros((40, 40), dtype=np.int16))
+    hdu.header["KOAID"] = koaid
+    hdu.header["IMTYPE"] = imtype
+    hdu.writeto(path)
+    return str(path)
+
+
+def test_imtype_mismatch_is_a_warning(tmp_path):
+    path = write_frame(tmp_path / "KB.1.fits", "KB.1.fits", imtype="ARCLAMP")
+
+    assert check_frame(path, "KB.1.fits", "object") == (None, "IMTYPE ARCLAMP does not match the metadata (object)")
+    assert check_frame(path, "KB.1.fits", "arclamp") == (None, None)
+
+
+def test_structural_faults(tmp_path):
+    path = write_frame(tmp_path / "KB.1.fits", "KB.1.fits")
+    fault, _ = check_frame(path, "KB.2.fits", "object")
+    assert "KOAID" in fault
+
+    with open(path, "r+b") as f:
+        f.truncate(FITS_BLOCK + 100)
+    fault, _ = check_frame(path, "KB.1.fits", "object")
+    assert "truncated" in fault
+
+
+def test_files_with_the_wrong_imtype_are_not_downloaded_again(tmp_path, capsys):
+    write_frame(tmp_path / "KB.1.fits", "KB.1.fits", imtype="ARCLAMP")
+    write_frame(tmp_path / "KB.2.fits", "KB.2.fits")
+    table = Table({"koaid": ["KB.1.fits", "KB.2.fits"], "koaimtyp": ["object", "object"],
+                   "filehand": ["/kcwi/KB.1.fits", "/kcwi/KB.2.fits"]})
+    mtime = os.path.getmtime(tmp_path / "KB.1.fits")
+
+    assert verify_directory(str(tmp_path), table, max_workers=1) == {}
+    assert "⚠️ KB.1.fits: IMTYPE ARCLAMP" in capsys.readouterr().out
+    assert verify_and_repair(table, str(tmp_path), max_workers=1) == {}
+    assert os.path.getmtime(tmp_path / "KB.1.fits") == mtime
+    assert "Downloading" not in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("koaid, expected", [("KB.1.fits", set()), ("KB.9.fits", {"KB.1.fits"})])
+def test_koaid_mismatch_makes_a_file_bad(tmp_path, koaid, expected):
+    write_frame(tmp_path / "KB.1.fits", koaid)
+
+    assert set(verify_directory(str(tmp_path), max_workers=1, verbose=False)) == expected